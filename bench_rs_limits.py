@@ -0,0 +1,593 @@
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import fnmatch
+import json
+import os
+import random
+import time
+import timeit
+
+import argparse
+
+import rs_limits
+
+
+class FakeDatabase(object):
+    """
+    An in-memory stand-in for the Redis database, implementing just
+    enough of the client interface for rs_preprocess().  Each command
+    counts as one round trip; an artificial latency may be added to
+    every round trip.
+    """
+
+    def __init__(self, data=None, hashes=None, latency=0.0):
+        """
+        Initialize the FakeDatabase.
+
+        :param data: A dictionary of the string keys and their
+                     values.
+        :param hashes: A dictionary mapping the names of hashes to
+                       dictionaries of their fields and values.
+        :param latency: The number of seconds to delay each round
+                        trip.
+        """
+
+        self.data = data or {}
+        self.hashes = hashes or {}
+        self.latency = latency
+        self.calls = {}
+
+    def _round_trip(self, command):
+        """
+        Account for a round trip to the database.
+
+        :param command: The name of the command.
+        """
+
+        self.calls[command] = self.calls.get(command, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def round_trips(self):
+        """
+        Return the total number of round trips so far.
+        """
+
+        return sum(self.calls.values())
+
+    def get(self, key):
+        self._round_trip('get')
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self._round_trip('mget')
+        return [self.data.get(key) for key in keys]
+
+    def hget(self, name, field):
+        self._round_trip('hget')
+        return self.hashes.get(name, {}).get(field)
+
+    def hmget(self, name, fields):
+        self._round_trip('hmget')
+        hash_ = self.hashes.get(name, {})
+        return [hash_.get(field) for field in fields]
+
+    def scan_iter(self, match=None, count=None):
+        self._round_trip('scan')
+        return iter([key for key in sorted(self.data)
+                     if match is None or fnmatch.fnmatchcase(key, match)])
+
+    def hscan_iter(self, name, match=None, count=None):
+        self._round_trip('hscan')
+        return iter([(field, value) for field, value in
+                     sorted(self.hashes.get(name, {}).items())
+                     if match is None or fnmatch.fnmatchcase(field, match)])
+
+    def script_load(self, source):
+        self._round_trip('script_load')
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        """
+        Emulate the Lua scripts used by rs_limits.
+        """
+
+        self._round_trip('evalsha')
+        keys = keys_and_args[:numkeys]
+        args = keys_and_args[numkeys:]
+        if sha == rs_limits._first_match_keys.sha:
+            values = [self.data.get(key) for key in keys]
+        elif sha == rs_limits._first_match_hash.sha:
+            hash_ = self.hashes.get(keys[0], {})
+            values = [hash_.get(field) for field in args]
+        else:
+            raise Exception("Unknown script %r" % sha)
+
+        for idx, value in enumerate(values):
+            if value is not None:
+                return [idx, value]
+        return None
+
+    def publish(self, channel, message):
+        self._round_trip('publish')
+
+
+class Middleware(object):
+    """
+    A stand-in for the Turnstile middleware, which only provides the
+    database handle.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+
+class Workload(object):
+    """
+    A synthetic workload of X-PP-Groups header values.
+    """
+
+    def __init__(self, groups=8, hit=0, explicit=1.0, distinct=100,
+                 skew=1.0, seed=None):
+        """
+        Initialize the Workload.
+
+        :param groups: The number of groups in each header value.
+        :param hit: The position, in priority order, of the mapped
+                    group in each header value.  If None, no group is
+                    mapped.
+        :param explicit: The fraction of header values which give
+                         explicit quality values for their groups; the
+                         remaining header values trigger the Repose
+                         group priority workaround.
+        :param distinct: The number of distinct header values.
+        :param skew: The exponent of the Zipf distribution used to
+                     select header values; 0 selects them uniformly.
+        :param seed: The seed for the random number generator.
+        """
+
+        self.rand = random.Random(seed)
+        self.headers = []
+        self.mappings = {}
+
+        for hdr in range(distinct):
+            names = ['grp%d-%d' % (hdr, idx) for idx in range(groups)]
+            if self.rand.random() < explicit:
+                # Qualities in decreasing order, so the priority order
+                # is the header order
+                header = ','.join('%s;q=%.3f' % (name, 0.9 - 0.001 * idx)
+                                  for idx, name in enumerate(names))
+            else:
+                # All groups get the default priority, so the priority
+                # order is the header order
+                header = ','.join(names)
+            self.headers.append(header)
+
+            if hit is not None:
+                self.mappings[names[hit]] = 'class%d' % (hdr % 10)
+
+        # Set up the cumulative weights for the Zipf distribution
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, distinct + 1):
+            total += 1.0 / rank ** skew
+            self.cumulative.append(total)
+
+    def next(self):
+        """
+        Select the next header value.
+        """
+
+        point = self.rand.random() * self.cumulative[-1]
+        return self.headers[bisect.bisect(self.cumulative, point)]
+
+    def database(self, storage='keys', latency=0.0):
+        """
+        Build a FakeDatabase containing the group mappings.
+
+        :param storage: The storage layout; either "keys" or "hash".
+        :param latency: The number of seconds to delay each round
+                        trip.
+        """
+
+        if storage == 'hash':
+            return FakeDatabase(hashes={rs_limits.GROUP_HASH:
+                                        dict(self.mappings)},
+                                latency=latency)
+
+        return FakeDatabase(data=dict(('rs-group:%s' % group, klass)
+                                      for group, klass in
+                                      self.mappings.items()),
+                            latency=latency)
+
+
+# The workloads to benchmark
+scenarios = {
+    'few-groups': dict(groups=3, hit=0, explicit=1.0, distinct=100),
+    'typical': dict(groups=8, hit=5, explicit=0.5, distinct=300),
+    'late-hit': dict(groups=15, hit=14, explicit=1.0, distinct=300),
+    'repose': dict(groups=10, hit=7, explicit=0.0, distinct=300),
+    'unmapped': dict(groups=10, hit=None, explicit=0.5, distinct=300),
+    'uniform': dict(groups=8, hit=5, explicit=0.5, distinct=3000,
+                    skew=0.0),
+}
+
+# The lookup strategies to benchmark, as rs_limits configuration
+strategies = {
+    'get': dict(lookup='get'),
+    'mget': dict(lookup='mget'),
+    'lua': dict(lookup='lua'),
+    'hash': dict(storage='hash'),
+    'cache': dict(lookup='mget', cache_size='10000'),
+    'resolution-cache': dict(lookup='mget', resolution_cache_size='10000'),
+    'snapshot': dict(lookup='mget', snapshot='yes'),
+    'filter': dict(lookup='get', group_filter='bloom'),
+    'table': dict(lookup='mget', resolution_table='yes'),
+}
+
+
+def run(workload, strategy, requests=10000, warmup=1000, latency=0.0):
+    """
+    Benchmark rs_preprocess() for a given workload and lookup
+    strategy.
+
+    :param workload: The Workload to drive rs_preprocess() with.
+    :param strategy: The "rs_limits" configuration section.
+    :param requests: The number of requests to measure.
+    :param warmup: The number of requests to issue before measuring.
+    :param latency: The number of seconds to delay each round trip to
+                    the database.
+
+    :returns: A dictionary containing the requests per second ("rps"),
+              the median and 99th percentile latencies in seconds
+              ("p50" and "p99"), and the average number of round
+              trips to the database per request ("round_trips").
+    """
+
+    db = workload.database(strategy.get('storage', 'keys'), latency)
+    midware = Middleware(db)
+    rs_conf = dict(strategy, cache_listen='no')
+
+    # Load the snapshot, filter, and resolution table here, rather
+    # than in background threads
+    snapshot = rs_conf.pop('snapshot', None)
+    group_filter = rs_conf.pop('group_filter', None)
+    table = rs_conf.pop('resolution_table', None)
+    state = rs_limits._get_state(midware, {'rs_limits': rs_conf})
+    if snapshot:
+        state.snapshot = rs_limits.MappingSnapshot(
+            rs_limits._get_storage(db, rs_conf))
+        state.snapshot.load()
+    if group_filter:
+        state.filter = rs_limits.GroupFilter(
+            rs_limits._get_storage(db, rs_conf), group_filter)
+        state.filter.load()
+    if table:
+        # As group_table would compute it, for every header value
+        state.table = rs_limits.ResolutionTable(db)
+        state.table.entries = dict(
+            (tuple(field.split(',')), klass or None)
+            for field, klass in rs_limits._compute_table(
+                workload.headers, rs_limits.GroupPriorities(''),
+                workload.mappings).items())
+    conf = {'rs_limits': rs_conf}
+
+    timer = timeit.default_timer
+    for i in range(warmup):
+        rs_limits.rs_preprocess(midware, {
+            'HTTP_X_PP_GROUPS': workload.next(),
+            'turnstile.conf': conf,
+        })
+
+    samples = []
+    before = db.round_trips()
+    for i in range(requests):
+        environ = {
+            'HTTP_X_PP_GROUPS': workload.next(),
+            'turnstile.conf': conf,
+        }
+        start = timer()
+        rs_limits.rs_preprocess(midware, environ)
+        samples.append(timer() - start)
+
+    samples.sort()
+    return {
+        'rps': len(samples) / sum(samples),
+        'p50': samples[len(samples) // 2],
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'round_trips': float(db.round_trips() - before) / len(samples),
+    }
+
+
+# The file holding the baselines for the performance regression gate
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'perf_baselines.json')
+
+# The group priorities and header values used by the microbenchmarks
+_micro_prios = ','.join(['=0.05'] + ['grp%d=0.%03d' % (idx, idx + 100)
+                                     for idx in range(20)])
+_micro_explicit = ','.join('grp%d;q=%.3f' % (idx, 0.9 - 0.001 * idx)
+                           for idx in range(8))
+_micro_repose = ','.join('grp%d' % idx for idx in range(8))
+
+
+def _time(func, number, repeat=5):
+    """
+    Time a function, taking the best of several repetitions to reduce
+    the effect of other activity on the machine.
+
+    :param func: The function to time; it is called with no arguments.
+    :param number: The number of calls in each repetition.
+    :param repeat: The number of repetitions.
+
+    :returns: The time per call, in seconds.
+    """
+
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def _reference(data, table):
+    """
+    A fixed reference workload, resembling the header parsing done by
+    the preprocessor but independent of the code under test.
+
+    :param data: A comma-separated list of names and quality values.
+    :param table: A dictionary of multipliers for the names.
+
+    :returns: The names, sorted by decreasing weighted quality.
+    """
+
+    result = []
+    for part in data.split(','):
+        name, _sep, quality = part.partition(';q=')
+        result.append((-float(quality or 1) * table.get(name, 1.0), name))
+    result.sort()
+
+    return [name for _weight, name in result]
+
+
+def calibrate():
+    """
+    Time a fixed, pure-Python reference workload.  Timings divided by
+    this are roughly independent of the speed of the machine.
+
+    :returns: The time taken by the reference workload, in seconds.
+    """
+
+    data = ','.join('grp%d;q=0.%d' % (idx, idx) for idx in range(10))
+    table = dict(('grp%d' % idx, 0.5) for idx in range(0, 10, 2))
+    return _time(lambda: _reference(data, table), 5000)
+
+
+def _micro_preprocess(strategy):
+    """
+    Build a microbenchmark of rs_preprocess() with a lookup strategy.
+
+    :param strategy: The name of the lookup strategy.
+
+    :returns: A function which runs the microbenchmark.
+    """
+
+    def bench():
+        workload = Workload(seed=42, **scenarios['typical'])
+        result = run(workload, strategies[strategy], 2000, 500)
+        return {'seconds': result['p50'],
+                'round_trips': result['round_trips']}
+
+    return bench
+
+
+# The microbenchmarks guarded by the performance regression gate.
+# Each returns a dictionary of the time per call, in seconds, and
+# optionally the average number of round trips to the database.
+microbenchmarks = {
+    'priorities': lambda: {
+        'seconds': _time(lambda: rs_limits.GroupPriorities(_micro_prios),
+                         2000),
+    },
+    'parse-explicit': lambda: {
+        'seconds': _time(lambda: rs_limits._parse_groups(
+            _micro_explicit, rs_limits.GroupPriorities(_micro_prios)),
+            2000),
+    },
+    'parse-repose': lambda: {
+        'seconds': _time(lambda: rs_limits._parse_groups(
+            _micro_repose, rs_limits.GroupPriorities(_micro_prios)),
+            2000),
+    },
+}
+for _strategy in strategies:
+    microbenchmarks['preprocess-%s' % _strategy] = \
+        _micro_preprocess(_strategy)
+
+
+def measure(name, rounds=5):
+    """
+    Run a microbenchmark.  Each round times the reference workload
+    immediately before the microbenchmark, so that changes in the
+    speed of the machine while measuring affect both alike.
+
+    :param name: The name of the microbenchmark.
+    :param rounds: The number of rounds to run.  The median cost is
+                   reported.
+
+    :returns: A dictionary of the cost per call, relative to the
+              reference workload, and the average number of round
+              trips to the database, if the microbenchmark counts
+              them.
+    """
+
+    costs = []
+    for _round in range(rounds):
+        unit = calibrate()
+        result = microbenchmarks[name]()
+        costs.append(result['seconds'] / unit)
+    costs.sort()
+
+    measured = {'cost': costs[len(costs) // 2]}
+    if 'round_trips' in result:
+        measured['round_trips'] = result['round_trips']
+
+    return measured
+
+
+def compare(measured, baseline, tolerance):
+    """
+    Compare the result of a microbenchmark against its baseline.
+
+    :param measured: The result of the microbenchmark, as returned by
+                     measure().
+    :param baseline: The baseline for the microbenchmark, in the same
+                     form.
+    :param tolerance: The fraction by which the cost may exceed the
+                      baseline.  Round trips may never exceed the
+                      baseline.
+
+    :returns: A list of descriptions of the regressions; empty if
+              there are none.
+    """
+
+    regressions = []
+    if measured['cost'] > baseline['cost'] * (1.0 + tolerance):
+        regressions.append("cost %.2f exceeds baseline %.2f by more than "
+                           "%d%%" % (measured['cost'], baseline['cost'],
+                                     tolerance * 100))
+    if measured.get('round_trips', 0.0) > baseline.get('round_trips',
+                                                       0.0) + 1e-9:
+        regressions.append("round trips %.2f exceed baseline %.2f" %
+                           (measured['round_trips'],
+                            baseline.get('round_trips', 0.0)))
+
+    return regressions
+
+
+def load_baselines(path=BASELINES):
+    """
+    Load the baselines for the performance regression gate.
+
+    :param path: The name of the baselines file.
+
+    :returns: A dictionary containing the tolerance ("tolerance") and
+              a dictionary mapping the microbenchmark names to their
+              baselines ("baselines").
+    """
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def update_baselines(path=BASELINES, tolerance=0.5):
+    """
+    Measure all the microbenchmarks, and save the results as the new
+    baselines.
+
+    :param path: The name of the baselines file.
+    :param tolerance: The fraction by which the cost may exceed the
+                      baselines.
+
+    :returns: The new baselines, in the form returned by
+              load_baselines().
+    """
+
+    baselines = {
+        'tolerance': tolerance,
+        'baselines': dict((name, measure(name))
+                          for name in sorted(microbenchmarks)),
+    }
+
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+    return baselines
+
+
+def main():
+    """
+    Benchmark rs_preprocess() under a variety of workloads and lookup
+    strategies.
+    """
+
+    parser = argparse.ArgumentParser(description=main.__doc__.strip())
+    parser.add_argument('--scenario', '-s',
+                        dest='scenarios',
+                        action='append',
+                        choices=sorted(scenarios),
+                        help="Benchmark the given scenario.  May be given "
+                        "more than once.  Defaults to all scenarios.")
+    parser.add_argument('--strategy', '-S',
+                        dest='strategies',
+                        action='append',
+                        choices=sorted(strategies),
+                        help="Benchmark the given lookup strategy.  May be "
+                        "given more than once.  Defaults to all strategies.")
+    parser.add_argument('--requests', '-n',
+                        dest='requests',
+                        type=int,
+                        default=10000,
+                        help="The number of requests to measure.  Defaults "
+                        "to %(default)s.")
+    parser.add_argument('--warmup', '-w',
+                        dest='warmup',
+                        type=int,
+                        default=1000,
+                        help="The number of requests to issue before "
+                        "measuring.  Defaults to %(default)s.")
+    parser.add_argument('--latency', '-l',
+                        dest='latency',
+                        type=float,
+                        default=0.0,
+                        help="The simulated latency of each round trip to "
+                        "the database, in milliseconds.  Defaults to "
+                        "%(default)s.")
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=42,
+                        help="The seed for the random number generator.  "
+                        "Defaults to %(default)s.")
+    parser.add_argument('--update-baselines',
+                        dest='update_baselines',
+                        action='store_true',
+                        default=False,
+                        help="Instead of benchmarking, measure the "
+                        "microbenchmarks guarded by the performance "
+                        "regression gate, and save the results as the new "
+                        "baselines.")
+    args = parser.parse_args()
+
+    if args.update_baselines:
+        baselines = update_baselines()
+        for name, baseline in sorted(baselines['baselines'].items()):
+            print "%-27s cost %8.2f  trips %5.2f" % (
+                name, baseline['cost'], baseline.get('round_trips', 0.0))
+        return
+
+    print "%-12s %-17s %10s %10s %10s %8s" % (
+        'scenario', 'strategy', 'req/s', 'p50 (us)', 'p99 (us)', 'trips')
+    for scen_name in args.scenarios or sorted(scenarios):
+        for strat_name in args.strategies or sorted(strategies):
+            workload = Workload(seed=args.seed, **scenarios[scen_name])
+            result = run(workload, strategies[strat_name], args.requests,
+                         args.warmup, args.latency / 1000.0)
+            print "%-12s %-17s %10.0f %10.1f %10.1f %8.2f" % (
+                scen_name, strat_name, result['rps'],
+                result['p50'] * 1000000, result['p99'] * 1000000,
+                result['round_trips'])
+
+
+if __name__ == '__main__':
+    main()
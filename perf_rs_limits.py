@@ -0,0 +1,88 @@
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Performance regression gate.  These tests are timing-sensitive, so
+# they are not named like the correctness tests; run them with
+# "tox -e perf".  After an intended change in performance, regenerate
+# the baselines with "python bench_rs_limits.py --update-baselines".
+
+import os
+
+import unittest2
+
+import bench_rs_limits
+
+
+class TestPerformance(unittest2.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.baselines = bench_rs_limits.load_baselines()
+        cls.tolerance = float(os.environ.get('RS_LIMITS_PERF_TOLERANCE',
+                                             cls.baselines['tolerance']))
+
+    def check(self, name):
+        baseline = self.baselines['baselines'][name]
+        measured = bench_rs_limits.measure(name)
+
+        regressions = bench_rs_limits.compare(measured, baseline,
+                                              self.tolerance)
+        if regressions:
+            # Timings are noisy; make sure it wasn't a fluke
+            measured = bench_rs_limits.measure(name)
+            regressions = bench_rs_limits.compare(measured, baseline,
+                                                  self.tolerance)
+
+        self.assertEqual(regressions, [],
+                         "%s: %s" % (name, '; '.join(regressions)))
+
+    def test_baselines_complete(self):
+        self.assertEqual(sorted(self.baselines['baselines']),
+                         sorted(bench_rs_limits.microbenchmarks))
+
+    def test_priorities(self):
+        self.check('priorities')
+
+    def test_parse_explicit(self):
+        self.check('parse-explicit')
+
+    def test_parse_repose(self):
+        self.check('parse-repose')
+
+    def test_preprocess_get(self):
+        self.check('preprocess-get')
+
+    def test_preprocess_mget(self):
+        self.check('preprocess-mget')
+
+    def test_preprocess_lua(self):
+        self.check('preprocess-lua')
+
+    def test_preprocess_hash(self):
+        self.check('preprocess-hash')
+
+    def test_preprocess_cache(self):
+        self.check('preprocess-cache')
+
+    def test_preprocess_resolution_cache(self):
+        self.check('preprocess-resolution-cache')
+
+    def test_preprocess_snapshot(self):
+        self.check('preprocess-snapshot')
+
+    def test_preprocess_filter(self):
+        self.check('preprocess-filter')
+
+    def test_preprocess_table(self):
+        self.check('preprocess-table')
@@ -13,8 +13,52 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import bisect
+import cProfile
+import csv
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import pstats
+import socket
+import struct
+import sys
+import threading
+import time
+import weakref
+
+import eventlet
+from eventlet import event
+import redis
 from turnstile import config
 from turnstile import tools
+from turnstile import utils
+
+
+LOG = logging.getLogger('rs_limits')
+
+# The channel on which changes to the group mappings are announced
+GROUP_CHANNEL = 'rs-group-update'
+
+# The hash in which the group mappings are stored, if so configured
+GROUP_HASH = 'rs-groups'
+
+# The hash in which the group priorities and their version are stored
+PRIORITIES_KEY = 'rs-group-priorities'
+
+# The hash in which the rate-limit classes precomputed for common
+# combinations of groups are stored, and the hash holding its version
+# and the mapping epoch it was computed at
+TABLE_KEY = 'rs-group-table'
+TABLE_INFO_KEY = 'rs-group-table-info'
+
+# The counter bumped whenever the tools change the group mappings
+EPOCH_KEY = 'rs-group-epoch'
 
 
 class GroupPriorities(dict):
@@ -45,6 +89,10 @@ class GroupPriorities(dict):
         # Initialize the dict object
         super(GroupPriorities, self).__init__()
 
+        # Remember where we came from, so callers can tell whether we
+        # need to be rebuilt
+        self.conf_value = conf_value
+
         # Now, start populating ourself
         for group_spec in conf_value.split(','):
             group_spec = group_spec.strip()
@@ -70,175 +118,4522 @@ class GroupPriorities(dict):
         return self.get('', 0.1)
 
 
-def rs_preprocess(midware, environ):
+class LuaScript(object):
     """
-    Pre-process requests to nova.  Derives the rate-limit class from
-    the X-PP-Groups header.
+    A Lua script to be executed by the database.  The script is
+    invoked by its SHA1 digest, so that its text need only be sent to
+    the database once; if the database does not know the script
+    (e.g., because it has been restarted), the script is loaded and
+    invoked again.
     """
 
-    # If we don't have the header, let nova_preprocess() do its magic.
-    group_str = environ.get('HTTP_X_PP_GROUPS')
-    if not group_str:
-        return
+    def __init__(self, source):
+        """
+        Initialize the LuaScript.
 
-    # We'll need the nova context
-    context = environ.get('nova.context')
-    if context and not hasattr(context, 'quota_class'):
-        # If the context doesn't have quota_class, then don't activate
-        # the quota_class part of the algorithm...
-        context = None
+        :param source: The text of the script.
+        """
 
-    # Split the groups string into a list of groups, respecting quality
-    groups = []
-    overall_quality = 1.0
-    for group in group_str.split(','):
-        # Strip off any whitespace, just in case
-        group = group.strip()
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
 
-        # Convert quality, if present
-        quality = 1.0
-        name, _sep, qual_str = group.partition(';')
-        if qual_str.startswith('q='):
-            try:
-                quality = float(qual_str[2:])
-            except ValueError:
-                # Invalid float; use 1.0
-                pass
+    def __call__(self, db, keys=(), args=()):
+        """
+        Execute the script.
 
-        groups.append((name, quality))
-        overall_quality *= quality
+        :param db: The database handle.
+        :param keys: A list of the keys to pass to the script.
+        :param args: A list of the additional arguments to pass to the
+                     script.
 
-    # If the overall quality is 1.0, that means we have the Repose
-    # group priority bug; work around it by rebuilding the groups list
-    if overall_quality == 1.0:
-        # First, let's build the group priorities dictionary
-        conf = environ.get('turnstile.conf', {'rs_limits': {}})
-        prios = GroupPriorities(conf['rs_limits'].get('groups', ''))
+        :returns: The result of the script.
+        """
 
-        # Now walk through the groups list and rebuild it
-        for idx in range(len(groups)):
-            name, quality = groups[idx]
-            groups[idx] = (name, prios[name.lower()] * quality)
+        keys = list(keys)
+        args = list(args)
+        try:
+            return db.evalsha(self.sha, len(keys), *(keys + args))
+        except redis.exceptions.NoScriptError:
+            # Load the script and try again
+            db.script_load(self.source)
+            return db.evalsha(self.sha, len(keys), *(keys + args))
 
-    # Look up the rate-limit class from the database
-    for group, _quality in sorted(groups, key=lambda x: x[1], reverse=True):
-        klass = midware.db.get('rs-group:%s' % group)
-        if klass:
-            # We have our rate-limit group!
-            environ['turnstile.nova.limitclass'] = klass
 
-            # If we have a context that supports it, set the quota
-            # class
-            if context:
-                context.quota_class = klass
+# Find the first of the given keys which has a value.  Returns the
+# (0-based) index of the key and its value, or nil.
+_first_match_keys = LuaScript("""
+for i, key in ipairs(KEYS) do
+    local value = redis.call('GET', key)
+    if value then
+        return {i - 1, value}
+    end
+end
+return nil
+""")
 
-            return
+# Find the first of the given fields of the hash named by the sole key
+# which has a value.  Returns the (0-based) index of the field and its
+# value, or nil.
+_first_match_hash = LuaScript("""
+for i, field in ipairs(ARGV) do
+    local value = redis.call('HGET', KEYS[1], field)
+    if value then
+        return {i - 1, value}
+    end
+end
+return nil
+""")
 
 
-def _check_arguments(args):
+def _first_match(db, keys):
     """
-    Sanity-check the arguments to ensure that the --class and --delete
-    options are not both given.  This is a preprocessor for the
-    group_class() function, when being called in console script mode.
+    Find the first of several keys which has a value.  The search is
+    performed by a Lua script in the database, so that only the
+    matching key's value is returned.
 
-    :param args: A Namespace object containing a 'klass' attribute and
-                 a 'delete' attribute.
+    :param db: The database handle.  If this is a DatabaseWrapper,
+               its first_match() method is used.
+    :param keys: A list of the keys to check, in order.
+
+    :returns: A tuple of the index of the first key with a value and
+              that value.  If no key has a value, returns (None,
+              None).
     """
 
-    if args.klass and args.delete:
-        raise Exception("The --class and --delete options are "
-                        "mutually exclusive.")
+    if isinstance(db, DatabaseWrapper):
+        return db.first_match(keys)
 
+    return _script_first_match(db, keys)
 
-def _report_group_class(args, result):
+
+def _script_first_match(db, keys):
     """
-    Report the rate-limit class for the group.  This is a
-    postprocessor for the group_class() function, when being called in
-    console script mode.
+    Find the first of several keys which has a value, using a Lua
+    script.
 
-    :param args: A Namespace object containing a 'group' attribute, a
-                 desired rate-limit class in the 'klass' attribute
-                 (which should be None if no change was requested),
-                 and a 'delete' attribute (which should be True if the
-                 association was to be deleted).
-    :param result: The result of the group_class() function call.
-                   This will be the previously configured rate-limit
-                   class for the group.
+    :param db: The database handle.
+    :param keys: A list of the keys to check, in order.
 
-    :returns: None to indicate success.
+    :returns: A tuple of the index of the first key with a value and
+              that value.  If no key has a value, returns (None,
+              None).
     """
 
-    print "Group %s:" % args.group
-    if args.klass or args.delete:
-        if result:
-            print "  Previous rate-limit class: %s" % result
-        if args.delete:
-            print "  Deleted from database"
-        else:
-            print "  New rate-limit class: %s" % args.klass
-    elif result:
-        print "  Configured rate-limit class: %s" % result
-    else:
-        print "  Not currently configured in database."
+    result = _first_match_keys(db, keys)
+    if not result:
+        return None, None
 
-    return None
+    return int(result[0]), result[1]
 
 
-@tools.add_argument('config',
-                    help="Name of the configuration file, for connecting "
-                    "to the Redis database.")
-@tools.add_argument('group',
-                    help="Name of the group.")
-@tools.add_argument('--debug', '-d',
-                    dest='debug',
-                    action='store_true',
-                    default=False,
-                    help="Run the tool in debug mode.")
-@tools.add_argument('--delete', '-D',
-                    dest='delete',
-                    action='store_true',
-                    default=False,
-                    help="Delete the group from the database.")
-@tools.add_argument('--class', '-c',
-                    dest='klass',
-                    action='store',
-                    default=None,
-                    help="If specified, sets the class associated with "
-                    "the given group.")
-@tools.add_preprocessor(_check_arguments)
-@tools.add_postprocessor(_report_group_class)
-def group_class(conf_file, group, klass=None, delete=False):
+class DatabaseWrapper(object):
+    """
+    Base class for objects which wrap a database handle to alter the
+    handling of the group mappings.  All attribute accesses not
+    handled by the subclass are passed through to the underlying
+    database handle.
     """
-    Set up or query limit classes associated with groups.
 
-    :param conf_file: Name of the configuration file, for connecting
-                      to the Redis database.
-    :param group: The name of the group.
-    :param klass: If provided, the name of the class to map the group
-                  to.
-    :param delete: If True, deletes the group from the database.
+    def __init__(self, db):
+        """
+        Initialize the wrapper.
 
-    Returns the class associated with the given group.  Note that only
-    one of `klass` or `delete` may be given.
+        :param db: The database handle to wrap.
+        """
+
+        self.db = db
+
+    def __getattr__(self, name):
+        """
+        Pass all other attribute accesses through to the database.
+        """
+
+        return getattr(self.db, name)
+
+    def first_match(self, keys):
+        """
+        Find the first of several keys which has a value.
+
+        :param keys: A list of the keys to check, in order.
+
+        :returns: A tuple of the index of the first key with a value
+                  and that value.  If no key has a value, returns
+                  (None, None).
+        """
+
+        return _first_match(self.db, keys)
+
+
+class HashDatabase(DatabaseWrapper):
+    """
+    Wrap a database handle so that the group mappings are stored as
+    the fields of a single hash, rather than as individual
+    "rs-group:<group>" keys.  The get(), mget(), set(), delete(),
+    scan_iter(), and first_match() methods translate the key names
+    into the names of the hash fields.
     """
 
-    # Connect to the database...
-    conf = config.Config(conf_file=conf_file)
-    db = conf.get_database()
+    prefix = 'rs-group:'
 
-    # Get the key for the limit class...
-    key = 'rs-group:%s' % group
+    def __init__(self, db, name=GROUP_HASH):
+        """
+        Initialize the wrapper.
 
-    # Now, look up the tenant's current class
-    old_klass = db.get(key)
+        :param db: The database handle to wrap.
+        :param name: The name of the hash.
+        """
 
-    # Do we need to delete it?  Change it?
-    if delete and old_klass is not None:
-        db.delete(key)
-    elif klass and klass != old_klass:
-        db.set(key, klass)
+        super(HashDatabase, self).__init__(db)
+        self.name = name
 
-    return old_klass
+    def _field(self, key):
+        """
+        Translate a key name into the name of the hash field.
+
+        :param key: The key name, e.g., "rs-group:<group>".
+
+        :returns: The field name, e.g., "<group>".
+        """
+
+        return key[len(self.prefix):]
+
+    def get(self, key):
+        """
+        Retrieve the value of a key.
+
+        :param key: The key to retrieve.
+
+        :returns: The value of the key, or None.
+        """
+
+        return self.db.hget(self.name, self._field(key))
+
+    def mget(self, keys):
+        """
+        Retrieve the values of several keys, using a single HMGET.
+
+        :param keys: A list of the keys to retrieve.
+
+        :returns: A list of the values of the keys.
+        """
+
+        return self.db.hmget(self.name, [self._field(key) for key in keys])
+
+    def set(self, key, value):
+        """
+        Set the value of a key.
+
+        :param key: The key to set.
+        :param value: The value to set it to.
+        """
+
+        return self.db.hset(self.name, self._field(key), value)
+
+    def delete(self, *keys):
+        """
+        Delete one or more keys.
+
+        :param keys: The keys to delete.
+        """
+
+        return self.db.hdel(self.name, *[self._field(key) for key in keys])
+
+    def pipeline(self, *args, **kwargs):
+        """
+        Create a pipeline which also stores the group mappings in the
+        hash.  All arguments are passed to the pipeline() method of
+        the wrapped database handle.
+
+        :returns: A HashDatabase wrapping the pipeline.
+        """
+
+        return self.__class__(self.db.pipeline(*args, **kwargs), self.name)
+
+    def scan_iter(self, match=None, count=None):
+        """
+        Iterate over the keys, using HSCAN.
+
+        :param match: A glob pattern for the key names, which must
+                      begin with "rs-group:".
+        :param count: A hint for the number of keys to retrieve at a
+                      time.
+
+        :returns: An iterator over the key names.
+        """
+
+        if match is not None:
+            match = self._field(match)
+
+        for field, _value in self.db.hscan_iter(self.name, match=match,
+                                                count=count):
+            yield self.prefix + field
+
+    def first_match(self, keys):
+        """
+        Find the first of several keys which has a value.  The search
+        is performed by a Lua script in the database.
+
+        :param keys: A list of the keys to check, in order.
+
+        :returns: A tuple of the index of the first key with a value
+                  and that value.  If no key has a value, returns
+                  (None, None).
+        """
+
+        result = _first_match_hash(self.db, [self.name],
+                                   [self._field(key) for key in keys])
+        if not result:
+            return None, None
+
+        return int(result[0]), result[1]
+
+
+def _get_storage(db, rs_conf):
+    """
+    Wrap a database handle as required by the configured storage of
+    the group mappings.
+
+    :param db: The database handle.
+    :param rs_conf: The "rs_limits" section of the configuration.  If
+                    the "storage" option is "hash", the mappings are
+                    stored in a single hash.
+
+    :returns: A database handle.
+    """
+
+    if rs_conf.get('storage', 'keys') == 'hash':
+        return HashDatabase(db)
+
+    return db
+
+
+class MappingCache(object):
+    """
+    An in-process cache of database values, such as the rate-limit
+    classes mapped to groups.  The cache is bounded; when it is full,
+    the least recently used entry is evicted.  Entries may also be
+    given a time-to-live.  Negative results--values of None--are
+    cached just like any other value.
+    """
+
+    # Indexes into the link lists
+    PREV, NEXT, KEY, VALUE, EXPIRE = range(5)
+
+    def __init__(self, size, ttl=None):
+        """
+        Initialize the cache.
+
+        :param size: The maximum number of entries in the cache.
+        :param ttl: The number of seconds for which an entry remains
+                    valid.  If None or 0, entries do not expire and
+                    will only be evicted to make room.
+        """
+
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # Counts the invalidations, so that callers can tell whether a
+        # value fetched from the database may have been superseded
+        # while they waited for it
+        self.invalidations = 0
+
+        # The entries are kept in a circular doubly-linked list, most
+        # recently used first, and indexed by key
+        self._lock = threading.Lock()
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        """
+        Return the number of entries in the cache.
+        """
+
+        return len(self._data)
+
+    def _unlink(self, link):
+        """
+        Remove a link from the linked list.  Must be called with the
+        lock held.
+
+        :param link: The link to remove.
+        """
+
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _push(self, link):
+        """
+        Add a link to the front of the linked list.  Must be called
+        with the lock held.
+
+        :param link: The link to add.
+        """
+
+        root = self._root
+        link[self.PREV] = root
+        link[self.NEXT] = root[self.NEXT]
+        root[self.NEXT][self.PREV] = link
+        root[self.NEXT] = link
+
+    def lookup(self, key, default=None):
+        """
+        Look up a key in the cache.  Updates the hit and miss
+        counters.
+
+        :param key: The key to look up.
+        :param default: The value to return if the key is not in the
+                        cache or has expired.  Note that a cached
+                        value may be None, so callers which need to
+                        distinguish a cached None should pass a
+                        sentinel.
+
+        :returns: The cached value, or the default.
+        """
+
+        with self._lock:
+            link = self._data.get(key)
+            if link is not None:
+                expire = link[self.EXPIRE]
+                if expire is None or expire > time.time():
+                    # Mark it most recently used
+                    self._unlink(link)
+                    self._push(link)
+                    self.hits += 1
+                    return link[self.VALUE]
+
+                # Expired; get rid of it
+                self._unlink(link)
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+    def store(self, key, value):
+        """
+        Store a value into the cache, evicting the least recently
+        used entry if the cache is full.
+
+        :param key: The key to store.
+        :param value: The value to associate with the key.  May be
+                      None.
+        """
+
+        expire = time.time() + self.ttl if self.ttl else None
+
+        with self._lock:
+            link = self._data.get(key)
+            if link is not None:
+                self._unlink(link)
+            elif len(self._data) >= self.size:
+                # Evict the least recently used entry
+                oldest = self._root[self.PREV]
+                if oldest is self._root:
+                    # Zero-sized cache; nothing to do
+                    return
+                self._unlink(oldest)
+                del self._data[oldest[self.KEY]]
+
+            link = [None, None, key, value, expire]
+            self._push(link)
+            self._data[key] = link
+
+    def invalidate(self, key=None):
+        """
+        Remove an entry from the cache.
+
+        :param key: The key to remove.  If None, the entire cache is
+                    cleared.
+        """
+
+        with self._lock:
+            self.invalidations += 1
+            if key is None:
+                self._data.clear()
+                self._root[:] = [self._root, self._root, None, None, None]
+                return
+
+            link = self._data.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+
+    def stats(self):
+        """
+        Report statistics about the cache.
+
+        :returns: A dictionary containing the keys "size", "hits",
+                  and "misses".
+        """
+
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class CachingDatabase(DatabaseWrapper):
+    """
+    Wrap a database handle so that the get(), mget(), and
+    first_match() methods are answered from a MappingCache where
+    possible.
+    """
+
+    # Sentinel for cache misses
+    _missing = object()
+
+    def __init__(self, db, cache):
+        """
+        Initialize the wrapper.
+
+        :param db: The database handle to wrap.
+        :param cache: The MappingCache to consult.
+        """
+
+        super(CachingDatabase, self).__init__(db)
+        self.cache = cache
+
+    def get(self, key):
+        """
+        Retrieve the value of a key, consulting the cache first.
+
+        :param key: The key to retrieve.
+
+        :returns: The value of the key, or None.
+        """
+
+        value = self.cache.lookup(key, self._missing)
+        if value is self._missing:
+            invalidations = self.cache.invalidations
+            value = self.db.get(key)
+            self._store([(key, value)], invalidations)
+
+        return value
+
+    def mget(self, keys):
+        """
+        Retrieve the values of several keys, consulting the cache
+        first.  Only the keys missing from the cache are requested
+        from the database, using a single MGET.
+
+        :param keys: A list of the keys to retrieve.
+
+        :returns: A list of the values of the keys.
+        """
+
+        values = [self.cache.lookup(key, self._missing) for key in keys]
+        missing = [idx for idx, value in enumerate(values)
+                   if value is self._missing]
+        if missing:
+            invalidations = self.cache.invalidations
+            fetched = self.db.mget([keys[idx] for idx in missing])
+            for idx, value in zip(missing, fetched):
+                values[idx] = value
+            self._store([(keys[idx], values[idx]) for idx in missing],
+                        invalidations)
+
+        return values
+
+    def first_match(self, keys):
+        """
+        Find the first of several keys which has a value, consulting
+        the cache first.  If a key not in the cache is encountered
+        before a match is found, the remaining keys are searched in
+        the database, and the results are used to update the cache.
+
+        :param keys: A list of the keys to check, in order.
+
+        :returns: A tuple of the index of the first key with a value
+                  and that value.  If no key has a value, returns
+                  (None, None).
+        """
+
+        for start, key in enumerate(keys):
+            value = self.cache.lookup(key, self._missing)
+            if value is self._missing:
+                break
+            elif value:
+                return start, value
+        else:
+            # All the keys were cached, and none of them have values
+            return None, None
+
+        # Search the remaining keys in the database
+        rest = keys[start:]
+        invalidations = self.cache.invalidations
+        idx, value = _first_match(self.db, rest)
+
+        # Every key before the match has no value
+        items = [(key, None) for key in
+                 rest[:len(rest) if idx is None else idx]]
+        if idx is not None:
+            items.append((rest[idx], value))
+        self._store(items, invalidations)
+
+        if idx is None:
+            return None, None
+
+        return start + idx, value
+
+    def _store(self, items, invalidations):
+        """
+        Store values fetched from the database into the cache, unless
+        the cache has been invalidated since they were requested, in
+        which case they may already be out of date.
+
+        :param items: A list of tuples of the keys and their values.
+        :param invalidations: The invalidation count of the cache
+                              when the values were requested.
+        """
+
+        if self.cache.invalidations != invalidations:
+            return
+
+        for key, value in items:
+            self.cache.store(key, value)
+
+
+class MappingSnapshot(object):
+    """
+    An in-memory copy of all the group mappings.  The snapshot is
+    loaded by a daemon thread, which periodically reloads it; it may
+    also be updated one group at a time as changes are announced.
+    The snapshot provides get() and mget() methods, so it may be used
+    in place of the database handle for looking up the mappings.
+    """
+
+    def __init__(self, db, interval=300.0, max_age=900.0, batch=1000):
+        """
+        Initialize the MappingSnapshot.
+
+        :param db: The database handle.
+        :param interval: The number of seconds between reloads of the
+                         snapshot.
+        :param max_age: The maximum age of the snapshot, in seconds.
+                        A snapshot older than this is no longer
+                        considered fresh.
+        :param batch: The number of keys to request from the database
+                      at a time when loading the snapshot.
+        """
+
+        self.db = db
+        self.interval = interval
+        self.max_age = max_age
+        self.batch = batch
+
+        self.mappings = {}
+        self.loaded = None
+        self.pending = None
+
+    def start(self):
+        """
+        Start the loading thread.
+        """
+
+        eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Reload the snapshot forever.
+        """
+
+        while True:
+            try:
+                self.load()
+            except Exception:
+                LOG.exception("Failure loading group mapping snapshot")
+
+            eventlet.sleep(self.interval)
+
+    def load(self):
+        """
+        Load the snapshot from the database.  The keys are enumerated
+        using SCAN, so that the database is not blocked, and their
+        values are retrieved in batches using MGET.
+        """
+
+        # Changes announced while the snapshot is being loaded must be
+        # applied to the new snapshot, since the SCAN may already
+        # have passed them by
+        self.pending = []
+        try:
+            mappings = {}
+
+            keys = []
+            for key in self.db.scan_iter(match='rs-group:*',
+                                         count=self.batch):
+                keys.append(key)
+                if len(keys) >= self.batch:
+                    mappings.update(zip(keys, self.db.mget(keys)))
+                    keys = []
+            if keys:
+                mappings.update(zip(keys, self.db.mget(keys)))
+            mappings.update(self.pending)
+        finally:
+            self.pending = None
+
+        # Install the new snapshot; keys which vanished between the
+        # SCAN and the MGET will have None values, so skip them
+        self.mappings = dict((key, value) for key, value in mappings.items()
+                             if value is not None)
+        self.loaded = time.time()
+
+    def update(self, group):
+        """
+        Update the mapping for a single group from the database.
+
+        :param group: The name of the group.
+        """
+
+        key = 'rs-group:%s' % group
+        value = self.db.get(key)
+        if self.pending is not None:
+            self.pending.append((key, value))
+        if value is None:
+            self.mappings.pop(key, None)
+        else:
+            self.mappings[key] = value
+
+    def fresh(self):
+        """
+        Determine whether the snapshot may be used.
+
+        :returns: True if the snapshot has been loaded and is not
+                  older than the maximum age, False otherwise.
+        """
+
+        return (self.loaded is not None and
+                time.time() - self.loaded <= self.max_age)
+
+    def get(self, key):
+        """
+        Retrieve the value of a key from the snapshot.
+
+        :param key: The key to retrieve.
+
+        :returns: The value of the key, or None.
+        """
+
+        return self.mappings.get(key)
+
+    def mget(self, keys):
+        """
+        Retrieve the values of several keys from the snapshot.
+
+        :param keys: A list of the keys to retrieve.
+
+        :returns: A list of the values of the keys.
+        """
+
+        mappings = self.mappings
+        return [mappings.get(key) for key in keys]
+
+    def stats(self):
+        """
+        Report statistics about the snapshot.
+
+        :returns: A dictionary containing the keys "size" and "age".
+                  The age will be None if the snapshot has not been
+                  loaded.
+        """
+
+        return {
+            'size': len(self.mappings),
+            'age': (None if self.loaded is None else
+                    time.time() - self.loaded),
+        }
+
+
+# The layout of the shared group mapping file: a header giving the
+# number of mappings and the time the file was written, an index of
+# the offsets of the mapping records, sorted by key, and the records
+# themselves, each being the lengths of the key and value followed by
+# the key and value
+_SHARED_MAGIC = 'RSGM'
+_SHARED_VERSION = 1
+_shared_header = struct.Struct('>4sHId')
+_shared_index = struct.Struct('>I')
+_shared_record = struct.Struct('>HH')
+
+
+def _write_mapping_file(path, mappings):
+    """
+    Write group mappings to a shared group mapping file.  The file is
+    replaced atomically, so readers always see a complete file.
+
+    :param path: The name of the file.
+    :param mappings: A dictionary mapping the "rs-group:<group>" keys
+                     to the rate-limit classes.
+    """
+
+    items = sorted(mappings.items())
+    offset = _shared_header.size + _shared_index.size * len(items)
+    index = []
+    records = []
+    for key, value in items:
+        index.append(_shared_index.pack(offset))
+        record = _shared_record.pack(len(key), len(value)) + key + value
+        records.append(record)
+        offset += len(record)
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_shared_header.pack(_SHARED_MAGIC, _SHARED_VERSION,
+                                    len(items), time.time()))
+        f.write(''.join(index))
+        f.write(''.join(records))
+    os.rename(tmp, path)
+
+
+class SharedSnapshot(MappingSnapshot):
+    """
+    A copy of all the group mappings, kept in a file which is mapped
+    into the memory of every worker process on a host.  One process
+    at a time--whichever holds a lock on the file--loads the mappings
+    from the database and rewrites the file; the others only read it.
+    Lookups search the file in place, so each worker shares the same
+    pages of memory.
+    """
+
+    def __init__(self, path, db=None, interval=300.0, max_age=900.0,
+                 batch=1000, check=1.0):
+        """
+        Initialize the SharedSnapshot.
+
+        :param path: The name of the shared group mapping file.
+        :param db: The database handle.  If not provided, this process
+                   will never write the file.
+        :param interval: The number of seconds between reloads of the
+                         file from the database.
+        :param max_age: The maximum age of the file, in seconds.  A
+                        file older than this is no longer considered
+                        fresh.
+        :param batch: The number of keys to request from the database
+                      at a time when loading the mappings.
+        :param check: The number of seconds between checks for a
+                      replacement file.
+        """
+
+        super(SharedSnapshot, self).__init__(db, interval, max_age, batch)
+
+        self.path = path
+        self.check = check
+
+        self.lock = None
+        self.ident = None
+        self.checked = None
+
+        # The memory map of the file, the number of mappings in it,
+        # and the time it was written; replaced as a unit, so that
+        # other threads never see a mixture of two files
+        self.view = None
+
+    def start(self):
+        """
+        Start the loading thread, if this process may write the file.
+        """
+
+        if self.db is not None:
+            eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Reload the file forever, whenever this process holds the lock
+        on it.
+        """
+
+        while True:
+            try:
+                if self.acquire():
+                    self.load()
+            except Exception:
+                LOG.exception("Failure loading shared group mappings")
+
+            eventlet.sleep(self.interval)
+
+    def acquire(self):
+        """
+        Attempt to become the process which writes the file.
+
+        :returns: True if this process holds the lock on the file,
+                  False otherwise.
+        """
+
+        if self.lock is None:
+            lock = open(self.path + '.lock', 'a')
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                lock.close()
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            self.lock = lock
+
+        return True
+
+    def load(self):
+        """
+        Load the mappings from the database and rewrite the file.
+        """
+
+        super(SharedSnapshot, self).load()
+        _write_mapping_file(self.path, self.mappings)
+
+    def update(self, group):
+        """
+        Update the mapping for a single group from the database and
+        rewrite the file.  Does nothing unless this process writes
+        the file.
+
+        :param group: The name of the group.
+        """
+
+        # Before the first load completes, only a load in progress
+        # needs to know about the change
+        if self.lock is not None and (self.loaded is not None or
+                                      self.pending is not None):
+            super(SharedSnapshot, self).update(group)
+            if self.loaded is not None:
+                _write_mapping_file(self.path, self.mappings)
+
+    def invalidate(self, group=None):
+        """
+        Apply an announced change to the group mappings.  This allows
+        a MappingListener to keep the file up to date in a process
+        which has no PreprocessState, such as the group_share tool.
+
+        :param group: The name of the group whose mapping changed.  If
+                      not provided, the whole file is reloaded, if it
+                      has been loaded before.
+        """
+
+        if group is not None:
+            self.update(group)
+        elif self.loaded is not None and self.acquire():
+            self.load()
+
+    def _open(self):
+        """
+        Retrieve the memory map of the file, mapping it again if the
+        file has been replaced.
+
+        :returns: A tuple of the memory map, the number of mappings in
+                  the file, and the time the file was written, or None
+                  if the file is not available.
+        """
+
+        now = time.time()
+        if (self.view is not None and self.checked is not None and
+                now - self.checked < self.check):
+            return self.view
+        self.checked = now
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return self.view
+        ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        if ident == self.ident:
+            return self.view
+
+        try:
+            with open(self.path, 'rb') as f:
+                map_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, written = _shared_header.unpack_from(map_)
+            if magic != _SHARED_MAGIC or version != _SHARED_VERSION:
+                raise ValueError("bad header")
+        except (EnvironmentError, ValueError, struct.error) as exc:
+            LOG.warning("Unable to map shared group mapping file %s: %s" %
+                        (self.path, exc))
+            return self.view
+
+        # The old map is left for the garbage collector, since other
+        # threads may still be searching it
+        self.view = (map_, count, written)
+        self.ident = ident
+        return self.view
+
+    def fresh(self):
+        """
+        Determine whether the file may be used.
+
+        :returns: True if the file has been mapped and is not older
+                  than the maximum age, False otherwise.
+        """
+
+        view = self._open()
+        return view is not None and time.time() - view[2] <= self.max_age
+
+    def _find(self, map_, count, key):
+        """
+        Search the file for a key.
+
+        :param map_: The memory map of the file.
+        :param count: The number of mappings in the file.
+        :param key: The key to search for.
+
+        :returns: The value of the key, or None.
+        """
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, = _shared_index.unpack_from(
+                map_, _shared_header.size + _shared_index.size * mid)
+            key_len, value_len = _shared_record.unpack_from(map_, offset)
+            start = offset + _shared_record.size
+            probe = map_[start:start + key_len]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                start += key_len
+                return map_[start:start + value_len]
+
+        return None
+
+    def get(self, key):
+        """
+        Retrieve the value of a key from the file.
+
+        :param key: The key to retrieve.
+
+        :returns: The value of the key, or None.
+        """
+
+        view = self._open()
+        if view is None:
+            return None
+        return self._find(view[0], view[1], key)
+
+    def mget(self, keys):
+        """
+        Retrieve the values of several keys from the file.
+
+        :param keys: A list of the keys to retrieve.
+
+        :returns: A list of the values of the keys.
+        """
+
+        view = self._open()
+        if view is None:
+            return [None] * len(keys)
+        map_, count, _written = view
+        return [self._find(map_, count, key) for key in keys]
+
+    def stats(self):
+        """
+        Report statistics about the file.
+
+        :returns: A dictionary containing the keys "size" and "age".
+                  The age will be None if the file has not been
+                  mapped.
+        """
+
+        view = self._open()
+        if view is None:
+            return dict(size=0, age=None)
+        return dict(size=view[1], age=time.time() - view[2])
+
+
+class BloomFilter(object):
+    """
+    A compact, probabilistic set of strings.  Membership tests may
+    return false positives, at roughly the configured rate, but never
+    false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Initialize the BloomFilter.
+
+        :param capacity: The number of strings expected to be added.
+        :param error_rate: The desired rate of false positives when
+                           the filter holds that many strings.
+        """
+
+        capacity = max(capacity, 1)
+        self.bits = max(int(math.ceil(-capacity * math.log(error_rate) /
+                                      math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(float(self.bits) / capacity *
+                                    math.log(2))), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def _indexes(self, item):
+        """
+        Compute the bit indexes for a string, using double hashing.
+
+        :param item: The string.
+
+        :returns: A list of bit indexes.
+        """
+
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        hash1, hash2 = struct.unpack('>QQ', hashlib.md5(item).digest())
+        return [(hash1 + i * hash2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        """
+        Add a string to the filter.
+
+        :param item: The string.
+        """
+
+        for idx in self._indexes(item):
+            self.array[idx >> 3] |= 1 << (idx & 7)
+
+    def __contains__(self, item):
+        """
+        Test whether a string may have been added to the filter.
+
+        :param item: The string.
+
+        :returns: False if the string was definitely not added, True
+                  otherwise.
+        """
+
+        for idx in self._indexes(item):
+            if not self.array[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+
+# The structures which may be used to hold the names of mapped groups;
+# each is called with the expected number of names and the desired
+# false positive rate
+_filter_types = {
+    'set': lambda capacity, error_rate: set(),
+    'bloom': BloomFilter,
+}
+
+
+class GroupFilter(object):
+    """
+    The names of all the groups which have mappings, so that groups
+    which cannot have a mapping need not be looked up.  The filter is
+    built by a daemon thread, which periodically rebuilds it; groups
+    are also added as changes to their mappings are announced.
+    """
+
+    def __init__(self, db, kind='set', interval=300.0, error_rate=0.001,
+                 batch=1000):
+        """
+        Initialize the GroupFilter.
+
+        :param db: The database handle.
+        :param kind: The structure used to hold the group names;
+                     either "set" or "bloom".
+        :param interval: The number of seconds between rebuilds of the
+                         filter.
+        :param error_rate: The desired rate of false positives, for
+                           the "bloom" structure.
+        :param batch: The number of keys to request from the database
+                      at a time when building the filter.
+        """
+
+        self.db = db
+        self.factory = _filter_types[kind]
+        self.interval = interval
+        self.error_rate = error_rate
+        self.batch = batch
+
+        self.members = None
+        self.count = 0
+        self.pending = None
+
+    def start(self):
+        """
+        Start the building thread.
+        """
+
+        eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Rebuild the filter forever.
+        """
+
+        while True:
+            try:
+                self.load()
+            except Exception:
+                LOG.exception("Failure building mapped group filter")
+
+            eventlet.sleep(self.interval)
+
+    def load(self):
+        """
+        Build the filter from the database.  The keys are enumerated
+        using SCAN, so that the database is not blocked.
+        """
+
+        # Changes announced while the filter is being built must be
+        # applied to the new filter
+        self.pending = []
+        try:
+            groups = [key[len('rs-group:'):] for key in
+                      self.db.scan_iter(match='rs-group:*',
+                                        count=self.batch)]
+            # Leave room for groups added before the next rebuild
+            members = self.factory(2 * len(groups) + 1000, self.error_rate)
+            for group in groups + self.pending:
+                members.add(group)
+        finally:
+            self.pending = None
+
+        self.members = members
+        self.count = len(groups)
+
+    def update(self, group):
+        """
+        Add a group whose mapping has changed.  A group whose mapping
+        was deleted remains in the filter until it is rebuilt, which
+        is harmless.
+
+        :param group: The name of the group.
+        """
+
+        if self.pending is not None:
+            self.pending.append(group)
+        if self.members is not None:
+            self.members.add(group)
+
+    def filter(self, groups):
+        """
+        Select the groups which may have mappings.
+
+        :param groups: A list of group names.
+
+        :returns: A list of those group names which may have mappings,
+                  in the same order.  If the filter has not been
+                  built, all the group names are returned.
+        """
+
+        members = self.members
+        if members is None:
+            return groups
+        return [group for group in groups if group in members]
+
+
+class MappingListener(object):
+    """
+    A daemon thread which listens for announcements of changes to the
+    group mappings and invalidates the affected cache entries.
+    """
+
+    def __init__(self, state, db, channel=GROUP_CHANNEL, retry=5.0):
+        """
+        Initialize the MappingListener.
+
+        :param state: The PreprocessState whose caches are to be
+                      invalidated, or any other object with a
+                      compatible invalidate() method.
+        :param db: The database handle.
+        :param channel: The channel to subscribe to.
+        :param retry: The number of seconds to wait before
+                      resubscribing if the subscription fails.
+        """
+
+        self.state = state
+        self.db = db
+        self.channel = channel
+        self.retry = retry
+
+        # Sent once the first subscription has been made and the
+        # caches flushed
+        self.subscribed = event.Event()
+
+    def start(self):
+        """
+        Start the listening thread.
+        """
+
+        eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Listen for announcements forever, resubscribing if the
+        subscription fails.
+        """
+
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                LOG.exception("Failure listening for group mapping changes")
+
+            eventlet.sleep(self.retry)
+
+    def listen(self):
+        """
+        Subscribe to the channel and process announcements.  Each
+        announcement consists of the name of the group whose mapping
+        changed.
+        """
+
+        pubsub = self.db.pubsub()
+        pubsub.subscribe(self.channel)
+
+        # Changes may have been made while we weren't listening
+        self.state.invalidate()
+        if not self.subscribed.ready():
+            self.subscribed.send()
+
+        for msg in pubsub.listen():
+            if msg['type'] == 'message' and msg['channel'] == self.channel:
+                self.state.invalidate(msg['data'])
+
+
+class PriorityWatcher(object):
+    """
+    A daemon thread which watches the group priorities stored in the
+    database.  Only the version counter is checked on each pass; the
+    priorities are retrieved and compiled only when it changes.
+    """
+
+    def __init__(self, db, interval=30.0):
+        """
+        Initialize the PriorityWatcher.
+
+        :param db: The database handle.
+        :param interval: The number of seconds between checks of the
+                         version counter.
+        """
+
+        self.db = db
+        self.interval = interval
+
+        self.version = None
+        self.prios = None
+
+    def start(self):
+        """
+        Start the watching thread.
+        """
+
+        eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Check the version of the group priorities forever.
+        """
+
+        while True:
+            try:
+                self.check()
+            except Exception:
+                LOG.exception("Failure checking the group priorities")
+
+            eventlet.sleep(self.interval)
+
+    def check(self):
+        """
+        Check the version of the group priorities, recompiling them if
+        it has changed.
+
+        :returns: A True value if the group priorities were
+                  recompiled.
+        """
+
+        if self.db.hget(PRIORITIES_KEY, 'version') == self.version:
+            return False
+
+        conf_value, version = self.db.hmget(PRIORITIES_KEY,
+                                            ['groups', 'version'])
+
+        # Compile the priorities before replacing the old ones, so
+        # requests never see a partially built table
+        self.prios = (None if conf_value is None else
+                      GroupPriorities(conf_value))
+        self.version = version
+
+        LOG.info("Loaded version %s of the group priorities: %r" %
+                 (version, conf_value))
+        return True
+
+    def get_prio_conf(self, conf_value):
+        """
+        Select the group priorities to use.
+
+        :param conf_value: The value of the rs_limits.groups
+                           configuration option.
+
+        :returns: The group priorities stored in the database, if
+                  any; otherwise, the configuration value.
+        """
+
+        prios = self.prios
+        return conf_value if prios is None else prios.conf_value
+
+
+class ResolutionTable(object):
+    """
+    A daemon thread which loads the rate-limit classes precomputed by
+    group_table for common combinations of groups.  The table is only
+    reloaded when its version changes, and is disregarded once the
+    group mappings have been changed since it was computed.
+    """
+
+    def __init__(self, db, interval=300.0):
+        """
+        Initialize the ResolutionTable.
+
+        :param db: The database handle.
+        :param interval: The number of seconds between checks of the
+                         version of the table.
+        """
+
+        self.db = db
+        self.interval = interval
+
+        self.version = None
+        self.entries = None
+
+    def start(self):
+        """
+        Start the loading thread.
+        """
+
+        eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Check the version of the table forever.
+        """
+
+        while True:
+            try:
+                self.check()
+            except Exception:
+                LOG.exception("Failure loading the resolution table")
+
+            eventlet.sleep(self.interval)
+
+    def check(self):
+        """
+        Check the version of the table, reloading it if it has
+        changed.
+
+        :returns: A True value if the table was reloaded.
+        """
+
+        version, epoch = self.db.hmget(TABLE_INFO_KEY, ['version', 'epoch'])
+        if version is None or epoch != (self.db.get(EPOCH_KEY) or '0'):
+            # The table is missing, or the mappings have changed since
+            # it was computed
+            if self.entries is not None:
+                LOG.info("Disregarding the out of date resolution table")
+            self.version = None
+            self.entries = None
+            return False
+        elif version == self.version:
+            return False
+
+        self.entries = dict((tuple(field.split(',')), klass or None)
+                            for field, klass in
+                            self.db.hgetall(TABLE_KEY).items())
+        self.version = version
+
+        LOG.info("Loaded version %s of the resolution table: %d entries" %
+                 (version, len(self.entries)))
+        return True
+
+    def lookup(self, groups):
+        """
+        Look up the precomputed rate-limit class for a list of groups.
+
+        :param groups: A list of group names, in priority order.
+
+        :returns: The rate-limit class, None if none of the groups are
+                  mapped to one, or _unresolved if the class was not
+                  precomputed for this list of groups.
+        """
+
+        entries = self.entries
+        if entries is None:
+            return _unresolved
+
+        return entries.get(tuple(groups), _unresolved)
+
+    def invalidate(self, group):
+        """
+        Discard the entries affected by a change to a group mapping.
+
+        :param group: The name of the group whose mapping changed.
+        """
+
+        entries = self.entries
+        if entries is not None:
+            self.entries = dict((groups, klass)
+                                for groups, klass in entries.items()
+                                if group not in groups)
+
+
+class CircuitBreaker(object):
+    """
+    Track the health of group mapping lookups.  The breaker is tripped
+    after a number of consecutive slow or failed lookups; while it is
+    open, lookups should not be attempted.  Once the reset interval
+    has elapsed, a single trial lookup is permitted; if it succeeds,
+    the breaker is closed again, and if it fails, the breaker is
+    re-opened.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset=30.0):
+        """
+        Initialize the CircuitBreaker.
+
+        :param threshold: The number of consecutive failures which
+                          trip the breaker.
+        :param reset: The number of seconds the breaker remains open
+                      before a trial lookup is permitted.
+        """
+
+        self.threshold = threshold
+        self.reset = reset
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self.trips = 0
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Determine whether a lookup may be attempted.
+
+        :returns: A True value if the lookup may be attempted, False
+                  if the caller should fall back instead.
+        """
+
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            elif (self.state == self.OPEN and
+                  time.time() - self.opened >= self.reset):
+                # Permit a single trial lookup
+                self.state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def success(self):
+        """
+        Record a successful lookup.
+        """
+
+        with self.lock:
+            if self.state != self.CLOSED:
+                LOG.info("Group mapping lookups have recovered; closing "
+                         "circuit breaker")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        """
+        Record a slow or failed lookup.
+
+        :returns: A True value if this failure tripped the breaker.
+        """
+
+        with self.lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self.threshold)):
+                LOG.warning("Group mapping lookups are failing; opening "
+                            "circuit breaker for %s seconds" % self.reset)
+                self.state = self.OPEN
+                self.opened = time.time()
+                self.trips += 1
+                return True
+
+            return False
+
+    def fallback(self):
+        """
+        Record the use of a fallback rate-limit class.
+        """
+
+        with self.lock:
+            self.fallbacks += 1
+
+    def stats(self):
+        """
+        Report on the state of the breaker.
+
+        :returns: A dictionary containing the state of the breaker
+                  ("closed", "open", or "half-open"), the number of
+                  consecutive failures, the number of times the
+                  breaker has tripped, and the number of fallbacks.
+        """
+
+        with self.lock:
+            return dict(state=self.state, failures=self.failures,
+                        trips=self.trips, fallbacks=self.fallbacks)
+
+
+class _Flight(object):
+    """
+    A call in progress on behalf of a SingleFlight, awaited by other
+    callers.  Callers waiting for its result block on an eventlet
+    event if the first of them is a green thread, or on a threading
+    event otherwise.
+    """
+
+    def __init__(self):
+        """
+        Initialize the _Flight.
+        """
+
+        self.result = None
+        self.exc_info = None
+
+        # Green threads have a parent greenlet; native threads don't
+        if eventlet.getcurrent().parent is not None:
+            self.event = event.Event()
+            self.green = True
+        else:
+            self.event = threading.Event()
+            self.green = False
+
+    def finish(self, result=None, exc_info=None):
+        """
+        Record the outcome of the call and wake up the waiters.
+
+        :param result: The result of the call.
+        :param exc_info: The exception information, if the call
+                         raised an exception.
+        """
+
+        self.result = result
+        self.exc_info = exc_info
+        if self.green:
+            self.event.send()
+        else:
+            self.event.set()
+
+    def wait(self):
+        """
+        Wait for the outcome of the call.
+
+        :returns: The result of the call.
+        """
+
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key, so that only one of
+    them does the work and the others wait for its result.  Works
+    with both native threads and green threads.  A _Flight is only
+    created once a second caller arrives, so that uncontended calls
+    stay cheap.
+    """
+
+    def __init__(self):
+        """
+        Initialize the SingleFlight.
+        """
+
+        self.flights = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call a function, unless a call for the same key is already in
+        progress, in which case its result is awaited instead.  If
+        the call in progress raises an exception, the same exception
+        is raised in all the waiting callers.
+
+        :param key: The key identifying the call.
+        :param func: The function to call.
+
+        Any additional positional or keyword arguments are passed to
+        the function.
+
+        :returns: A tuple of the result and a flag which is True if
+                  the result was shared from another caller's call.
+        """
+
+        with self.lock:
+            if key not in self.flights:
+                # Nobody is waiting yet
+                self.flights[key] = None
+                flight = None
+            else:
+                flight = self.flights[key]
+                if flight is None:
+                    flight = self.flights[key] = _Flight()
+                self.coalesced += 1
+
+        if flight is not None:
+            return flight.wait(), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            # Even a timeout must not leave the waiters stranded
+            exc_info = sys.exc_info()
+            with self.lock:
+                flight = self.flights.pop(key)
+            if flight is not None:
+                flight.finish(exc_info=exc_info)
+            raise
+
+        with self.lock:
+            flight = self.flights.pop(key)
+        if flight is not None:
+            flight.finish(result)
+
+        return result, False
+
+
+class MemoryMetrics(object):
+    """
+    A metrics sink which aggregates the metrics in memory.  Counters
+    are summed, and the distribution of each timing or observed value
+    is recorded as a histogram.
+    """
+
+    # The upper bounds of the histogram buckets; timings are recorded
+    # in milliseconds
+    bounds = (0, 0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, rs_conf=None):
+        """
+        Initialize the MemoryMetrics.
+
+        :param rs_conf: The "rs_limits" section of the configuration.
+                        Not used.
+        """
+
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.distributions = {}
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param value: The amount to increment the counter by.
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Record an observed value.
+
+        :param name: The name of the distribution.
+        :param value: The value observed.
+        """
+
+        with self._lock:
+            dist = self.distributions.get(name)
+            if dist is None:
+                dist = self.distributions[name] = {
+                    'count': 0,
+                    'sum': 0,
+                    'min': value,
+                    'max': value,
+                    'buckets': [0] * (len(self.bounds) + 1),
+                }
+
+            dist['count'] += 1
+            dist['sum'] += value
+            dist['min'] = min(dist['min'], value)
+            dist['max'] = max(dist['max'], value)
+            dist['buckets'][bisect.bisect_left(self.bounds, value)] += 1
+
+    def timing(self, name, seconds):
+        """
+        Record a timing.
+
+        :param name: The name of the distribution.
+        :param seconds: The time taken, in seconds.
+        """
+
+        self.observe(name, seconds * 1000.0)
+
+    def stats(self):
+        """
+        Report the aggregated metrics.
+
+        :returns: A dictionary containing "counters", a dictionary of
+                  the counters, and "distributions", a dictionary of
+                  the distributions.  Each distribution is a
+                  dictionary containing the "count", "sum", "min", and
+                  "max" of the values, along with "buckets", a list of
+                  tuples of the upper bound of each histogram bucket
+                  and the number of values in it; the upper bound of
+                  the last bucket is None.
+        """
+
+        with self._lock:
+            distributions = {}
+            for name, dist in self.distributions.items():
+                dist = dict(dist)
+                dist['buckets'] = zip(self.bounds + (None,),
+                                      dist['buckets'])
+                distributions[name] = dist
+
+            return {
+                'counters': dict(self.counters),
+                'distributions': distributions,
+            }
+
+
+class StatsdMetrics(object):
+    """
+    A metrics sink which emits the metrics to a statsd server over
+    UDP.  Errors sending the metrics are ignored.
+    """
+
+    def __init__(self, rs_conf=None):
+        """
+        Initialize the StatsdMetrics.
+
+        :param rs_conf: The "rs_limits" section of the configuration.
+                        The "statsd_host" and "statsd_port" options
+                        give the address of the statsd server
+                        (localhost, port 8125, by default), and the
+                        "statsd_prefix" option gives the prefix for the
+                        metric names ("rs_limits" by default).
+        """
+
+        rs_conf = rs_conf or {}
+
+        self.address = (rs_conf.get('statsd_host', 'localhost'),
+                        int(rs_conf.get('statsd_port', 8125)))
+        self.prefix = rs_conf.get('statsd_prefix', 'rs_limits')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind):
+        """
+        Send a metric to the statsd server.
+
+        :param name: The name of the metric.
+        :param value: The value of the metric.
+        :param kind: The statsd type of the metric.
+        """
+
+        try:
+            self.sock.sendto('%s.%s:%s|%s' % (self.prefix, name, value, kind),
+                             self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param value: The amount to increment the counter by.
+        """
+
+        self._send(name, value, 'c')
+
+    def observe(self, name, value):
+        """
+        Record an observed value.
+
+        :param name: The name of the distribution.
+        :param value: The value observed.
+        """
+
+        self._send(name, value, 'h')
+
+    def timing(self, name, seconds):
+        """
+        Record a timing.
+
+        :param name: The name of the distribution.
+        :param seconds: The time taken, in seconds.
+        """
+
+        self._send(name, '%.3f' % (seconds * 1000.0), 'ms')
+
+
+# Recognized values for the rs_limits.metrics configuration option;
+# other values name an entrypoint in the "rs_limits.metrics" group, or
+# a "module:class" specification
+_metrics_sinks = {
+    'memory': MemoryMetrics,
+    'statsd': StatsdMetrics,
+}
+
+
+class InstrumentedDatabase(DatabaseWrapper):
+    """
+    Wrap a database handle so that the number and duration of the
+    commands used to look up the group mappings are recorded.
+    """
+
+    # The commands to instrument
+    commands = set(['get', 'mget', 'hget', 'hmget', 'evalsha',
+                    'script_load'])
+
+    def __init__(self, db, metrics):
+        """
+        Initialize the wrapper.
+
+        :param db: The database handle to wrap.
+        :param metrics: The metrics sink.
+        """
+
+        super(InstrumentedDatabase, self).__init__(db)
+        self.metrics = metrics
+        self.lookups = 0
+
+    def __getattr__(self, name):
+        """
+        Pass all other attribute accesses through to the database,
+        instrumenting the interesting commands.
+        """
+
+        method = getattr(self.db, name)
+        if name not in self.commands:
+            return method
+
+        def instrumented(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.lookups += 1
+                self.metrics.timing('redis.%s' % name, time.time() - start)
+
+        return instrumented
+
+    def first_match(self, keys):
+        """
+        Find the first of several keys which has a value.  The Lua
+        script is run through this wrapper, so that it is
+        instrumented.
+
+        :param keys: A list of the keys to check, in order.
+
+        :returns: A tuple of the index of the first key with a value
+                  and that value.  If no key has a value, returns
+                  (None, None).
+        """
+
+        return _script_first_match(self, keys)
+
+
+class _Stages(object):
+    """
+    Time the stages of a profiled call.  Each stage is timed from the
+    end of the previous one.
+    """
+
+    def __init__(self):
+        """
+        Initialize the _Stages.
+        """
+
+        self.times = []
+        self.last = time.time()
+
+    def mark(self, stage):
+        """
+        Mark the end of a stage.
+
+        :param stage: The name of the stage.
+        """
+
+        now = time.time()
+        self.times.append((stage, now - self.last))
+        self.last = now
+
+
+class Profiler(object):
+    """
+    Profile a sample of the calls to rs_preprocess().  Either the
+    stages of each sampled call are timed, or the call is run under
+    cProfile; the results are aggregated in memory and periodically
+    written to a file.
+    """
+
+    def __init__(self, rate=1000, path=None, interval=60.0, cprofile=False):
+        """
+        Initialize the Profiler.
+
+        :param rate: Profile one in this many calls.
+        :param path: The name of the file to write the results to.  If
+                     None, the results are only kept in memory.
+        :param interval: The number of seconds between writes of the
+                         results.
+        :param cprofile: If True, the sampled calls are run under
+                         cProfile, and the results are written in the
+                         pstats format.  Otherwise, the stages of each
+                         sampled call are timed, and a summary of them
+                         is written.
+        """
+
+        self.rate = rate
+        self.path = path
+        self.interval = interval
+        self.cprofile = cprofile
+
+        self.calls = 0
+        self.samples = 0
+        self.stages = {}
+        self.stats = None
+        self.active = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the thread writing the results, if they are to be
+        written to a file.
+        """
+
+        if self.path:
+            eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Write the results periodically, forever.
+        """
+
+        while True:
+            eventlet.sleep(self.interval)
+
+            try:
+                self.dump()
+            except Exception:
+                LOG.exception("Failure writing the profile to %r" %
+                              self.path)
+
+    def sample(self):
+        """
+        Count a call, and determine whether it is to be profiled.
+        This is cheap, since it is called for every request.
+
+        :returns: A True value if the call is to be profiled.
+        """
+
+        self.calls += 1
+        return self.calls % self.rate == 0
+
+    def profile(self, func, *args):
+        """
+        Profile a call.
+
+        :param func: The function to call.  Unless cProfile is being
+                     used, it must accept a "stages" keyword argument,
+                     and mark the end of each stage on it.
+        :param args: The positional arguments for the function.
+
+        :returns: The result of the function.
+        """
+
+        if not self.cprofile:
+            stages = _Stages()
+            try:
+                return func(*args, stages=stages)
+            finally:
+                self.record(stages.times)
+
+        # Only one profiler may be active at a time; any calls
+        # interleaved with this one go unprofiled
+        with self.lock:
+            if self.active:
+                return func(*args)
+            self.active = True
+
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(func, *args)
+        finally:
+            with self.lock:
+                self.active = False
+                self.samples += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(prof)
+                else:
+                    self.stats.add(prof)
+
+    def record(self, times):
+        """
+        Record the stage times of a sampled call.
+
+        :param times: A list of tuples of the name of the stage and
+                      its duration in seconds.
+        """
+
+        with self.lock:
+            self.samples += 1
+            for stage, elapsed in times:
+                entry = self.stages.get(stage)
+                if entry is None:
+                    self.stages[stage] = [1, elapsed, elapsed]
+                else:
+                    entry[0] += 1
+                    entry[1] += elapsed
+                    entry[2] = max(entry[2], elapsed)
+
+    def summary(self):
+        """
+        Summarize the stage times.
+
+        :returns: A string summarizing the stage times, with one line
+                  per stage, ordered by the total time spent in it.
+        """
+
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda x: x[1][1],
+                            reverse=True)
+            lines = [
+                "rs_preprocess() profile: %d of %d calls sampled" %
+                (self.samples, self.calls),
+                "%-14s %8s %12s %10s %10s" %
+                ('stage', 'calls', 'total (ms)', 'mean (us)', 'max (us)'),
+            ]
+            for stage, (count, total, maximum) in stages:
+                lines.append("%-14s %8d %12.3f %10.1f %10.1f" %
+                             (stage, count, total * 1000,
+                              total / count * 1000000, maximum * 1000000))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        """
+        Write the results to the file.  The file is replaced
+        atomically, so readers never see a partial write.
+        """
+
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        if self.cprofile:
+            with self.lock:
+                if self.stats is None:
+                    return
+                self.stats.dump_stats(tmp_path)
+        else:
+            with open(tmp_path, 'w') as f:
+                f.write(self.summary())
+        os.rename(tmp_path, self.path)
+
+
+class ReplicaDatabase(DatabaseWrapper):
+    """
+    Wrap a database handle so that the commands used to read the group
+    mappings are sent to a read replica instead.  If the replica
+    fails, the commands are sent to the primary database until the
+    replica has had time to recover.  All other commands, including
+    writes, go to the primary database.
+    """
+
+    # The commands to send to the replica
+    commands = set(['get', 'mget', 'hget', 'hmget', 'evalsha',
+                    'script_load'])
+
+    # The commands to send to the replica which return iterators
+    iter_commands = set(['scan_iter', 'hscan_iter'])
+
+    # The errors indicating that the replica has failed
+    errors = (redis.exceptions.ConnectionError,
+              redis.exceptions.TimeoutError)
+
+    def __init__(self, db, replica, retry=30.0):
+        """
+        Initialize the wrapper.
+
+        :param db: The handle for the primary database.
+        :param replica: The handle for the read replica.
+        :param retry: The number of seconds to wait after the replica
+                      fails before sending commands to it again.
+        """
+
+        super(ReplicaDatabase, self).__init__(db)
+        self.replica = replica
+        self.retry = retry
+        self.failed = None
+
+    def _available(self):
+        """
+        Determine whether commands may be sent to the replica.
+
+        :returns: True if the replica has not failed recently, False
+                  otherwise.
+        """
+
+        return self.failed is None or time.time() - self.failed >= self.retry
+
+    def _fail(self, exc):
+        """
+        Record the failure of the replica.
+
+        :param exc: The exception raised by the replica.
+        """
+
+        LOG.warning("Read replica failed; using primary database for "
+                    "%s seconds: %s" % (self.retry, exc))
+        self.failed = time.time()
+
+    def _recover(self):
+        """
+        Record the success of the replica.
+        """
+
+        if self.failed is not None:
+            LOG.info("Read replica has recovered")
+            self.failed = None
+
+    def __getattr__(self, name):
+        """
+        Pass all other attribute accesses through to the primary
+        database, routing the commands which read the group mappings
+        to the replica.
+        """
+
+        method = getattr(self.db, name)
+        if name in self.iter_commands:
+            return lambda *args, **kwargs: self._iter(name, method, args,
+                                                      kwargs)
+        elif name not in self.commands:
+            return method
+
+        def routed(*args, **kwargs):
+            if self._available():
+                try:
+                    result = getattr(self.replica, name)(*args, **kwargs)
+                except self.errors as exc:
+                    self._fail(exc)
+                else:
+                    self._recover()
+                    return result
+
+            return method(*args, **kwargs)
+
+        return routed
+
+    def _iter(self, name, method, args, kwargs):
+        """
+        Iterate over the results of a command which returns an
+        iterator, using the replica if possible.  If the replica fails
+        before producing any results, the primary database is used;
+        if it fails later, the error is raised.
+
+        :param name: The name of the command.
+        :param method: The command on the primary database.
+        :param args: The positional arguments for the command.
+        :param kwargs: The keyword arguments for the command.
+        """
+
+        if self._available():
+            started = False
+            try:
+                for item in getattr(self.replica, name)(*args, **kwargs):
+                    started = True
+                    yield item
+            except self.errors as exc:
+                self._fail(exc)
+                if started:
+                    raise
+            else:
+                self._recover()
+                return
+
+        for item in method(*args, **kwargs):
+            yield item
+
+    def first_match(self, keys):
+        """
+        Find the first of several keys which has a value.  The Lua
+        script is run through this wrapper, so that it is sent to the
+        replica.
+
+        :param keys: A list of the keys to check, in order.
+
+        :returns: A tuple of the index of the first key with a value
+                  and that value.  If no key has a value, returns
+                  (None, None).
+        """
+
+        return _script_first_match(self, keys)
+
+
+class HeaderWarmer(object):
+    """
+    Track the most frequently resolved X-PP-Groups header values, and
+    periodically save them, either to a local file or to a list in the
+    database.  When the middleware starts, the saved header values
+    are used to preload the caches, fetching all the group mappings
+    they need at once.
+    """
+
+    def __init__(self, state, db, prio_conf='', path=None, key=None,
+                 size=1000, interval=300.0, ready=None):
+        """
+        Initialize the HeaderWarmer.
+
+        :param state: The PreprocessState whose caches are to be
+                      preloaded.
+        :param db: The database handle.
+        :param prio_conf: The value of the rs_limits.groups
+                          configuration option.
+        :param path: The name of the file to save the header values
+                     in.
+        :param key: The name of the database list to save the header
+                    values in, if no file name is given.
+        :param size: The number of header values to save.
+        :param interval: The number of seconds between saves.
+        :param ready: If provided, an eventlet Event which is sent
+                      when the caches may be preloaded, such as the
+                      "subscribed" event of a MappingListener, whose
+                      first subscription flushes the caches.  The
+                      caches are preloaded regardless if it is not
+                      sent within the interval.
+        """
+
+        self.state = state
+        self.db = db
+        self.prio_conf = prio_conf
+        self.path = path
+        self.key = key
+        self.size = size
+        self.interval = interval
+        self.ready = ready
+
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the warming thread.
+        """
+
+        eventlet.spawn_n(self.run)
+
+    def run(self):
+        """
+        Preload the caches, then save the header values forever.
+        """
+
+        if self.ready is not None:
+            with eventlet.Timeout(self.interval, False):
+                self.ready.wait()
+
+        try:
+            self.warm()
+        except Exception:
+            LOG.exception("Failure preloading group mappings")
+
+        while True:
+            eventlet.sleep(self.interval)
+
+            try:
+                self.save()
+            except Exception:
+                LOG.exception("Failure saving hot X-PP-Groups headers")
+
+    def record(self, group_str):
+        """
+        Record the resolution of a header value.
+
+        :param group_str: The value of the X-PP-Groups header.
+        """
+
+        with self.lock:
+            self.counts[group_str] = self.counts.get(group_str, 0) + 1
+
+            # Bound the memory used, keeping the most frequent values;
+            # halving the counts lets newly popular values catch up
+            if len(self.counts) > 10 * self.size:
+                self.counts = dict((hdr, count // 2) for hdr, count in
+                                   self._top(self.counts, self.size))
+
+    @staticmethod
+    def _top(counts, size):
+        """
+        Select the most frequent header values.
+
+        :param counts: A dictionary mapping header values to counts.
+        :param size: The number of header values to select.
+
+        :returns: A list of tuples of the header value and its count,
+                  most frequent first.
+        """
+
+        return sorted(counts.items(), key=lambda x: x[1],
+                      reverse=True)[:size]
+
+    def hot(self):
+        """
+        Retrieve the most frequently resolved header values.
+
+        :returns: A list of header values, most frequent first.
+        """
+
+        with self.lock:
+            counts = self.counts.copy()
+        return [hdr for hdr, _count in self._top(counts, self.size)]
+
+    def save(self):
+        """
+        Save the most frequently resolved header values.
+        """
+
+        headers = self.hot()
+        if not headers:
+            return
+
+        if self.path:
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(headers, f)
+            os.rename(tmp, self.path)
+        else:
+            pipe = self.db.pipeline()
+            pipe.delete(self.key)
+            pipe.rpush(self.key, *headers)
+            pipe.execute()
+
+    def load(self):
+        """
+        Load the saved header values.
+
+        :returns: A list of header values.
+        """
+
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except IOError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                return []
+
+        return self.db.lrange(self.key, 0, -1)
+
+    def warm(self):
+        """
+        Preload the caches for the saved header values.  All the group
+        mappings needed are fetched with a single command.
+
+        :returns: The number of header values preloaded.
+        """
+
+        state = self.state
+        generation = state.generation
+        prio_conf = state.get_prio_conf(self.prio_conf)
+
+        headers = self.load()
+        parsed = [(hdr, _get_groups(state, hdr, prio_conf))
+                  for hdr in headers]
+        keys = sorted(set('rs-group:%s' % group
+                          for _hdr, groups in parsed for group in groups))
+        if not keys:
+            return 0
+
+        db = HashDatabase(self.db) if state.hash else self.db
+        mappings = dict(zip(keys, db.mget(keys)))
+
+        # Don't store anything if the mappings changed meanwhile
+        if generation != state.generation:
+            return len(headers)
+
+        if state.cache is not None:
+            for key, klass in mappings.items():
+                state.cache.store(key, klass)
+
+        for hdr, groups in parsed:
+            klass = None
+            for group in groups:
+                klass = mappings['rs-group:%s' % group]
+                if klass:
+                    break
+            if state.resolution_cache is not None:
+                state.resolution_cache.store((hdr, prio_conf), klass)
+            if state.stale is not None:
+                state.stale.store((hdr, prio_conf), klass)
+
+        return len(headers)
+
+
+class PreprocessState(object):
+    """
+    Hold the state used by rs_preprocess() which must persist between
+    requests.  One of these is associated with each middleware
+    instance.
+    """
+
+    def __init__(self, rs_conf=None, db=None, replica=None):
+        """
+        Initialize the state.
+
+        :param rs_conf: The "rs_limits" section of the configuration.
+                        The "storage" option determines how the group
+                        mappings are stored, and the "lookup" option
+                        how they are looked up.  The
+                        "priorities_reload" and "priorities_interval"
+                        options control the reloading of group
+                        priorities stored in the database.  The
+                        "resolution_table" and
+                        "resolution_table_interval" options control
+                        the use of rate-limit classes precomputed by
+                        group_table.  The "profile", "profile_rate",
+                        "profile_file", and "profile_interval" options
+                        control the profiling of a sample of the
+                        calls.  The "metrics" option selects the
+                        metrics sink.  The "header_cache_size" option
+                        controls the cache of parsed X-PP-Groups
+                        headers.  The "cache_size" and "cache_ttl"
+                        options control the group mapping cache, the
+                        "resolution_cache_size" and
+                        "resolution_cache_ttl" options the cache of
+                        resolved rate-limit classes, and the
+                        "tenant_cache_size" and "tenant_cache_ttl"
+                        options the memo of rate-limit classes
+                        resolved for each tenant.  The "snapshot",
+                        "snapshot_interval", and "snapshot_max_age"
+                        options control the group mapping snapshot,
+                        and the "shared_cache",
+                        "shared_cache_refresh",
+                        "shared_cache_interval", and
+                        "shared_cache_max_age" options a snapshot
+                        shared between processes; the "cache_listen"
+                        option controls whether these listen for
+                        changes to the mappings.  The
+                        "lookup_timeout", "breaker_threshold",
+                        "breaker_reset", and "stale_cache_size"
+                        options control the circuit breaker.  The
+                        "coalesce" option controls whether concurrent
+                        resolutions of the same header are coalesced.
+                        The "warmup_file", "warmup_key",
+                        "warmup_size", and "warmup_interval" options
+                        control the preloading of the caches.  The
+                        "group_filter", "group_filter_interval", and
+                        "group_filter_error_rate" options control the
+                        filter of mapped groups.
+        :param db: The database handle.  If not provided, no snapshot
+                   is used, and the cache will not listen for changes
+                   to the mappings.
+        :param replica: The handle for a read replica of the database.
+                        If provided, the group mappings are read from
+                        the replica, falling back to the primary
+                        database for "replica_retry" seconds whenever
+                        the replica fails.
+        """
+
+        rs_conf = rs_conf or {}
+
+        # Route the group mapping reads to the replica
+        if replica is not None and db is not None:
+            db = ReplicaDatabase(db, replica,
+                                 float(rs_conf.get('replica_retry', 30)))
+            self.replica = db
+        else:
+            self.replica = None
+
+        self.prios = None
+        self.hash = rs_conf.get('storage', 'keys') == 'hash'
+
+        # Select the lookup function; batching is free with the hash
+        lookup = rs_conf.get('lookup', 'mget' if self.hash else 'get')
+        if lookup not in _lookups:
+            raise ValueError("Unknown lookup mode %r" % lookup)
+        self.lookup = _lookups[lookup]
+
+        # Watch for group priorities stored in the database, if they
+        # are to be reloaded from there
+        if (db is not None and
+                config.Config.to_bool(rs_conf.get('priorities_reload',
+                                                  'no'))):
+            self.priorities = PriorityWatcher(
+                db, float(rs_conf.get('priorities_interval', 30)))
+            self.priorities.start()
+        else:
+            self.priorities = None
+
+        # Load the rate-limit classes precomputed for common
+        # combinations of groups, if they are to be used
+        if (db is not None and
+                config.Config.to_bool(rs_conf.get('resolution_table',
+                                                  'no'))):
+            self.table = ResolutionTable(
+                db, float(rs_conf.get('resolution_table_interval', 300)))
+            self.table.start()
+        else:
+            self.table = None
+
+        # Profile a sample of the calls, if requested
+        profile = rs_conf.get('profile')
+        if profile:
+            if profile not in ('stages', 'cprofile'):
+                raise ValueError("Unknown profile type %r" % profile)
+            self.profiler = Profiler(
+                int(rs_conf.get('profile_rate', 1000)),
+                rs_conf.get('profile_file'),
+                float(rs_conf.get('profile_interval', 60)),
+                profile == 'cprofile')
+            self.profiler.start()
+        else:
+            self.profiler = None
+
+        # Set up the metrics sink, if one is desired
+        metrics = rs_conf.get('metrics')
+        if metrics:
+            sink = (_metrics_sinks.get(metrics) or
+                    utils.find_entrypoint('rs_limits.metrics', metrics,
+                                          required=True))
+            self.metrics = sink(rs_conf)
+        else:
+            self.metrics = None
+
+        # Set up the cache of parsed X-PP-Groups headers
+        header_cache_size = int(rs_conf.get('header_cache_size', 1000))
+        if header_cache_size > 0:
+            self.header_cache = MappingCache(header_cache_size)
+        else:
+            self.header_cache = None
+        self.cache = None
+        self.snapshot = None
+        self.listener = None
+
+        # Set up the group mapping cache, if one is desired
+        cache_ttl = float(rs_conf.get('cache_ttl', 60))
+        cache_size = int(rs_conf.get('cache_size', 0))
+        if cache_size > 0:
+            self.cache = MappingCache(cache_size, cache_ttl)
+
+        # Set up the cache of resolved rate-limit classes, if one is
+        # desired.  The generation is bumped whenever the cache is
+        # invalidated, so that resolutions in progress at the time
+        # don't store stale results.
+        self.generation = 0
+        resolution_cache_size = int(rs_conf.get('resolution_cache_size', 0))
+        if resolution_cache_size > 0:
+            self.resolution_cache = MappingCache(
+                resolution_cache_size,
+                float(rs_conf.get('resolution_cache_ttl', cache_ttl)))
+        else:
+            self.resolution_cache = None
+
+        # Set up the memo of the rate-limit classes resolved for each
+        # tenant, if one is desired
+        tenant_cache_size = int(rs_conf.get('tenant_cache_size', 0))
+        if tenant_cache_size > 0:
+            self.tenant_cache = MappingCache(
+                tenant_cache_size,
+                float(rs_conf.get('tenant_cache_ttl', cache_ttl)))
+        else:
+            self.tenant_cache = None
+
+        # Set up the circuit breaker, if lookups are to be time
+        # limited, along with the last known rate-limit classes to
+        # fall back on
+        self.lookup_timeout = float(rs_conf.get('lookup_timeout', 0))
+        if self.lookup_timeout > 0:
+            self.breaker = CircuitBreaker(
+                int(rs_conf.get('breaker_threshold', 5)),
+                float(rs_conf.get('breaker_reset', 30)))
+            self.stale = MappingCache(
+                int(rs_conf.get('stale_cache_size', 1000)))
+        else:
+            self.breaker = None
+            self.stale = None
+
+        # Coalesce concurrent resolutions of the same header
+        if config.Config.to_bool(rs_conf.get('coalesce', 'yes')):
+            self.flights = SingleFlight()
+        else:
+            self.flights = None
+
+        # Set up the group mapping snapshot, if one is desired; it may
+        # be shared between the processes on a host
+        if rs_conf.get('shared_cache'):
+            interval = float(rs_conf.get('shared_cache_interval', 300))
+            refresh = (db is not None and config.Config.to_bool(
+                rs_conf.get('shared_cache_refresh', 'yes')))
+            self.snapshot = SharedSnapshot(
+                rs_conf['shared_cache'],
+                _get_storage(db, rs_conf) if refresh else None, interval,
+                float(rs_conf.get('shared_cache_max_age', 3 * interval)))
+            self.snapshot.start()
+        elif (db is not None and
+                config.Config.to_bool(rs_conf.get('snapshot', 'no'))):
+            interval = float(rs_conf.get('snapshot_interval', 300))
+            self.snapshot = MappingSnapshot(
+                _get_storage(db, rs_conf), interval,
+                float(rs_conf.get('snapshot_max_age', 3 * interval)))
+            self.snapshot.start()
+
+        # Set up the filter of mapped groups, if one is desired
+        group_filter = rs_conf.get('group_filter')
+        if db is not None and group_filter:
+            self.filter = GroupFilter(
+                _get_storage(db, rs_conf), group_filter,
+                float(rs_conf.get('group_filter_interval', 300)),
+                float(rs_conf.get('group_filter_error_rate', 0.001)))
+            self.filter.start()
+        else:
+            self.filter = None
+
+        # Keep the caches and snapshot up to date
+        if ((self.cache is not None or self.snapshot is not None or
+             self.resolution_cache is not None or
+             self.tenant_cache is not None or
+             self.table is not None or
+             self.filter is not None) and
+                db is not None and
+                config.Config.to_bool(rs_conf.get('cache_listen', 'yes'))):
+            self.listener = MappingListener(self, db)
+            self.listener.start()
+
+        # Remember the most frequent headers, to preload the caches
+        # when the middleware next starts; the listener's first
+        # subscription flushes the caches, so wait for it
+        warmup_file = rs_conf.get('warmup_file')
+        warmup_key = rs_conf.get('warmup_key')
+        if db is not None and (warmup_file or warmup_key):
+            self.warmer = HeaderWarmer(
+                self, db, rs_conf.get('groups', ''), warmup_file,
+                warmup_key, int(rs_conf.get('warmup_size', 1000)),
+                float(rs_conf.get('warmup_interval', 300)),
+                None if self.listener is None else self.listener.subscribed)
+            self.warmer.start()
+        else:
+            self.warmer = None
+
+    def invalidate(self, group=None):
+        """
+        Invalidate cached information about a group mapping.
+
+        :param group: The name of the group whose mapping changed.  If
+                      None, all cached information is invalidated.
+        """
+
+        # The snapshot, the filter, and the resolution table are
+        # rebuilt periodically, so only individual changes need to be
+        # applied to them.  Updating the snapshot may yield to other
+        # requests, so this must be done before the caches below are
+        # cleared, lest they be refilled from the old mapping
+        if self.snapshot is not None and group is not None:
+            self.snapshot.update(group)
+        if self.filter is not None and group is not None:
+            self.filter.update(group)
+        if self.table is not None and group is not None:
+            self.table.invalidate(group)
+
+        if self.cache is not None:
+            self.cache.invalidate(None if group is None else
+                                  'rs-group:%s' % group)
+
+        # Any resolved rate-limit class could be affected
+        self.generation += 1
+        if self.resolution_cache is not None:
+            self.resolution_cache.invalidate()
+        if self.tenant_cache is not None:
+            self.tenant_cache.invalidate()
+
+    def get_prio_conf(self, conf_value):
+        """
+        Select the group priorities to use.
+
+        :param conf_value: The value of the rs_limits.groups
+                           configuration option.
+
+        :returns: The group priorities stored in the database, if they
+                  are being reloaded from there and have been set;
+                  otherwise, the configuration value.
+        """
+
+        if self.priorities is None:
+            return conf_value
+
+        return self.priorities.get_prio_conf(conf_value)
+
+    def get_priorities(self, conf_value):
+        """
+        Retrieve the compiled group priorities for the given
+        configuration value.  The priorities are only rebuilt if the
+        configuration value has changed since the last call.
+
+        :param conf_value: The group priorities, as returned by
+                           get_prio_conf().
+
+        :returns: An instance of GroupPriorities.
+        """
+
+        # Priorities loaded from the database are already compiled
+        if self.priorities is not None:
+            prios = self.priorities.prios
+            if prios is not None and prios.conf_value == conf_value:
+                return prios
+
+        prios = self.prios
+        if prios is None or prios.conf_value != conf_value:
+            prios = GroupPriorities(conf_value)
+            self.prios = prios
+
+        return prios
+
+
+# Maps middleware instances to their PreprocessState
+_states = weakref.WeakKeyDictionary()
+
+
+def _get_state(midware, conf):
+    """
+    Retrieve the PreprocessState associated with a middleware,
+    creating it if necessary.
+
+    :param midware: The turnstile middleware.
+    :param conf: The turnstile configuration, used if the state must
+                 be created.
+
+    :returns: An instance of PreprocessState.
+    """
+
+    try:
+        return _states[midware]
+    except KeyError:
+        pass
+
+    # A read replica is configured using "redis."-prefixed options in
+    # the rs_limits section, as for the control daemon
+    replica = None
+    if (hasattr(conf, 'get_database') and
+            any(key.startswith('redis.') for key in conf['rs_limits'])):
+        replica = conf.get_database('rs_limits')
+
+    return _states.setdefault(midware,
+                              PreprocessState(conf['rs_limits'], midware.db,
+                                              replica))
+
+
+def _lookup_get(db, groups):
+    """
+    Look up the rate-limit class for a list of groups by issuing one
+    GET per group, stopping at the first group which is mapped.
+
+    :param db: The database handle.
+    :param groups: A list of group names, in priority order.
+
+    :returns: A tuple of the matching group name and its rate-limit
+              class.  If no group is mapped, returns (None, None).
+    """
+
+    for group in groups:
+        klass = db.get('rs-group:%s' % group)
+        if klass:
+            return group, klass
+
+    return None, None
+
+
+def _lookup_mget(db, groups):
+    """
+    Look up the rate-limit class for a list of groups by issuing a
+    single MGET for all the groups, then selecting the first group
+    which is mapped.
+
+    :param db: The database handle.
+    :param groups: A list of group names, in priority order.
+
+    :returns: A tuple of the matching group name and its rate-limit
+              class.  If no group is mapped, returns (None, None).
+    """
+
+    if not groups:
+        return None, None
+
+    klasses = db.mget(['rs-group:%s' % group for group in groups])
+    for group, klass in zip(groups, klasses):
+        if klass:
+            return group, klass
+
+    return None, None
+
+
+def _lookup_lua(db, groups):
+    """
+    Look up the rate-limit class for a list of groups by running a Lua
+    script in the database, which returns only the rate-limit class
+    of the first group which is mapped.
+
+    :param db: The database handle.
+    :param groups: A list of group names, in priority order.
+
+    :returns: A tuple of the matching group name and its rate-limit
+              class.  If no group is mapped, returns (None, None).
+    """
+
+    if not groups:
+        return None, None
+
+    idx, klass = _first_match(db, ['rs-group:%s' % group
+                                   for group in groups])
+    if idx is None:
+        return None, None
+
+    return groups[idx], klass
+
+
+# Recognized values for the rs_limits.lookup configuration option
+_lookups = {
+    'get': _lookup_get,
+    'mget': _lookup_mget,
+    'lua': _lookup_lua,
+}
+
+
+def _parse_groups(group_str, prios, metrics=None, stages=None):
+    """
+    Parse the value of the X-PP-Groups header into a list of group
+    names, in priority order.
+
+    :param group_str: The value of the X-PP-Groups header.
+    :param prios: An instance of GroupPriorities, used to prioritize
+                  the groups if all of them have a quality of 1.0.
+    :param metrics: If provided, a metrics sink used to count uses of
+                    the group priorities.
+    :param stages: If provided, a _Stages object on which to mark the
+                   end of each stage of the parsing.
+
+    :returns: A tuple of group names, highest priority first.
+    """
+
+    groups, repose = _parse_header(group_str, prios, stages)
+    if repose and metrics is not None:
+        metrics.incr('repose')
+
+    return groups
+
+
+def _parse_header(group_str, prios, stages=None):
+    """
+    Parse the value of the X-PP-Groups header into a list of group
+    names, in priority order, noting whether the group priorities
+    were needed.
+
+    :param group_str: The value of the X-PP-Groups header.
+    :param prios: An instance of GroupPriorities, used to prioritize
+                  the groups if all of them have a quality of 1.0.
+    :param stages: If provided, a _Stages object on which to mark the
+                   end of each stage of the parsing.
+
+    :returns: A tuple of a tuple of group names, highest priority
+              first, and a flag which is True if the group priorities
+              were used to work around the Repose bug.
+    """
+
+    # Split the groups string into a list of groups, respecting quality
+    groups = []
+    overall_quality = 1.0
+    for group in group_str.split(','):
+        # Strip off any whitespace, just in case
+        group = group.strip()
+
+        # Convert quality, if present
+        quality = 1.0
+        name, _sep, qual_str = group.partition(';')
+        if qual_str.startswith('q='):
+            try:
+                quality = float(qual_str[2:])
+            except ValueError:
+                # Invalid float; use 1.0
+                pass
+
+        groups.append((name, quality))
+        overall_quality *= quality
+    if stages is not None:
+        stages.mark('parse')
+
+    # If the overall quality is 1.0, that means we have the Repose
+    # group priority bug; work around it by rebuilding the groups list
+    repose = overall_quality == 1.0
+    if repose:
+        # Walk through the groups list and rebuild it
+        for idx in range(len(groups)):
+            name, quality = groups[idx]
+            groups[idx] = (name, prios[name.lower()] * quality)
+        if stages is not None:
+            stages.mark('remap')
+
+    groups = tuple(name for name, _quality in
+                   sorted(groups, key=lambda x: x[1], reverse=True))
+    if stages is not None:
+        stages.mark('sort')
+
+    return groups, repose
+
+
+# Sentinel for resolution cache misses
+_unresolved = object()
+
+
+def _set_class(environ, context, klass):
+    """
+    Set the rate-limit class for the request.
+
+    :param environ: The request environment.
+    :param context: The nova context, if it supports the quota_class
+                    attribute, or None.
+    :param klass: The rate-limit class.  If None, the environment is
+                  left alone, so that nova_preprocess() may determine
+                  the rate-limit class.
+    """
+
+    if klass:
+        # We have our rate-limit group!
+        environ['turnstile.nova.limitclass'] = klass
+
+        # If we have a context that supports it, set the quota class
+        if context:
+            context.quota_class = klass
+
+
+def _get_groups(state, group_str, prio_conf, stages=None):
+    """
+    Split the value of the X-PP-Groups header into a list of group
+    names, in priority order.  This is expensive enough that the
+    results are remembered, if the header cache is enabled; uses of
+    the Repose bug workaround are counted either way.
+
+    :param state: The PreprocessState for the middleware.
+    :param group_str: The value of the X-PP-Groups header.
+    :param prio_conf: The value of the rs_limits.groups configuration
+                      option.
+    :param stages: If provided, a _Stages object on which to mark the
+                   end of each stage of the parsing.
+
+    :returns: A tuple of group names, highest priority first.
+    """
+
+    if state.header_cache is None:
+        return _parse_groups(group_str, state.get_priorities(prio_conf),
+                             state.metrics, stages)
+
+    parsed = state.header_cache.lookup((group_str, prio_conf))
+    if parsed is None:
+        parsed = _parse_header(group_str, state.get_priorities(prio_conf),
+                               stages)
+        state.header_cache.store((group_str, prio_conf), parsed)
+    elif stages is not None:
+        stages.mark('header_cache')
+
+    groups, repose = parsed
+    if repose and state.metrics is not None:
+        state.metrics.incr('repose')
+
+    return groups
+
+
+def _guarded_lookup(state, lookup, db, groups):
+    """
+    Perform a lookup under the control of the circuit breaker.  The
+    lookup is abandoned if it exceeds the configured timeout.
+
+    :param state: The PreprocessState for the middleware.
+    :param lookup: The lookup function.
+    :param db: The database handle to pass to the lookup function.
+    :param groups: A list of group names, in priority order.
+
+    :returns: The result of the lookup function, or _unresolved if
+              the lookup was not attempted or did not succeed.
+    """
+
+    breaker = state.breaker
+    if not breaker.allow():
+        return _unresolved
+
+    start = time.time()
+    timer = eventlet.Timeout(state.lookup_timeout)
+    try:
+        result = lookup(db, groups)
+    except eventlet.Timeout as exc:
+        if exc is not timer:
+            # Don't leave a trial lookup outstanding
+            breaker.failure()
+            raise
+        LOG.warning("Group mapping lookup timed out after %s seconds" %
+                    state.lookup_timeout)
+        result = _unresolved
+    except redis.exceptions.RedisError as exc:
+        LOG.warning("Group mapping lookup failed: %s" % exc)
+        result = _unresolved
+    except BaseException:
+        # Includes GreenletExit, which is not an Exception
+        breaker.failure()
+        raise
+    finally:
+        timer.cancel()
+
+    # A lookup which completes, but too slowly, is still a failure
+    if result is _unresolved or time.time() - start > state.lookup_timeout:
+        if breaker.failure() and state.metrics is not None:
+            state.metrics.incr('breaker.trip')
+    else:
+        breaker.success()
+
+    return result
+
+
+def _fallback(state, key, groups):
+    """
+    Select a rate-limit class without consulting the database.  The
+    last known rate-limit class for the header is used; failing that,
+    the group mapping snapshot is consulted, regardless of its age.
+
+    :param state: The PreprocessState for the middleware.
+    :param key: The resolution cache key for the header.
+    :param groups: A list of group names, in priority order.
+
+    :returns: The rate-limit class, or None if none is known.
+    """
+
+    state.breaker.fallback()
+    if state.metrics is not None:
+        state.metrics.incr('fallback')
+
+    klass = state.stale.lookup(key, _unresolved)
+    if klass is not _unresolved:
+        return klass
+
+    if state.snapshot is not None:
+        group, klass = _lookup_mget(state.snapshot, groups)
+        return klass
+
+    return None
+
+
+def _tenant_key(state, environ, group_str, prio_conf):
+    """
+    Compute the key for the tenant memo.
+
+    :param state: The PreprocessState for the middleware.
+    :param environ: The request environment.
+    :param group_str: The value of the X-PP-Groups header.
+    :param prio_conf: The value of the rs_limits.groups configuration
+                      option.
+
+    :returns: A tuple of the tenant's project ID and a fingerprint of
+              the header and group priorities, or None if the tenant
+              memo is not in use or the tenant is not known.
+    """
+
+    if state.tenant_cache is None:
+        return None
+
+    tenant = getattr(environ.get('nova.context'), 'project_id', None)
+    if tenant is None:
+        return None
+
+    # The same tenant may send different headers, so include them
+    return (tenant,
+            hashlib.md5('%s\0%s' % (group_str, prio_conf)).digest())
+
+
+def _resolve(midware, state, rs_conf, group_str, tenant_key=None,
+             stages=None):
+    """
+    Resolve the rate-limit class for a value of the X-PP-Groups
+    header.
+
+    :param midware: The turnstile middleware.
+    :param state: The PreprocessState for the middleware.
+    :param rs_conf: The "rs_limits" section of the configuration.
+    :param group_str: The value of the X-PP-Groups header.
+    :param tenant_key: The key for the tenant memo, or None.
+    :param stages: If provided, a _Stages object on which to mark the
+                   end of each stage of the resolution.
+
+    :returns: The rate-limit class, or None if none of the groups
+              are mapped to one.
+    """
+
+    if state.warmer is not None:
+        state.warmer.record(group_str)
+
+    # Has this tenant sent this header recently?
+    if tenant_key is not None:
+        klass = state.tenant_cache.lookup(tenant_key, _unresolved)
+        if klass is not _unresolved:
+            if state.metrics is not None:
+                _record_resolution(state.metrics, klass)
+            if stages is not None:
+                stages.mark('cache')
+            return klass
+    generation = state.generation
+
+    # Have we already resolved the rate-limit class for this header?
+    prio_conf = state.get_prio_conf(rs_conf.get('groups', ''))
+    if state.resolution_cache is not None:
+        klass = state.resolution_cache.lookup((group_str, prio_conf),
+                                              _unresolved)
+        if klass is not _unresolved:
+            if tenant_key is not None:
+                state.tenant_cache.store(tenant_key, klass)
+            if state.metrics is not None:
+                _record_resolution(state.metrics, klass)
+            if stages is not None:
+                stages.mark('cache')
+            return klass
+    if stages is not None:
+        stages.mark('cache')
+
+    if state.flights is None:
+        klass, authoritative = _resolve_uncached(
+            midware, state, rs_conf, group_str, prio_conf, generation,
+            stages)
+    else:
+        # Let any concurrent resolution of the same header do the
+        # work
+        (klass, authoritative), shared = state.flights.do(
+            (group_str, prio_conf), _resolve_uncached,
+            midware, state, rs_conf, group_str, prio_conf, generation,
+            stages)
+        if shared and state.metrics is not None:
+            state.metrics.incr('coalesced')
+    if stages is not None:
+        stages.mark('resolve')
+
+    # Remember the result for the tenant, unless it is only a
+    # fallback or the mappings changed meanwhile
+    if (tenant_key is not None and authoritative and
+            generation == state.generation):
+        state.tenant_cache.store(tenant_key, klass)
+
+    return klass
+
+
+def _record_resolution(metrics, klass, lookups=0, position=None):
+    """
+    Record the metrics describing the resolution of a rate-limit
+    class.
+
+    :param metrics: The metrics sink.
+    :param klass: The rate-limit class, or None if none of the groups
+                  are mapped to one.
+    :param lookups: The number of database commands issued.
+    :param position: The position, in priority order, of the group
+                     which provided the rate-limit class, or None if
+                     it is not known.
+    """
+
+    metrics.observe('lookups', lookups)
+    if klass is None:
+        metrics.incr('unmapped')
+    elif position is not None:
+        metrics.observe('position', position)
+
+
+def _resolve_uncached(midware, state, rs_conf, group_str, prio_conf,
+                      generation, stages=None):
+    """
+    Resolve the rate-limit class for a value of the X-PP-Groups
+    header, without consulting the resolution cache.  The result is
+    stored in the resolution cache, if one is in use.
+
+    :param midware: The turnstile middleware.
+    :param state: The PreprocessState for the middleware.
+    :param rs_conf: The "rs_limits" section of the configuration.
+    :param group_str: The value of the X-PP-Groups header.
+    :param prio_conf: The value of the rs_limits.groups configuration
+                      option.
+    :param generation: The generation of the state when the
+                       resolution began.
+    :param stages: If provided, a _Stages object on which to mark the
+                   end of each stage of the resolution.
+
+    :returns: A tuple of the rate-limit class (or None if none of the
+              groups are mapped to one) and a flag which is False if
+              the class was selected without consulting the database
+              because of the circuit breaker.
+    """
+
+    metrics = state.metrics
+
+    # Split the groups string into a list of groups
+    groups = _get_groups(state, group_str, prio_conf, stages)
+
+    # The class may have been precomputed for this combination of
+    # groups
+    if state.table is not None:
+        klass = state.table.lookup(groups)
+        if klass is not _unresolved:
+            if metrics is not None:
+                metrics.incr('table_hit')
+                _record_resolution(metrics, klass)
+            if (state.resolution_cache is not None and
+                    generation == state.generation):
+                state.resolution_cache.store((group_str, prio_conf), klass)
+            return klass, True
+
+    # Look up the rate-limit class from the database
+    lookup = state.lookup
+    instrumented = None
+    candidates = groups
+    if state.snapshot is not None and state.snapshot.fresh():
+        # The snapshot is in memory, so a single mget() is cheapest
+        db, lookup = state.snapshot, _lookup_mget
+    else:
+        db = midware.db if state.replica is None else state.replica
+        if metrics is not None:
+            db = instrumented = InstrumentedDatabase(db, metrics)
+        if state.hash:
+            db = HashDatabase(db)
+        if state.cache is not None:
+            db = CachingDatabase(db, state.cache)
+
+        # Skip the groups which cannot have mappings
+        if state.filter is not None:
+            candidates = state.filter.filter(groups)
+    if state.breaker is None or db is state.snapshot:
+        group, klass = lookup(db, candidates)
+    else:
+        result = _guarded_lookup(state, lookup, db, candidates)
+        if result is _unresolved:
+            return _fallback(state, (group_str, prio_conf), groups), False
+        group, klass = result
+        state.stale.store((group_str, prio_conf), klass)
+    if stages is not None:
+        stages.mark('lookup')
+
+    if metrics is not None:
+        _record_resolution(
+            metrics, klass,
+            0 if instrumented is None else instrumented.lookups,
+            None if group is None else groups.index(group))
+
+    # Remember the result, unless the mappings changed meanwhile
+    if (state.resolution_cache is not None and
+            generation == state.generation):
+        state.resolution_cache.store((group_str, prio_conf), klass)
+
+    return klass, True
+
+
+def rs_preprocess(midware, environ):
+    """
+    Pre-process requests to nova.  Derives the rate-limit class from
+    the X-PP-Groups header.
+    """
+
+    # If we don't have the header, let nova_preprocess() do its magic.
+    group_str = environ.get('HTTP_X_PP_GROUPS')
+    if not group_str:
+        return
+
+    # We'll need the nova context
+    context = environ.get('nova.context')
+    if context and not hasattr(context, 'quota_class'):
+        # If the context doesn't have quota_class, then don't activate
+        # the quota_class part of the algorithm...
+        context = None
+
+    # We'll also need our configuration
+    conf = environ.get('turnstile.conf', {'rs_limits': {}})
+    state = _get_state(midware, conf)
+
+    # Profile a sample of the calls, if requested
+    if state.profiler is not None and state.profiler.sample():
+        state.profiler.profile(_preprocess, midware, environ, state,
+                               conf['rs_limits'], group_str, context)
+    else:
+        _preprocess(midware, environ, state, conf['rs_limits'], group_str,
+                    context)
+
+
+def _preprocess(midware, environ, state, rs_conf, group_str, context,
+                stages=None):
+    """
+    Derive the rate-limit class from the X-PP-Groups header.  This is
+    the body of rs_preprocess(), separated so that it may be
+    profiled.
+
+    :param midware: The turnstile middleware.
+    :param environ: The request environment.
+    :param state: The PreprocessState for the middleware.
+    :param rs_conf: The "rs_limits" section of the configuration.
+    :param group_str: The value of the X-PP-Groups header.
+    :param context: The nova context, or None if the rate-limit class
+                    is not to be set on it.
+    :param stages: If provided, a _Stages object on which to mark the
+                   end of each stage of the resolution.
+    """
+
+    tenant_key = _tenant_key(state, environ, group_str,
+                             state.get_prio_conf(rs_conf.get('groups', '')))
+
+    if state.metrics is None:
+        klass = _resolve(midware, state, rs_conf, group_str, tenant_key,
+                         stages)
+    else:
+        start = time.time()
+        klass = _resolve(midware, state, rs_conf, group_str, tenant_key,
+                         stages)
+        state.metrics.timing('preprocess', time.time() - start)
+
+    _set_class(environ, context, klass)
+    if stages is not None:
+        stages.mark('finish')
+
+
+class PendingResolution(object):
+    """
+    A resolution of the rate-limit class which is waiting for group
+    mappings to be fetched from the database.  The caller is
+    responsible for executing the database command given by the
+    "command" attribute, then passing the resulting list of values to
+    the complete() method.
+    """
+
+    def __init__(self, state, environ, context, cache_key, groups, values,
+                 generation, tenant_key=None):
+        """
+        Initialize the PendingResolution.
+
+        :param state: The PreprocessState for the middleware.
+        :param environ: The request environment.
+        :param context: The nova context, if it supports the
+                        quota_class attribute, or None.
+        :param cache_key: The key for the resolution cache.
+        :param groups: A list of group names, in priority order.
+        :param values: A list of the known rate-limit classes for the
+                       groups; unknown classes must be given as
+                       _unresolved.  Only the groups with unknown
+                       classes are fetched.
+        :param generation: The generation of the state when the
+                           resolution began.
+        :param tenant_key: The key for the tenant memo, or None.
+        """
+
+        self.state = state
+        self.environ = environ
+        self.context = context
+        self.cache_key = cache_key
+        self.groups = groups
+        self.values = values
+        self.generation = generation
+        self.tenant_key = tenant_key
+
+        self.missing = [idx for idx, value in enumerate(values)
+                        if value is _unresolved]
+        if state.hash:
+            self.command = (('HMGET', GROUP_HASH) +
+                            tuple(groups[idx] for idx in self.missing))
+        else:
+            self.command = (('MGET',) +
+                            tuple('rs-group:%s' % groups[idx]
+                                  for idx in self.missing))
+
+    def complete(self, values):
+        """
+        Complete the resolution.
+
+        :param values: A list of the results of the database command
+                       given by the "command" attribute.
+
+        :returns: The rate-limit class, or None if none of the groups
+                  are mapped to one.
+        """
+
+        state = self.state
+        for idx, value in zip(self.missing, values):
+            self.values[idx] = value
+
+        klass = None
+        for value in self.values:
+            if value:
+                klass = value
+                break
+
+        # Remember the results, unless the mappings changed meanwhile
+        if self.generation == state.generation:
+            if state.cache is not None:
+                for idx in self.missing:
+                    state.cache.store('rs-group:%s' % self.groups[idx],
+                                      self.values[idx])
+            if state.resolution_cache is not None:
+                state.resolution_cache.store(self.cache_key, klass)
+            if self.tenant_key is not None:
+                state.tenant_cache.store(self.tenant_key, klass)
+
+        _set_class(self.environ, self.context, klass)
+        return klass
+
+
+def rs_prepare(midware, environ):
+    """
+    Pre-process requests to nova without blocking on the database.
+    This is an alternative to rs_preprocess() for servers which use an
+    asynchronous database client.  The rate-limit class is derived
+    from the X-PP-Groups header using the same group priorities and
+    caches as rs_preprocess(), but any group mappings which must be
+    fetched from the database are left for the caller to fetch; the
+    circuit breaker, stale fallback, lookup coalescing and metrics
+    are not applied.
+
+    :param midware: The turnstile middleware.
+    :param environ: The request environment.
+
+    :returns: None if the request has been completely processed.
+              Otherwise, returns a PendingResolution; the caller must
+              execute its "command" with the asynchronous database
+              client, then pass the results to its complete() method.
+    """
+
+    # If we don't have the header, let nova_preprocess() do its magic.
+    group_str = environ.get('HTTP_X_PP_GROUPS')
+    if not group_str:
+        return None
+
+    # We'll need the nova context
+    context = environ.get('nova.context')
+    if context and not hasattr(context, 'quota_class'):
+        context = None
+
+    # We'll also need our configuration
+    conf = environ.get('turnstile.conf', {'rs_limits': {}})
+    state = _get_state(midware, conf)
+
+    if state.warmer is not None:
+        state.warmer.record(group_str)
+
+    # Has this tenant sent this header recently?
+    prio_conf = state.get_prio_conf(conf['rs_limits'].get('groups', ''))
+    tenant_key = _tenant_key(state, environ, group_str, prio_conf)
+    if tenant_key is not None:
+        klass = state.tenant_cache.lookup(tenant_key, _unresolved)
+        if klass is not _unresolved:
+            _set_class(environ, context, klass)
+            return None
+    generation = state.generation
+
+    # Have we already resolved the rate-limit class for this header?
+    cache_key = (group_str, prio_conf)
+    if state.resolution_cache is not None:
+        klass = state.resolution_cache.lookup(cache_key, _unresolved)
+        if klass is not _unresolved:
+            if tenant_key is not None:
+                state.tenant_cache.store(tenant_key, klass)
+            _set_class(environ, context, klass)
+            return None
+
+    # Split the groups string into a list of groups
+    groups = _get_groups(state, group_str, prio_conf)
+
+    # Find out what we already know about the group mappings; the
+    # class may even have been precomputed for this combination of
+    # groups
+    klass = (_unresolved if state.table is None else
+             state.table.lookup(groups))
+    if klass is not _unresolved:
+        values = [klass]
+    elif state.snapshot is not None and state.snapshot.fresh():
+        values = state.snapshot.mget(['rs-group:%s' % group
+                                      for group in groups])
+    else:
+        if state.cache is not None:
+            values = [state.cache.lookup('rs-group:%s' % group, _unresolved)
+                      for group in groups]
+        else:
+            values = [_unresolved] * len(groups)
+
+        # Groups which cannot have mappings need not be fetched
+        if state.filter is not None:
+            mapped = set(state.filter.filter(groups))
+            values = [None if value is _unresolved and group not in mapped
+                      else value for group, value in zip(groups, values)]
+
+    # Only the groups preceding the first known mapping matter
+    for idx, value in enumerate(values):
+        if value is not _unresolved and value:
+            del values[idx + 1:]
+            break
+
+    pending = PendingResolution(state, environ, context, cache_key,
+                                groups[:len(values)], values, generation,
+                                tenant_key)
+    if pending.missing:
+        return pending
+
+    # Everything we need is already known
+    pending.complete([])
+    return None
+
+
+def _check_arguments(args):
+    """
+    Sanity-check the arguments to ensure that the --class and --delete
+    options are not both given, that neither is given when listing
+    the group mappings, that only --delete is given with
+    --priorities, and that a group is given when not listing or
+    managing the group priorities.  This is a preprocessor for the
+    group_class() function, when being called in console script mode.
+
+    :param args: A Namespace object containing a 'group' attribute, a
+                 'klass' attribute, a 'delete' attribute, a 'listing'
+                 attribute, a 'counts' attribute, and a 'priorities'
+                 attribute.
+    """
+
+    if args.klass and args.delete:
+        raise Exception("The --class and --delete options are "
+                        "mutually exclusive.")
+
+    if args.priorities is not None:
+        if args.klass or args.listing or args.counts:
+            raise Exception("The --priorities option may not be used "
+                            "with the --class, --list, or --counts "
+                            "options.")
+        if args.priorities is not True and args.delete:
+            raise Exception("The group priorities may not be both set "
+                            "and deleted.")
+    elif args.listing or args.counts:
+        if args.klass or args.delete:
+            raise Exception("The --list and --counts options may not be "
+                            "used with the --class or --delete options.")
+    elif not args.group:
+        raise Exception("A group must be specified.")
+
+
+def _report_group_class(args, result):
+    """
+    Report the rate-limit class for the group.  This is a
+    postprocessor for the group_class() function, when being called in
+    console script mode.
+
+    :param args: A Namespace object containing a 'group' attribute, a
+                 desired rate-limit class in the 'klass' attribute
+                 (which should be None if no change was requested),
+                 and a 'delete' attribute (which should be True if the
+                 association was to be deleted).
+    :param result: The result of the group_class() function call.
+                   This will be the previously configured rate-limit
+                   class for the group.
+
+    :returns: None to indicate success.
+    """
+
+    if args.priorities is not None:
+        return _report_group_priorities(args, result)
+    elif args.listing or args.counts:
+        return _report_group_list(args, result)
+
+    print "Group %s:" % args.group
+    if args.klass or args.delete:
+        if result:
+            print "  Previous rate-limit class: %s" % result
+        if args.delete:
+            print "  Deleted from database"
+        else:
+            print "  New rate-limit class: %s" % args.klass
+    elif result:
+        print "  Configured rate-limit class: %s" % result
+    else:
+        print "  Not currently configured in database."
+
+    return None
+
+
+def _report_group_list(args, result):
+    """
+    Report the group mappings as they are listed.  This is called by
+    the _report_group_class() postprocessor when listing the group
+    mappings.
+
+    :param args: A Namespace object containing a 'listing' attribute
+                 (which should be True if each group mapping is to be
+                 reported) and a 'counts' attribute (which should be
+                 True if the number of groups mapped to each rate-limit
+                 class is to be reported).
+    :param result: The result of the group_class() function call.
+                   This will be an iterator over tuples of the group
+                   name and the rate-limit class.
+
+    :returns: None to indicate success.
+    """
+
+    counts = {}
+    for group, klass in result:
+        if args.listing:
+            print "Group %s: %s" % (group, klass)
+        counts[klass] = counts.get(klass, 0) + 1
+
+    if args.counts:
+        print "Groups per rate-limit class:"
+        for klass in sorted(counts):
+            print "  %s: %d" % (klass, counts[klass])
+        print "  Total: %d" % sum(counts.values())
+
+    return None
+
+
+def _report_group_priorities(args, result):
+    """
+    Report the group priorities stored in the database.  This is
+    called by the _report_group_class() postprocessor when managing
+    the group priorities.
+
+    :param args: A Namespace object containing a 'priorities'
+                 attribute (which should be True if no change was
+                 requested, or the new group priorities) and a
+                 'delete' attribute (which should be True if the group
+                 priorities were to be deleted).
+    :param result: The result of the group_class() function call.
+                   This will be a tuple of the previous version and
+                   the previous group priorities.
+
+    :returns: None to indicate success.
+    """
+
+    version, prio_conf = result
+
+    print "Group priorities:"
+    if args.priorities is not True or args.delete:
+        if prio_conf is not None:
+            print "  Previous priorities: %s" % prio_conf
+        if args.delete:
+            print "  Deleted from database"
+        else:
+            print "  New priorities: %s" % args.priorities
+    elif prio_conf is not None:
+        print "  Configured priorities: %s" % prio_conf
+        print "  Version: %s" % version
+    else:
+        print "  Not currently configured in database."
+
+    return None
+
+
+def _group_priorities(db, prio_conf=None, delete=False):
+    """
+    Set up or query the group priorities stored in the database.  The
+    version counter is bumped whenever they are changed, so that
+    workers reloading them can tell that they need to be recompiled.
+
+    :param db: The database handle.
+    :param prio_conf: If provided, the new group priorities, in the
+                      format of the rs_limits.groups configuration
+                      option.
+    :param delete: If True, deletes the group priorities from the
+                   database.
+
+    :returns: A tuple of the previous version and the previous group
+              priorities.
+    """
+
+    version, old_prio_conf = db.hmget(PRIORITIES_KEY,
+                                      ['version', 'groups'])
+
+    if delete and old_prio_conf is not None:
+        pipe = db.pipeline()
+        pipe.hdel(PRIORITIES_KEY, 'groups')
+        pipe.hincrby(PRIORITIES_KEY, 'version', 1)
+        pipe.execute()
+    elif prio_conf is not None and prio_conf != old_prio_conf:
+        pipe = db.pipeline()
+        pipe.hset(PRIORITIES_KEY, 'groups', prio_conf)
+        pipe.hincrby(PRIORITIES_KEY, 'version', 1)
+        pipe.execute()
+
+    return version, old_prio_conf
+
+
+def _scan_mappings(db, match='*', batch=1000):
+    """
+    Iterate over the group mappings, in batches.  The keys are
+    enumerated using SCAN, so that the database is not blocked, and
+    their values are retrieved using one MGET per batch; only one
+    batch is held in memory at a time.
+
+    :param db: The database handle.
+    :param match: A glob pattern for the group names.
+    :param batch: The number of group mappings to retrieve at a time.
+
+    :returns: An iterator over lists of tuples of the group name and
+              the rate-limit class.
+    """
+
+    keys = []
+    for key in db.scan_iter(match='rs-group:%s' % match, count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            yield _fetch_mappings(db, keys)
+            keys = []
+    if keys:
+        yield _fetch_mappings(db, keys)
+
+
+def _fetch_mappings(db, keys):
+    """
+    Retrieve a batch of group mappings.
+
+    :param db: The database handle.
+    :param keys: A list of "rs-group:<group>" keys.
+
+    :returns: A list of tuples of the group name and the rate-limit
+              class.
+    """
+
+    # Keys which vanished between the SCAN and the MGET will have None
+    # values, so skip them
+    return [(key[len('rs-group:'):], klass)
+            for key, klass in zip(keys, db.mget(keys))
+            if klass is not None]
+
+
+def _list_mappings(db, match='*', batch=1000):
+    """
+    Iterate over the group mappings.
+
+    :param db: The database handle.
+    :param match: A glob pattern for the group names.
+    :param batch: The number of group mappings to retrieve at a time.
+
+    :returns: An iterator over tuples of the group name and the
+              rate-limit class.
+    """
+
+    for mappings in _scan_mappings(db, match, batch):
+        for mapping in mappings:
+            yield mapping
+
+
+@tools.add_argument('config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('group',
+                    nargs='?',
+                    default=None,
+                    help="Name of the group.  When listing the group "
+                    "mappings, a glob pattern for the group names.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_argument('--delete', '-D',
+                    dest='delete',
+                    action='store_true',
+                    default=False,
+                    help="Delete the group from the database.")
+@tools.add_argument('--class', '-c',
+                    dest='klass',
+                    action='store',
+                    default=None,
+                    help="If specified, sets the class associated with "
+                    "the given group.")
+@tools.add_argument('--list', '-l',
+                    dest='listing',
+                    action='store_true',
+                    default=False,
+                    help="List the group mappings, optionally only those "
+                    "for groups matching the given pattern.")
+@tools.add_argument('--counts',
+                    dest='counts',
+                    action='store_true',
+                    default=False,
+                    help="Report the number of groups mapped to each "
+                    "rate-limit class, optionally only counting groups "
+                    "matching the given pattern.")
+@tools.add_argument('--batch', '-b',
+                    dest='batch',
+                    action='store',
+                    type=int,
+                    default=1000,
+                    help="The number of group mappings to retrieve at a "
+                    "time when listing them.  Defaults to %(default)s.")
+@tools.add_argument('--priorities', '-p',
+                    dest='priorities',
+                    nargs='?',
+                    const=True,
+                    default=None,
+                    help="Show the group priorities stored in the "
+                    "database, or set them if a value is given; with "
+                    "--delete, deletes them.  The value has the same "
+                    "format as the rs_limits.groups configuration "
+                    "option.")
+@tools.add_preprocessor(_check_arguments)
+@tools.add_postprocessor(_report_group_class)
+def group_class(conf_file, group, klass=None, delete=False, listing=False,
+                counts=False, batch=1000, priorities=None):
+    """
+    Set up or query limit classes associated with groups.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param group: The name of the group.  When listing, a glob pattern
+                  for the group names; if None, all groups are
+                  listed.
+    :param klass: If provided, the name of the class to map the group
+                  to.
+    :param delete: If True, deletes the group from the database.
+    :param listing: If True, lists the group mappings.
+    :param counts: If True, lists the group mappings so that the
+                   number of groups mapped to each class may be
+                   reported.
+    :param batch: The number of group mappings to retrieve at a time
+                  when listing them.
+    :param priorities: If provided, the group priorities stored in the
+                       database are managed instead of a group
+                       mapping.  If True, they are queried or, with
+                       `delete`, deleted; otherwise, this is the new
+                       value for them.
+
+    Returns the class associated with the given group.  Note that only
+    one of `klass` or `delete` may be given.  When listing, returns an
+    iterator over tuples of the group name and the class, which
+    retrieves the group mappings in batches as it is consumed.  When
+    managing the group priorities, returns a tuple of their previous
+    version and value.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    if priorities is not None:
+        return _group_priorities(conf.get_database(),
+                                 None if priorities is True else priorities,
+                                 delete)
+    db = _get_storage(conf.get_database(), conf['rs_limits'])
+
+    if listing or counts:
+        return _list_mappings(db, group or '*', batch)
+
+    # Get the key for the limit class...
+    key = 'rs-group:%s' % group
+
+    # Now, look up the tenant's current class
+    old_klass = db.get(key)
+
+    # Do we need to delete it?  Change it?  Either way, let everyone
+    # know about the change.
+    if delete and old_klass is not None:
+        db.delete(key)
+        db.incr(EPOCH_KEY)
+        db.publish(GROUP_CHANNEL, group)
+    elif klass and klass != old_klass:
+        db.set(key, klass)
+        db.incr(EPOCH_KEY)
+        db.publish(GROUP_CHANNEL, group)
+
+    return old_klass
+
+
+def _read_mappings(stream, fmt):
+    """
+    Read group mappings from a stream.
+
+    :param stream: The stream to read.
+    :param fmt: The format of the stream; either "csv", in which each
+                row contains a group name and a rate-limit class, or
+                "json", in which each line is a JSON object with
+                "group" and "class" keys.  An empty or missing
+                rate-limit class indicates that the group's mapping
+                is to be deleted.
+
+    :returns: An iterator over tuples of the group name and the
+              rate-limit class, which will be None if the mapping is
+              to be deleted.
+    """
+
+    if fmt == 'json':
+        for lineno, line in enumerate(stream):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                group = record['group']
+            except (ValueError, TypeError, KeyError):
+                raise ValueError("Invalid group mapping on line %d" %
+                                 (lineno + 1))
+            yield group, record.get('class') or None
+    else:
+        for lineno, row in enumerate(csv.reader(stream)):
+            if not row or not row[0]:
+                continue
+            elif len(row) > 2:
+                raise ValueError("Invalid group mapping on line %d" %
+                                 (lineno + 1))
+            yield row[0], row[1] if len(row) > 1 and row[1] else None
+
+
+def _write_mappings(stream, fmt, mappings):
+    """
+    Write group mappings to a stream.
+
+    :param stream: The stream to write to.
+    :param fmt: The format of the stream; either "csv" or "json".  See
+                _read_mappings() for details.
+    :param mappings: A list of tuples of the group name and the
+                     rate-limit class.
+    """
+
+    if fmt == 'json':
+        for group, klass in mappings:
+            stream.write(json.dumps({'group': group, 'class': klass},
+                                    sort_keys=True) + '\n')
+    else:
+        csv.writer(stream).writerows(mappings)
+
+
+def _bulk_batch(db, batch):
+    """
+    Apply a batch of group mapping changes.  The current mappings are
+    retrieved with a single MGET, and the changes are applied and
+    announced in a single pipeline.
+
+    :param db: The database handle.
+    :param batch: A list of tuples of the group name and the new
+                  rate-limit class, which should be None if the
+                  mapping is to be deleted.  Each group may appear
+                  only once.
+
+    :returns: A list of tuples of the group name, the previous
+              rate-limit class, and the new rate-limit class, for
+              those groups whose mappings were changed.
+    """
+
+    old_klasses = db.mget(['rs-group:%s' % group for group, _klass in batch])
+
+    changes = []
+    pipe = db.pipeline(transaction=False)
+    for (group, klass), old_klass in zip(batch, old_klasses):
+        if klass == old_klass:
+            continue
+        elif klass is None:
+            pipe.delete('rs-group:%s' % group)
+        else:
+            pipe.set('rs-group:%s' % group, klass)
+        pipe.publish(GROUP_CHANNEL, group)
+        changes.append((group, old_klass, klass))
+    if changes:
+        pipe.incr(EPOCH_KEY)
+        pipe.execute()
+
+    return changes
+
+
+def _dump_mappings(db, stream, fmt, batch):
+    """
+    Dump all the group mappings.
+
+    :param db: The database handle.
+    :param stream: The stream to write the group mappings to.
+    :param fmt: The format of the stream; either "csv" or "json".
+    :param batch: The number of group mappings to retrieve at a time.
+
+    :returns: The number of group mappings dumped.
+    """
+
+    count = 0
+    for mappings in _scan_mappings(db, batch=batch):
+        _write_mappings(stream, fmt, mappings)
+        count += len(mappings)
+
+    return count
+
+
+def _report_group_bulk(args, result):
+    """
+    Report the group mappings changed or dumped.  This is a
+    postprocessor for the group_bulk() function, when being called in
+    console script mode.
+
+    :param args: A Namespace object containing a 'dump' attribute
+                 (which should be True if the group mappings were
+                 dumped).
+    :param result: The result of the group_bulk() function call.  This
+                   will be the number of group mappings dumped, or a
+                   list of tuples of the group name, the previous
+                   rate-limit class, and the new rate-limit class for
+                   each changed mapping.
+
+    :returns: None to indicate success.
+    """
+
+    if args.dump:
+        # The mappings may have gone to stdout
+        print >>sys.stderr, "Dumped %d group mapping(s)" % result
+        return None
+
+    for group, old_klass, klass in result:
+        print "Group %s:" % group
+        if old_klass:
+            print "  Previous rate-limit class: %s" % old_klass
+        if klass is None:
+            print "  Deleted from database"
+        else:
+            print "  New rate-limit class: %s" % klass
+    print "Changed %d group mapping(s)" % len(result)
+
+    return None
+
+
+@tools.add_argument('config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('file_name',
+                    metavar='file',
+                    nargs='?',
+                    default='-',
+                    help="Name of the file to read the group mappings "
+                    "from, or to dump them to.  Defaults to standard input "
+                    "or standard output.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_argument('--format', '-f',
+                    dest='fmt',
+                    action='store',
+                    choices=['csv', 'json'],
+                    default='csv',
+                    help="The format of the group mappings: \"csv\" rows "
+                    "of group name and rate-limit class, or \"json\" lines "
+                    "with \"group\" and \"class\" keys.  An empty "
+                    "rate-limit class deletes the group.  Defaults to "
+                    "%(default)s.")
+@tools.add_argument('--dump',
+                    dest='dump',
+                    action='store_true',
+                    default=False,
+                    help="Dump all the group mappings, rather than "
+                    "changing them.")
+@tools.add_argument('--batch', '-b',
+                    dest='batch',
+                    action='store',
+                    type=int,
+                    default=1000,
+                    help="The number of group mappings to read or change "
+                    "at a time.  Defaults to %(default)s.")
+@tools.add_postprocessor(_report_group_bulk)
+def group_bulk(conf_file, file_name='-', fmt='csv', dump=False, batch=1000):
+    """
+    Change or dump many group mappings at once.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param file_name: Name of the file to read the group mappings
+                      from, or to dump them to.  If "-", standard
+                      input or standard output is used.
+    :param fmt: The format of the group mappings; either "csv" or
+                "json".
+    :param dump: If True, dumps all the group mappings rather than
+                 changing them.
+    :param batch: The number of group mappings to read or change at a
+                  time.
+
+    When changing group mappings, the changes are applied in batches
+    using a single connection to the database, and each change is
+    announced as group_class() would.  Returns a list of tuples of the
+    group name, the previous rate-limit class, and the new rate-limit
+    class for each changed mapping.  When dumping group mappings,
+    returns the number of mappings dumped.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = _get_storage(conf.get_database(), conf['rs_limits'])
+
+    if file_name == '-':
+        stream = sys.stdout if dump else sys.stdin
+    else:
+        stream = open(file_name, 'w' if dump else 'r')
+
+    try:
+        if dump:
+            return _dump_mappings(db, stream, fmt, batch)
+
+        changes = []
+        pending = []
+        groups = set()
+        for group, klass in _read_mappings(stream, fmt):
+            # A group appearing twice in a batch must see its first
+            # change as its previous value
+            if len(pending) >= batch or group in groups:
+                changes.extend(_bulk_batch(db, pending))
+                pending = []
+                groups = set()
+            pending.append((group, klass))
+            groups.add(group)
+        if pending:
+            changes.extend(_bulk_batch(db, pending))
+
+        return changes
+    finally:
+        if file_name != '-':
+            stream.close()
+
+
+def _migrate_batch(db, keys, delete=False):
+    """
+    Migrate a batch of group mappings into the hash.  The values are
+    retrieved with a single MGET, and all the writes are issued in a
+    single pipeline.
+
+    :param db: The database handle.
+    :param keys: A list of "rs-group:<group>" keys to migrate.
+    :param delete: If True, deletes the keys once they have been
+                   migrated.
+
+    :returns: The number of group mappings migrated.
+    """
+
+    count = 0
+    pipe = db.pipeline(transaction=False)
+    for key, klass in zip(keys, db.mget(keys)):
+        if klass is None:
+            # Deleted since we found it
+            continue
+
+        pipe.hset(GROUP_HASH, key[len('rs-group:'):], klass)
+        if delete:
+            pipe.delete(key)
+        count += 1
+    pipe.execute()
+
+    return count
+
+
+def _report_group_migrate(args, result):
+    """
+    Report the number of group mappings migrated.  This is a
+    postprocessor for the group_migrate() function, when being called
+    in console script mode.
+
+    :param args: A Namespace object containing a 'delete' attribute
+                 (which should be True if the original keys were to be
+                 deleted).
+    :param result: The result of the group_migrate() function call.
+                   This will be the number of group mappings migrated.
+
+    :returns: None to indicate success.
+    """
+
+    print "Migrated %d group mapping(s) to hash %s" % (result, GROUP_HASH)
+    if args.delete:
+        print "  Original keys deleted from database"
+
+    return None
+
+
+@tools.add_argument('config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_argument('--delete', '-D',
+                    dest='delete',
+                    action='store_true',
+                    default=False,
+                    help="Delete the original keys from the database once "
+                    "they have been migrated.")
+@tools.add_argument('--batch', '-b',
+                    dest='batch',
+                    action='store',
+                    type=int,
+                    default=1000,
+                    help="The number of group mappings to migrate at a "
+                    "time.  Defaults to %(default)s.")
+@tools.add_postprocessor(_report_group_migrate)
+def group_migrate(conf_file, delete=False, batch=1000):
+    """
+    Migrate group mappings into a single hash.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param delete: If True, deletes the original "rs-group:<group>"
+                   keys once they have been migrated.
+    :param batch: The number of group mappings to migrate at a time.
+
+    Copies all the "rs-group:<group>" keys into the fields of the
+    "rs-groups" hash, so that the "storage" option of the "rs_limits"
+    section of the configuration may be set to "hash".  Returns the
+    number of group mappings migrated.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    # Walk through all the keys, without blocking the database
+    count = 0
+    keys = []
+    for key in db.scan_iter(match='rs-group:*', count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            count += _migrate_batch(db, keys, delete)
+            keys = []
+    if keys:
+        count += _migrate_batch(db, keys, delete)
+
+    return count
+
+
+@tools.add_argument('config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_argument('--once', '-1',
+                    dest='once',
+                    action='store_true',
+                    default=False,
+                    help="Write the shared group mapping file once, then "
+                    "exit.  By default, the file is rewritten "
+                    "periodically, for as long as this tool runs.")
+def group_share(conf_file, once=False):
+    """
+    Maintain the shared group mapping file.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param once: If True, writes the file once and returns.
+                 Otherwise, rewrites the file every
+                 "shared_cache_interval" seconds, whenever no worker
+                 process is doing so, and applies changes announced
+                 by group_class as they arrive.
+
+    The name of the file is given by the "shared_cache" option of the
+    "rs_limits" section of the configuration.  This allows the file
+    to be maintained by a separate process, in which case the
+    "shared_cache_refresh" option should be set to "no" so that the
+    worker processes only read the file.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    rs_conf = conf['rs_limits']
+    if not rs_conf.get('shared_cache'):
+        raise ValueError("The \"shared_cache\" option of the \"rs_limits\" "
+                         "section of the configuration must be set")
+    if not once:
+        # The listener blocks reading from the database, so the
+        # sockets must cooperate with the reloading loop
+        eventlet.monkey_patch()
+    raw_db = conf.get_database()
+    db = _get_storage(raw_db, rs_conf)
+
+    snapshot = SharedSnapshot(rs_conf['shared_cache'], db,
+                              float(rs_conf.get('shared_cache_interval',
+                                                300)))
+    if once:
+        snapshot.load()
+    else:
+        MappingListener(snapshot, raw_db).start()
+        snapshot.run()
+
+
+def _compute_table(headers, prios, mappings):
+    """
+    Compute the rate-limit classes for the combinations of groups in
+    several X-PP-Groups header values.
+
+    :param headers: A list of values of the X-PP-Groups header.
+    :param prios: An instance of GroupPriorities.
+    :param mappings: A dictionary mapping group names to rate-limit
+                     classes.
+
+    :returns: A dictionary mapping the comma-separated group names, in
+              priority order, to the rate-limit class, which is empty
+              if none of the groups are mapped to one.
+    """
+
+    table = {}
+    for header in headers:
+        if not header:
+            continue
+
+        groups = _parse_groups(header, prios)
+
+        klass = ''
+        for group in groups:
+            if mappings.get(group):
+                klass = mappings[group]
+                break
+        table[','.join(groups)] = klass
+
+    return table
+
+
+def _store_table(db, table, epoch, batch=1000):
+    """
+    Replace the resolution table in the database.  The new table is
+    built under a temporary name and renamed into place, along with
+    bumping its version, in a single transaction.
+
+    :param db: The database handle.
+    :param table: A dictionary mapping the comma-separated group
+                  names, in priority order, to the rate-limit class.
+    :param epoch: The value of the mapping epoch counter when the
+                  group mappings were read.
+    :param batch: The number of entries to store per command.
+    """
+
+    tmp_key = '%s.tmp' % TABLE_KEY
+    fields = table.items()
+
+    pipe = db.pipeline()
+    pipe.delete(tmp_key)
+    for idx in range(0, len(fields), batch):
+        pipe.hmset(tmp_key, dict(fields[idx:idx + batch]))
+    if fields:
+        pipe.rename(tmp_key, TABLE_KEY)
+    else:
+        pipe.delete(TABLE_KEY)
+    pipe.hincrby(TABLE_INFO_KEY, 'version', 1)
+    pipe.hset(TABLE_INFO_KEY, 'epoch', epoch)
+    pipe.execute()
+
+
+def _report_group_table(args, result):
+    """
+    Report the size of the resolution table.  This is a postprocessor
+    for the group_table() function, when being called in console
+    script mode.
+
+    :param args: A Namespace object containing a 'delete' attribute
+                 (which should be True if the table was to be
+                 deleted).
+    :param result: The result of the group_table() function call.
+                   This will be a tuple of the number of header
+                   values read and the resolution table.
+
+    :returns: None to indicate success.
+    """
+
+    if args.delete:
+        print "Deleted the resolution table from database"
+        return None
+
+    count, table = result
+    print ("Stored %d group combination(s) from %d header value(s)" %
+           (len(table), count))
+    print "  With a rate-limit class: %d" % len([klass for klass in
+                                                 table.values() if klass])
+
+    return None
+
+
+@tools.add_argument('config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('file_name',
+                    nargs='?',
+                    default=None,
+                    help="Name of a file listing the X-PP-Groups header "
+                    "values to precompute the rate-limit classes for, one "
+                    "per line.  If \"-\", standard input is read.  "
+                    "Defaults to the header values saved for preloading "
+                    "the caches.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_argument('--delete', '-D',
+                    dest='delete',
+                    action='store_true',
+                    default=False,
+                    help="Delete the resolution table from the database.")
+@tools.add_argument('--batch', '-b',
+                    dest='batch',
+                    action='store',
+                    type=int,
+                    default=1000,
+                    help="The number of group mappings to retrieve, or "
+                    "table entries to store, at a time.  Defaults to "
+                    "%(default)s.")
+@tools.add_postprocessor(_report_group_table)
+def group_table(conf_file, file_name=None, delete=False, batch=1000):
+    """
+    Precompute the rate-limit classes for common combinations of
+    groups.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param file_name: Name of a file listing the X-PP-Groups header
+                      values, one per line.  If "-", standard input is
+                      read.  If None, the header values saved by the
+                      "warmup_file" or "warmup_key" options of the
+                      "rs_limits" section of the configuration are
+                      used.
+    :param delete: If True, deletes the resolution table from the
+                   database.
+    :param batch: The number of group mappings to retrieve, or table
+                  entries to store, at a time.
+
+    All the group mappings are read, and the rate-limit class is
+    determined for the groups in each header value, using the group
+    priorities that rs_preprocess() would use.  The resulting table is
+    used by rs_preprocess() if the "resolution_table" option is
+    enabled, until the group mappings next change.  Returns a tuple of
+    the number of header values read and the table.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    rs_conf = conf['rs_limits']
+    db = conf.get_database()
+
+    if delete:
+        db.delete(TABLE_KEY, TABLE_INFO_KEY)
+        return None
+
+    # Get the header values to precompute the classes for
+    if file_name == '-':
+        headers = [line.strip() for line in sys.stdin]
+    elif file_name:
+        with open(file_name) as f:
+            headers = [line.strip() for line in f]
+    elif rs_conf.get('warmup_file') or rs_conf.get('warmup_key'):
+        headers = HeaderWarmer(None, db, path=rs_conf.get('warmup_file'),
+                               key=rs_conf.get('warmup_key')).load()
+    else:
+        raise ValueError("A file of header values must be given if the "
+                         "\"warmup_file\" and \"warmup_key\" options of "
+                         "the \"rs_limits\" section of the configuration "
+                         "are not set")
+    headers = [header for header in headers if header]
+
+    # Use the same group priorities as rs_preprocess()
+    prio_conf = rs_conf.get('groups', '')
+    if config.Config.to_bool(rs_conf.get('priorities_reload', 'no')):
+        prio_conf = db.hget(PRIORITIES_KEY, 'groups') or prio_conf
+
+    # Read the epoch before the mappings, so that any change made
+    # while they are being read marks the table as out of date
+    epoch = db.get(EPOCH_KEY) or '0'
+    mappings = dict(_list_mappings(_get_storage(db, rs_conf), batch=batch))
+
+    table = _compute_table(headers, GroupPriorities(prio_conf), mappings)
+    _store_table(db, table, epoch, batch)
+
+    return len(headers), table
 
 
 # For backwards compatibility
@@ -53,6 +53,10 @@ setup(
     entry_points={
         'console_scripts': [
             'group_class = rs_limits:group_class',
+            'group_bulk = rs_limits:group_bulk',
+            'group_migrate = rs_limits:group_migrate',
+            'group_share = rs_limits:group_share',
+            'group_table = rs_limits:group_table',
         ],
     },
 )
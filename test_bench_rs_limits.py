@@ -0,0 +1,184 @@
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import unittest2
+
+import bench_rs_limits
+import rs_limits
+
+
+class TestFakeDatabase(unittest2.TestCase):
+    def test_get_mget(self):
+        db = bench_rs_limits.FakeDatabase(data={'key1': 'value1'})
+
+        self.assertEqual(db.get('key1'), 'value1')
+        self.assertEqual(db.get('key2'), None)
+        self.assertEqual(db.mget(['key2', 'key1']), [None, 'value1'])
+        self.assertEqual(db.calls, dict(get=2, mget=1))
+        self.assertEqual(db.round_trips(), 3)
+
+    def test_hget_hmget(self):
+        db = bench_rs_limits.FakeDatabase(hashes={'hash': {'f1': 'v1'}})
+
+        self.assertEqual(db.hget('hash', 'f1'), 'v1')
+        self.assertEqual(db.hmget('hash', ['f2', 'f1']), [None, 'v1'])
+        self.assertEqual(db.hmget('other', ['f1']), [None])
+
+    def test_scan_iter(self):
+        db = bench_rs_limits.FakeDatabase(data={
+            'rs-group:b': 'x', 'rs-group:a': 'y', 'other': 'z'})
+
+        self.assertEqual(list(db.scan_iter(match='rs-group:*')),
+                         ['rs-group:a', 'rs-group:b'])
+
+    def test_evalsha(self):
+        db = bench_rs_limits.FakeDatabase(
+            data={'rs-group:b': 'cls'},
+            hashes={rs_limits.GROUP_HASH: {'b': 'cls'}})
+
+        self.assertEqual(rs_limits._first_match(db, ['rs-group:a',
+                                                     'rs-group:b']),
+                         (1, 'cls'))
+        self.assertEqual(rs_limits.HashDatabase(db).first_match(
+            ['rs-group:a', 'rs-group:b']), (1, 'cls'))
+        self.assertEqual(rs_limits._first_match(db, ['rs-group:a']),
+                         (None, None))
+
+    @mock.patch.object(time, 'sleep')
+    def test_latency(self, mock_sleep):
+        db = bench_rs_limits.FakeDatabase(latency=0.5)
+
+        db.get('key')
+
+        mock_sleep.assert_called_once_with(0.5)
+
+
+class TestWorkload(unittest2.TestCase):
+    def test_mappings(self):
+        workload = bench_rs_limits.Workload(groups=4, hit=2, distinct=5,
+                                            seed=1)
+
+        self.assertEqual(len(workload.headers), 5)
+        self.assertEqual(len(workload.mappings), 5)
+        for hdr, header in enumerate(workload.headers):
+            self.assertTrue(('grp%d-2' % hdr) in workload.mappings)
+            self.assertEqual(header.count(','), 3)
+
+    def test_explicit(self):
+        explicit = bench_rs_limits.Workload(explicit=1.0, distinct=5)
+        default = bench_rs_limits.Workload(explicit=0.0, distinct=5)
+
+        for header in explicit.headers:
+            self.assertTrue(';q=' in header)
+        for header in default.headers:
+            self.assertFalse(';q=' in header)
+
+    def test_unmapped(self):
+        workload = bench_rs_limits.Workload(hit=None, distinct=5)
+
+        self.assertEqual(workload.mappings, {})
+
+    def test_next(self):
+        workload = bench_rs_limits.Workload(distinct=10, seed=1)
+
+        for i in range(100):
+            self.assertTrue(workload.next() in workload.headers)
+
+    def test_database(self):
+        workload = bench_rs_limits.Workload(distinct=2, hit=0)
+
+        keys = workload.database()
+        hash_ = workload.database('hash')
+
+        self.assertEqual(sorted(keys.data), ['rs-group:grp0-0',
+                                             'rs-group:grp1-0'])
+        self.assertEqual(sorted(hash_.hashes[rs_limits.GROUP_HASH]),
+                         ['grp0-0', 'grp1-0'])
+
+
+class TestRun(unittest2.TestCase):
+    def test_strategies(self):
+        for name, strategy in bench_rs_limits.strategies.items():
+            workload = bench_rs_limits.Workload(groups=5, hit=3,
+                                                distinct=20, seed=1)
+
+            result = bench_rs_limits.run(workload, strategy, 50, 10)
+
+            self.assertEqual(sorted(result),
+                             ['p50', 'p99', 'round_trips', 'rps'])
+            self.assertTrue(result['p50'] <= result['p99'])
+
+
+class TestGate(unittest2.TestCase):
+    def test_microbenchmarks(self):
+        for name in ('priorities', 'parse-explicit', 'parse-repose'):
+            result = bench_rs_limits.microbenchmarks[name]()
+
+            self.assertEqual(result.keys(), ['seconds'])
+
+    def test_calibrate(self):
+        self.assertEqual(bench_rs_limits._reference(
+            'a;q=0.5,b;q=0.6,c', {'c': 0.1}), ['b', 'a', 'c'])
+        self.assertTrue(bench_rs_limits.calibrate() > 0.0)
+
+    @mock.patch.dict(bench_rs_limits.microbenchmarks, {
+        'fast': mock.Mock(side_effect=[{'seconds': 2.0}, {'seconds': 9.0},
+                                       {'seconds': 1.0}]),
+        'trips': lambda: {'seconds': 3.0, 'round_trips': 1.5},
+    })
+    @mock.patch.object(bench_rs_limits, 'calibrate', return_value=2.0)
+    def test_measure(self, mock_calibrate):
+        self.assertEqual(bench_rs_limits.measure('fast', 3),
+                         {'cost': 1.0})
+        self.assertEqual(bench_rs_limits.measure('trips', 1),
+                         {'cost': 1.5, 'round_trips': 1.5})
+        self.assertEqual(mock_calibrate.call_count, 4)
+
+    def test_compare(self):
+        baseline = {'cost': 2.0, 'round_trips': 1.0}
+
+        self.assertEqual(bench_rs_limits.compare(
+            {'cost': 2.9, 'round_trips': 1.0}, baseline, 0.5), [])
+        self.assertEqual(bench_rs_limits.compare(
+            {'cost': 3.1, 'round_trips': 0.5}, baseline, 0.5),
+            ["cost 3.10 exceeds baseline 2.00 by more than 50%"])
+        self.assertEqual(bench_rs_limits.compare(
+            {'cost': 1.0, 'round_trips': 2.0}, baseline, 0.5),
+            ["round trips 2.00 exceed baseline 1.00"])
+        self.assertEqual(bench_rs_limits.compare(
+            {'cost': 1.0, 'round_trips': 2.0}, {'cost': 1.0}, 0.5),
+            ["round trips 2.00 exceed baseline 0.00"])
+
+    @mock.patch.dict(bench_rs_limits.microbenchmarks, clear=True,
+                     fast=lambda: {'seconds': 2.0})
+    @mock.patch.object(bench_rs_limits, 'calibrate', return_value=4.0)
+    def test_update_load_baselines(self, mock_calibrate):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'baselines.json')
+        try:
+            result = bench_rs_limits.update_baselines(path, 0.25)
+            loaded = bench_rs_limits.load_baselines(path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        expected = {'tolerance': 0.25, 'baselines': {'fast': {'cost': 0.5}}}
+        self.assertEqual(result, expected)
+        self.assertEqual(loaded, expected)
@@ -14,10 +14,21 @@
 #    under the License.
 
 import decimal
+import json
+import os
+import pstats
+import shutil
+import socket
 import StringIO
 import sys
+import tempfile
+import threading
+import time
 
+import eventlet
+import greenlet
 import mock
+import redis
 from turnstile import config
 from turnstile import tools
 import unittest2
@@ -25,6 +36,10 @@ import unittest2
 import rs_limits
 
 
+class TestException(Exception):
+    pass
+
+
 class TestGroupPriorities(unittest2.TestCase):
     def test_init(self):
         expected = {
@@ -32,20 +47,3241 @@ class TestGroupPriorities(unittest2.TestCase):
             "admin": 0.5555,
             "delinquent": 1,
         }
-        example = "=0.1, AdMin=0.5555, dElINQUenT=1.00000000, iNvalId=0.1a"
+        example = "=0.1, AdMin=0.5555, dElINQUenT=1.00000000, iNvalId=0.1a"
+
+        gp = rs_limits.GroupPriorities(example)
+
+        self.assertEqual(gp, expected)
+
+    def test_missing(self):
+        example = "=0.1, AdMin=0.5555, dElINQUenT=1.00000000"
+
+        gp = rs_limits.GroupPriorities(example)
+
+        self.assertEqual(gp['nobody'], 0.1)
+        self.assertEqual(gp['AdMin'], 0.1)
+        self.assertEqual(gp['admin'], 0.5555)
+
+
+class TestLuaScript(unittest2.TestCase):
+    def test_init(self):
+        script = rs_limits.LuaScript('return 1')
+
+        self.assertEqual(script.source, 'return 1')
+        self.assertEqual(script.sha,
+                         'e0e1f9fabfc9d4800c877a703b823ac0578ff8db')
+
+    def test_call(self):
+        db = mock.Mock(**{'evalsha.return_value': 'result'})
+        script = rs_limits.LuaScript('return 1')
+
+        result = script(db, ['key1', 'key2'], ['arg1'])
+
+        self.assertEqual(result, 'result')
+        db.evalsha.assert_called_once_with(script.sha, 2, 'key1', 'key2',
+                                           'arg1')
+        self.assertFalse(db.script_load.called)
+
+    def test_call_noscript(self):
+        db = mock.Mock(**{'evalsha.side_effect': [
+            redis.exceptions.NoScriptError, 'result']})
+        script = rs_limits.LuaScript('return 1')
+
+        result = script(db, ['key1'])
+
+        self.assertEqual(result, 'result')
+        db.script_load.assert_called_once_with('return 1')
+        self.assertEqual(db.evalsha.call_args_list, [
+            mock.call(script.sha, 1, 'key1'),
+            mock.call(script.sha, 1, 'key1'),
+        ])
+
+
+class TestFirstMatch(unittest2.TestCase):
+    @mock.patch.object(rs_limits, '_first_match_keys',
+                       return_value=['1', 'cls2'])
+    def test_match(self, mock_first_match_keys):
+        result = rs_limits._first_match('db', ['key1', 'key2'])
+
+        self.assertEqual(result, (1, 'cls2'))
+        mock_first_match_keys.assert_called_once_with('db', ['key1', 'key2'])
+
+    @mock.patch.object(rs_limits, '_first_match_keys', return_value=None)
+    def test_nomatch(self, mock_first_match_keys):
+        result = rs_limits._first_match('db', ['key1', 'key2'])
+
+        self.assertEqual(result, (None, None))
+
+    @mock.patch.object(rs_limits, '_first_match_keys')
+    def test_wrapper(self, mock_first_match_keys):
+        db = rs_limits.DatabaseWrapper('db')
+
+        with mock.patch.object(db, 'first_match',
+                               return_value=(0, 'cls1')) as mock_first_match:
+            result = rs_limits._first_match(db, ['key1'])
+
+        self.assertEqual(result, (0, 'cls1'))
+        mock_first_match.assert_called_once_with(['key1'])
+        self.assertFalse(mock_first_match_keys.called)
+
+
+class TestDatabaseWrapper(unittest2.TestCase):
+    def test_passthrough(self):
+        db = mock.Mock()
+        wrapper = rs_limits.DatabaseWrapper(db)
+
+        self.assertEqual(wrapper.db, db)
+        self.assertEqual(wrapper.pipeline, db.pipeline)
+
+    @mock.patch.object(rs_limits, '_first_match', return_value=(0, 'cls1'))
+    def test_first_match(self, mock_first_match):
+        wrapper = rs_limits.DatabaseWrapper('db')
+
+        result = wrapper.first_match(['key1'])
+
+        self.assertEqual(result, (0, 'cls1'))
+        mock_first_match.assert_called_once_with('db', ['key1'])
+
+
+class TestHashDatabase(unittest2.TestCase):
+    def test_init(self):
+        hdb = rs_limits.HashDatabase('db')
+
+        self.assertEqual(hdb.db, 'db')
+        self.assertEqual(hdb.name, rs_limits.GROUP_HASH)
+
+    def test_passthrough(self):
+        db = mock.Mock()
+        hdb = rs_limits.HashDatabase(db)
+
+        self.assertEqual(hdb.publish, db.publish)
+
+    def test_get(self):
+        db = mock.Mock(**{'hget.return_value': 'cls1'})
+        hdb = rs_limits.HashDatabase(db, 'hash')
+
+        self.assertEqual(hdb.get('rs-group:grp1'), 'cls1')
+        db.hget.assert_called_once_with('hash', 'grp1')
+
+    def test_mget(self):
+        db = mock.Mock(**{'hmget.return_value': ['cls1', None]})
+        hdb = rs_limits.HashDatabase(db, 'hash')
+
+        self.assertEqual(hdb.mget(['rs-group:grp1', 'rs-group:grp2']),
+                         ['cls1', None])
+        db.hmget.assert_called_once_with('hash', ['grp1', 'grp2'])
+
+    def test_set(self):
+        db = mock.Mock()
+        hdb = rs_limits.HashDatabase(db, 'hash')
+
+        hdb.set('rs-group:grp1', 'cls1')
+
+        db.hset.assert_called_once_with('hash', 'grp1', 'cls1')
+
+    def test_delete(self):
+        db = mock.Mock()
+        hdb = rs_limits.HashDatabase(db, 'hash')
+
+        hdb.delete('rs-group:grp1', 'rs-group:grp2')
+
+        db.hdel.assert_called_once_with('hash', 'grp1', 'grp2')
+
+    def test_pipeline(self):
+        db = mock.Mock()
+        hdb = rs_limits.HashDatabase(db, 'hash')
+
+        pipe = hdb.pipeline(transaction=False)
+        pipe.set('rs-group:grp1', 'cls1')
+        pipe.execute()
+
+        self.assertIsInstance(pipe, rs_limits.HashDatabase)
+        self.assertEqual(pipe.name, 'hash')
+        db.pipeline.assert_called_once_with(transaction=False)
+        db.pipeline.return_value.assert_has_calls([
+            mock.call.hset('hash', 'grp1', 'cls1'),
+            mock.call.execute(),
+        ])
+
+    def test_scan_iter(self):
+        db = mock.Mock(**{'hscan_iter.return_value': iter([
+            ('grp1', 'cls1'),
+            ('grp2', 'cls2'),
+        ])})
+        hdb = rs_limits.HashDatabase(db, 'hash')
+
+        result = list(hdb.scan_iter(match='rs-group:*', count=10))
+
+        self.assertEqual(result, ['rs-group:grp1', 'rs-group:grp2'])
+        db.hscan_iter.assert_called_once_with('hash', match='*', count=10)
+
+    @mock.patch.object(rs_limits, '_first_match_hash',
+                       return_value=['1', 'cls2'])
+    def test_first_match(self, mock_first_match_hash):
+        hdb = rs_limits.HashDatabase('db', 'hash')
+
+        result = hdb.first_match(['rs-group:grp1', 'rs-group:grp2'])
+
+        self.assertEqual(result, (1, 'cls2'))
+        mock_first_match_hash.assert_called_once_with(
+            'db', ['hash'], ['grp1', 'grp2'])
+
+    @mock.patch.object(rs_limits, '_first_match_hash', return_value=None)
+    def test_first_match_nomatch(self, mock_first_match_hash):
+        hdb = rs_limits.HashDatabase('db', 'hash')
+
+        result = hdb.first_match(['rs-group:grp1', 'rs-group:grp2'])
+
+        self.assertEqual(result, (None, None))
+
+
+class TestGetStorage(unittest2.TestCase):
+    def test_keys(self):
+        self.assertEqual(rs_limits._get_storage('db', {}), 'db')
+        self.assertEqual(rs_limits._get_storage('db', dict(storage='keys')),
+                         'db')
+
+    def test_hash(self):
+        result = rs_limits._get_storage('db', dict(storage='hash'))
+
+        self.assertIsInstance(result, rs_limits.HashDatabase)
+        self.assertEqual(result.db, 'db')
+
+
+class TestMappingCache(unittest2.TestCase):
+    def test_lookup_miss(self):
+        cache = rs_limits.MappingCache(10)
+
+        self.assertEqual(cache.lookup('key', 'default'), 'default')
+        self.assertEqual(cache.stats(), dict(size=0, hits=0, misses=1))
+
+    def test_store_lookup(self):
+        cache = rs_limits.MappingCache(10)
+
+        cache.store('key', 'value')
+        cache.store('neg', None)
+
+        self.assertEqual(cache.lookup('key', 'default'), 'value')
+        self.assertEqual(cache.lookup('neg', 'default'), None)
+        self.assertEqual(cache.stats(), dict(size=2, hits=2, misses=0))
+
+    def test_lru_eviction(self):
+        cache = rs_limits.MappingCache(2)
+
+        cache.store('key1', 'value1')
+        cache.store('key2', 'value2')
+        cache.lookup('key1')
+        cache.store('key3', 'value3')
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.lookup('key1', 'default'), 'value1')
+        self.assertEqual(cache.lookup('key2', 'default'), 'default')
+        self.assertEqual(cache.lookup('key3', 'default'), 'value3')
+
+    def test_replace(self):
+        cache = rs_limits.MappingCache(2)
+
+        cache.store('key1', 'value1')
+        cache.store('key2', 'value2')
+        cache.store('key1', 'value3')
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.lookup('key1', 'default'), 'value3')
+        self.assertEqual(cache.lookup('key2', 'default'), 'value2')
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_ttl(self, mock_time):
+        cache = rs_limits.MappingCache(10, 5)
+
+        cache.store('key', 'value')
+        mock_time.return_value = 1004.0
+        self.assertEqual(cache.lookup('key', 'default'), 'value')
+        mock_time.return_value = 1005.0
+        self.assertEqual(cache.lookup('key', 'default'), 'default')
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = rs_limits.MappingCache(10)
+        cache.store('key1', 'value1')
+        cache.store('key2', 'value2')
+
+        cache.invalidate('key1')
+        cache.invalidate('nosuch')
+
+        self.assertEqual(cache.lookup('key1', 'default'), 'default')
+        self.assertEqual(cache.lookup('key2', 'default'), 'value2')
+
+    def test_invalidate_all(self):
+        cache = rs_limits.MappingCache(10)
+        cache.store('key1', 'value1')
+        cache.store('key2', 'value2')
+
+        cache.invalidate()
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.lookup('key1', 'default'), 'default')
+        cache.store('key3', 'value3')
+        self.assertEqual(cache.lookup('key3', 'default'), 'value3')
+
+
+class TestCachingDatabase(unittest2.TestCase):
+    def test_passthrough(self):
+        db = mock.Mock()
+        cdb = rs_limits.CachingDatabase(db, rs_limits.MappingCache(10))
+
+        self.assertEqual(cdb.pipeline, db.pipeline)
+
+    def test_get(self):
+        classes = {'rs-group:grp1': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        cache = rs_limits.MappingCache(10)
+        cdb = rs_limits.CachingDatabase(db, cache)
+
+        for i in range(3):
+            self.assertEqual(cdb.get('rs-group:grp1'), 'lim_class')
+            self.assertEqual(cdb.get('rs-group:grp2'), None)
+
+        self.assertEqual(db.get.call_args_list, [
+            mock.call('rs-group:grp1'),
+            mock.call('rs-group:grp2'),
+        ])
+        self.assertEqual(cache.stats(), dict(size=2, hits=4, misses=2))
+
+    def test_mget(self):
+        db = mock.Mock(**{'mget.return_value': [None, 'cls3']})
+        cache = rs_limits.MappingCache(10)
+        cache.store('rs-group:grp2', 'cls2')
+        cdb = rs_limits.CachingDatabase(db, cache)
+
+        result = cdb.mget(['rs-group:grp1', 'rs-group:grp2',
+                           'rs-group:grp3'])
+
+        self.assertEqual(result, [None, 'cls2', 'cls3'])
+        db.mget.assert_called_once_with(['rs-group:grp1', 'rs-group:grp3'])
+        self.assertEqual(cache.lookup('rs-group:grp1', 'default'), None)
+        self.assertEqual(cache.lookup('rs-group:grp3', 'default'), 'cls3')
+
+    def test_mget_all_cached(self):
+        db = mock.Mock()
+        cache = rs_limits.MappingCache(10)
+        cache.store('rs-group:grp1', None)
+        cdb = rs_limits.CachingDatabase(db, cache)
+
+        result = cdb.mget(['rs-group:grp1'])
+
+        self.assertEqual(result, [None])
+        self.assertFalse(db.mget.called)
+
+    @mock.patch.object(rs_limits, '_first_match', return_value=(1, 'cls4'))
+    def test_first_match(self, mock_first_match):
+        cache = rs_limits.MappingCache(10)
+        cache.store('key1', None)
+        cache.store('key4', 'old4')
+        cdb = rs_limits.CachingDatabase('db', cache)
+
+        result = cdb.first_match(['key1', 'key2', 'key3', 'key4'])
+
+        self.assertEqual(result, (2, 'cls4'))
+        mock_first_match.assert_called_once_with('db', ['key2', 'key3',
+                                                        'key4'])
+        self.assertEqual(cache.lookup('key2', 'none'), None)
+        self.assertEqual(cache.lookup('key3', 'none'), 'cls4')
+        self.assertEqual(cache.lookup('key4', 'none'), 'old4')
+
+    @mock.patch.object(rs_limits, '_first_match',
+                       return_value=(None, None))
+    def test_first_match_nomatch(self, mock_first_match):
+        cache = rs_limits.MappingCache(10)
+        cdb = rs_limits.CachingDatabase('db', cache)
+
+        result = cdb.first_match(['key1', 'key2'])
+
+        self.assertEqual(result, (None, None))
+        self.assertEqual(cache.lookup('key1', 'none'), None)
+        self.assertEqual(cache.lookup('key2', 'none'), None)
+
+    def test_invalidated_during_fetch(self):
+        cache = rs_limits.MappingCache(10)
+
+        def fetch(result):
+            # The mapping changes while the request is in flight
+            def func(*args):
+                cache.invalidate('rs-group:grp1')
+                return result
+            return func
+
+        db = mock.Mock(**{
+            'get.side_effect': fetch('old'),
+            'mget.side_effect': fetch(['old']),
+        })
+        cdb = rs_limits.CachingDatabase(db, cache)
+
+        self.assertEqual(cdb.get('rs-group:grp1'), 'old')
+        self.assertEqual(cdb.mget(['rs-group:grp1']), ['old'])
+        with mock.patch.object(rs_limits, '_first_match',
+                               side_effect=fetch((0, 'old'))):
+            self.assertEqual(cdb.first_match(['rs-group:grp1']),
+                             (0, 'old'))
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.invalidations, 3)
+
+    @mock.patch.object(rs_limits, '_first_match')
+    def test_first_match_cached(self, mock_first_match):
+        cache = rs_limits.MappingCache(10)
+        cache.store('key1', None)
+        cache.store('key2', 'cls2')
+        cdb = rs_limits.CachingDatabase('db', cache)
+
+        self.assertEqual(cdb.first_match(['key1', 'key2', 'key3']),
+                         (1, 'cls2'))
+        self.assertEqual(cdb.first_match(['key1']), (None, None))
+        self.assertFalse(mock_first_match.called)
+
+
+class TestMappingSnapshot(unittest2.TestCase):
+    def test_init(self):
+        snap = rs_limits.MappingSnapshot('db')
+
+        self.assertEqual(snap.db, 'db')
+        self.assertEqual(snap.interval, 300.0)
+        self.assertEqual(snap.max_age, 900.0)
+        self.assertEqual(snap.batch, 1000)
+        self.assertEqual(snap.mappings, {})
+        self.assertEqual(snap.loaded, None)
+        self.assertEqual(snap.pending, None)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        snap = rs_limits.MappingSnapshot('db')
+
+        snap.start()
+
+        mock_spawn_n.assert_called_once_with(snap.run)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=[None, TestException])
+    @mock.patch.object(rs_limits.MappingSnapshot, 'load',
+                       side_effect=[Exception, None])
+    @mock.patch.object(rs_limits.LOG, 'exception')
+    def test_run(self, mock_exception, mock_load, mock_sleep):
+        snap = rs_limits.MappingSnapshot('db', interval=10.0)
+
+        self.assertRaises(TestException, snap.run)
+
+        self.assertEqual(mock_load.call_count, 2)
+        self.assertEqual(mock_exception.call_count, 1)
+        mock_sleep.assert_has_calls([mock.call(10.0), mock.call(10.0)])
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_load(self, mock_time):
+        data = {
+            'rs-group:grp1': 'cls1',
+            'rs-group:grp2': 'cls2',
+            'rs-group:grp3': None,
+            'rs-group:grp4': 'cls4',
+            'rs-group:grp5': 'cls5',
+        }
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter(sorted(data)),
+            'mget.side_effect': lambda keys: [data[k] for k in keys],
+        })
+        snap = rs_limits.MappingSnapshot(db, batch=2)
+        snap.mappings = {'rs-group:old': 'old'}
+
+        snap.load()
+
+        self.assertEqual(snap.mappings, {
+            'rs-group:grp1': 'cls1',
+            'rs-group:grp2': 'cls2',
+            'rs-group:grp4': 'cls4',
+            'rs-group:grp5': 'cls5',
+        })
+        self.assertEqual(snap.loaded, 1000.0)
+        db.scan_iter.assert_called_once_with(match='rs-group:*', count=2)
+        self.assertEqual(db.mget.call_args_list, [
+            mock.call(['rs-group:grp1', 'rs-group:grp2']),
+            mock.call(['rs-group:grp3', 'rs-group:grp4']),
+            mock.call(['rs-group:grp5']),
+        ])
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_load_concurrent_update(self, mock_time):
+        data = {'rs-group:grp1': 'cls1', 'rs-group:grp2': 'cls2'}
+        snap = rs_limits.MappingSnapshot(None)
+
+        def scan_iter(match, count):
+            yield 'rs-group:grp1'
+            yield 'rs-group:grp2'
+
+            # Changes announced after the SCAN has passed them by
+            data['rs-group:grp0'] = 'cls0'
+            snap.update('grp0')
+            del data['rs-group:grp2']
+            snap.update('grp2')
+
+        snap.db = mock.Mock(**{
+            'scan_iter.side_effect': scan_iter,
+            'mget.side_effect': lambda keys: [data.get(k) for k in keys],
+            'get.side_effect': lambda key: data.get(key),
+        })
+
+        snap.load()
+
+        self.assertEqual(snap.mappings, {
+            'rs-group:grp0': 'cls0',
+            'rs-group:grp1': 'cls1',
+        })
+        self.assertEqual(snap.pending, None)
+
+    def test_update(self):
+        data = {'rs-group:grp1': 'new1', 'rs-group:grp2': None}
+        db = mock.Mock(**{'get.side_effect': lambda x: data.get(x)})
+        snap = rs_limits.MappingSnapshot(db)
+        snap.mappings = {'rs-group:grp1': 'cls1', 'rs-group:grp2': 'cls2'}
+
+        snap.update('grp1')
+        snap.update('grp2')
+        snap.update('grp3')
+
+        self.assertEqual(snap.mappings, {'rs-group:grp1': 'new1'})
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_fresh(self, mock_time):
+        snap = rs_limits.MappingSnapshot('db', max_age=60.0)
+
+        self.assertFalse(snap.fresh())
+        snap.loaded = 940.0
+        self.assertTrue(snap.fresh())
+        snap.loaded = 939.0
+        self.assertFalse(snap.fresh())
+
+    def test_get_mget(self):
+        snap = rs_limits.MappingSnapshot('db')
+        snap.mappings = {'rs-group:grp1': 'cls1'}
+
+        self.assertEqual(snap.get('rs-group:grp1'), 'cls1')
+        self.assertEqual(snap.get('rs-group:grp2'), None)
+        self.assertEqual(snap.mget(['rs-group:grp2', 'rs-group:grp1']),
+                         [None, 'cls1'])
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_stats(self, mock_time):
+        snap = rs_limits.MappingSnapshot('db')
+
+        self.assertEqual(snap.stats(), dict(size=0, age=None))
+        snap.mappings = {'rs-group:grp1': 'cls1'}
+        snap.loaded = 990.0
+        self.assertEqual(snap.stats(), dict(size=1, age=10.0))
+
+
+class TestSharedSnapshot(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mappings')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_read(self):
+        rs_limits._write_mapping_file(self.path, {
+            'rs-group:grp1': 'class1',
+            'rs-group:grp3': 'class3',
+            'rs-group:grp2': 'class2',
+        })
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        self.assertTrue(snap.fresh())
+        self.assertEqual(snap.get('rs-group:grp2'), 'class2')
+        self.assertEqual(snap.get('rs-group:grp0'), None)
+        self.assertEqual(snap.mget(['rs-group:grp4', 'rs-group:grp3',
+                                    'rs-group:grp1']),
+                         [None, 'class3', 'class1'])
+        self.assertEqual(snap.stats()['size'], 3)
+        self.assertEqual(os.listdir(self.tmpdir), ['mappings'])
+
+    def test_empty(self):
+        rs_limits._write_mapping_file(self.path, {})
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        self.assertTrue(snap.fresh())
+        self.assertEqual(snap.mget(['rs-group:grp1']), [None])
+
+    def test_missing(self):
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        self.assertFalse(snap.fresh())
+        self.assertEqual(snap.get('rs-group:grp1'), None)
+        self.assertEqual(snap.mget(['rs-group:grp1']), [None])
+        self.assertEqual(snap.stats(), dict(size=0, age=None))
+
+    def test_corrupt(self):
+        with open(self.path, 'wb') as f:
+            f.write('garbage')
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        self.assertFalse(snap.fresh())
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_stale(self, mock_time):
+        rs_limits._write_mapping_file(self.path, {'rs-group:grp1': 'c'})
+        snap = rs_limits.SharedSnapshot(self.path, max_age=60.0)
+
+        self.assertTrue(snap.fresh())
+        mock_time.return_value = 1061.0
+        self.assertFalse(snap.fresh())
+
+    def test_replaced(self):
+        rs_limits._write_mapping_file(self.path, {'rs-group:grp1': 'old'})
+        snap = rs_limits.SharedSnapshot(self.path, check=0.0)
+        self.assertEqual(snap.get('rs-group:grp1'), 'old')
+
+        rs_limits._write_mapping_file(self.path, {'rs-group:grp1': 'new',
+                                                  'rs-group:grp2': 'c'})
+
+        self.assertEqual(snap.get('rs-group:grp1'), 'new')
+        self.assertEqual(snap.stats()['size'], 2)
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_open_view(self, mock_time):
+        rs_limits._write_mapping_file(self.path, {'rs-group:grp1': 'cls1'})
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        view = snap._open()
+
+        # The map is paired with its own count and write time
+        map_, count, written = view
+        self.assertEqual(count, 1)
+        self.assertEqual(written, 1000.0)
+        self.assertEqual(snap._find(map_, count, 'rs-group:grp1'), 'cls1')
+        self.assertTrue(snap._open() is view)
+
+    def test_replaced_check_interval(self):
+        rs_limits._write_mapping_file(self.path, {'rs-group:grp1': 'old'})
+        snap = rs_limits.SharedSnapshot(self.path, check=60.0)
+        self.assertEqual(snap.get('rs-group:grp1'), 'old')
+
+        rs_limits._write_mapping_file(self.path, {'rs-group:grp1': 'new'})
+
+        self.assertEqual(snap.get('rs-group:grp1'), 'old')
+
+    def test_acquire(self):
+        snap1 = rs_limits.SharedSnapshot(self.path)
+        snap2 = rs_limits.SharedSnapshot(self.path)
+
+        self.assertTrue(snap1.acquire())
+        self.assertTrue(snap1.acquire())
+        self.assertFalse(snap2.acquire())
+
+        snap1.lock.close()
+
+        self.assertTrue(snap2.acquire())
+
+    def test_load(self):
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter(['rs-group:grp1']),
+            'mget.return_value': ['class1'],
+        })
+        snap = rs_limits.SharedSnapshot(self.path, db)
+
+        snap.load()
+
+        reader = rs_limits.SharedSnapshot(self.path)
+        self.assertEqual(reader.get('rs-group:grp1'), 'class1')
+
+    def test_update(self):
+        db = mock.Mock(**{'get.return_value': 'class2'})
+        snap = rs_limits.SharedSnapshot(self.path, db)
+        snap.acquire()
+        snap.loaded = 1000.0
+        snap.mappings = {'rs-group:grp1': 'class1'}
+
+        snap.update('grp2')
+
+        reader = rs_limits.SharedSnapshot(self.path)
+        self.assertEqual(reader.mget(['rs-group:grp1', 'rs-group:grp2']),
+                         ['class1', 'class2'])
+
+    def test_update_reader(self):
+        db = mock.Mock()
+        snap = rs_limits.SharedSnapshot(self.path, db)
+
+        snap.update('grp1')
+
+        self.assertFalse(db.get.called)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_update_first_load(self):
+        data = {'rs-group:grp1': 'class1'}
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        def scan_iter(match, count):
+            yield 'rs-group:grp1'
+
+            # Announced after the SCAN passed it by, before the file
+            # has ever been written
+            data['rs-group:grp0'] = 'class0'
+            snap.update('grp0')
+            self.assertFalse(os.path.exists(self.path))
+
+        snap.db = mock.Mock(**{
+            'scan_iter.side_effect': scan_iter,
+            'mget.side_effect': lambda keys: [data.get(k) for k in keys],
+            'get.side_effect': lambda key: data.get(key),
+        })
+        snap.acquire()
+
+        snap.load()
+
+        reader = rs_limits.SharedSnapshot(self.path)
+        self.assertEqual(reader.mget(['rs-group:grp0', 'rs-group:grp1']),
+                         ['class0', 'class1'])
+
+    @mock.patch.object(rs_limits.SharedSnapshot, 'load')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'update')
+    def test_invalidate(self, mock_update, mock_load):
+        snap = rs_limits.SharedSnapshot(self.path, 'db')
+
+        snap.invalidate('grp1')
+        mock_update.assert_called_once_with('grp1')
+
+        # Nothing to reload before the first load
+        snap.invalidate()
+        self.assertFalse(mock_load.called)
+
+        snap.loaded = 1000.0
+        snap.invalidate()
+        mock_load.assert_called_once_with()
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        snap = rs_limits.SharedSnapshot(self.path, 'db')
+
+        snap.start()
+
+        mock_spawn_n.assert_called_once_with(snap.run)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start_reader(self, mock_spawn_n):
+        snap = rs_limits.SharedSnapshot(self.path)
+
+        snap.start()
+
+        self.assertFalse(mock_spawn_n.called)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=TestException)
+    @mock.patch.object(rs_limits.SharedSnapshot, 'acquire',
+                       return_value=False)
+    @mock.patch.object(rs_limits.SharedSnapshot, 'load')
+    def test_run_not_writer(self, mock_load, mock_acquire, mock_sleep):
+        snap = rs_limits.SharedSnapshot(self.path, 'db', interval=10.0)
+
+        self.assertRaises(TestException, snap.run)
+
+        self.assertFalse(mock_load.called)
+        mock_sleep.assert_called_once_with(10.0)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=TestException)
+    @mock.patch.object(rs_limits.SharedSnapshot, 'acquire',
+                       return_value=True)
+    @mock.patch.object(rs_limits.SharedSnapshot, 'load')
+    def test_run_writer(self, mock_load, mock_acquire, mock_sleep):
+        snap = rs_limits.SharedSnapshot(self.path, 'db', interval=10.0)
+
+        self.assertRaises(TestException, snap.run)
+
+        mock_load.assert_called_once_with()
+
+
+class TestBloomFilter(unittest2.TestCase):
+    def test_sizing(self):
+        bloom = rs_limits.BloomFilter(1000, 0.01)
+
+        self.assertEqual(bloom.bits, 9586)
+        self.assertEqual(bloom.hashes, 7)
+        self.assertEqual(len(bloom.array), 1199)
+
+    def test_membership(self):
+        bloom = rs_limits.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('grp%d' % i)
+
+        for i in range(1000):
+            self.assertTrue(('grp%d' % i) in bloom)
+        false_positives = len([i for i in range(1000, 11000)
+                               if ('grp%d' % i) in bloom])
+        self.assertLess(false_positives, 200)
+
+    def test_unicode(self):
+        bloom = rs_limits.BloomFilter(10)
+
+        bloom.add(u'gr\xfcp')
+
+        self.assertTrue(u'gr\xfcp' in bloom)
+        self.assertTrue(u'gr\xfcp'.encode('utf-8') in bloom)
+
+
+class TestGroupFilter(unittest2.TestCase):
+    def test_init(self):
+        group_filter = rs_limits.GroupFilter('db')
+
+        self.assertEqual(group_filter.members, None)
+        self.assertEqual(group_filter.filter(('grp1', 'grp2')),
+                         ('grp1', 'grp2'))
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        group_filter = rs_limits.GroupFilter('db')
+
+        group_filter.start()
+
+        mock_spawn_n.assert_called_once_with(group_filter.run)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=TestException)
+    @mock.patch.object(rs_limits.GroupFilter, 'load',
+                       side_effect=TestException)
+    def test_run(self, mock_load, mock_sleep):
+        group_filter = rs_limits.GroupFilter('db', interval=10.0)
+
+        self.assertRaises(TestException, group_filter.run)
+
+        mock_load.assert_called_once_with()
+        mock_sleep.assert_called_once_with(10.0)
+
+    def test_load(self):
+        for kind in ('set', 'bloom'):
+            db = mock.Mock(**{'scan_iter.return_value': iter([
+                'rs-group:grp1', 'rs-group:grp3'])})
+            group_filter = rs_limits.GroupFilter(db, kind, batch=10)
+
+            group_filter.load()
+
+            self.assertEqual(group_filter.count, 2)
+            self.assertEqual(group_filter.filter(['grp1', 'grp2', 'grp3']),
+                             ['grp1', 'grp3'])
+            db.scan_iter.assert_called_once_with(match='rs-group:*',
+                                                 count=10)
+
+    def test_load_bloom(self):
+        db = mock.Mock(**{'scan_iter.return_value': iter([])})
+        group_filter = rs_limits.GroupFilter(db, 'bloom', error_rate=0.01)
+
+        group_filter.load()
+
+        self.assertIsInstance(group_filter.members, rs_limits.BloomFilter)
+
+    def test_load_concurrent_update(self):
+        group_filter = rs_limits.GroupFilter(None)
+
+        def scan_iter(**kwargs):
+            yield 'rs-group:grp1'
+            group_filter.update('grp2')
+
+        group_filter.db = mock.Mock(**{'scan_iter.side_effect': scan_iter})
+
+        group_filter.load()
+
+        self.assertEqual(group_filter.members, set(['grp1', 'grp2']))
+        self.assertEqual(group_filter.pending, None)
+
+    def test_update(self):
+        group_filter = rs_limits.GroupFilter('db')
+        group_filter.update('grp1')
+        group_filter.members = set()
+
+        group_filter.update('grp2')
+
+        self.assertEqual(group_filter.members, set(['grp2']))
+
+
+class TestMappingListener(unittest2.TestCase):
+    def test_init(self):
+        listener = rs_limits.MappingListener('state', 'db')
+
+        self.assertEqual(listener.state, 'state')
+        self.assertEqual(listener.db, 'db')
+        self.assertEqual(listener.channel, rs_limits.GROUP_CHANNEL)
+        self.assertEqual(listener.retry, 5.0)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        listener = rs_limits.MappingListener('state', 'db')
+
+        listener.start()
+
+        mock_spawn_n.assert_called_once_with(listener.run)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=[None, TestException])
+    @mock.patch.object(rs_limits.MappingListener, 'listen',
+                       side_effect=[Exception, None])
+    @mock.patch.object(rs_limits.LOG, 'exception')
+    def test_run(self, mock_exception, mock_listen, mock_sleep):
+        listener = rs_limits.MappingListener('state', 'db', retry=2.0)
+
+        self.assertRaises(TestException, listener.run)
+
+        self.assertEqual(mock_listen.call_count, 2)
+        self.assertEqual(mock_exception.call_count, 1)
+        mock_sleep.assert_has_calls([mock.call(2.0), mock.call(2.0)])
+
+    def test_listen(self):
+        pubsub = mock.Mock(**{'listen.return_value': [
+            dict(type='subscribe', channel='chan', data=1),
+            dict(type='message', channel='other', data='grp1'),
+            dict(type='message', channel='chan', data='grp2'),
+            dict(type='message', channel='chan', data='grp3'),
+        ]})
+        db = mock.Mock(**{'pubsub.return_value': pubsub})
+        state = mock.Mock()
+        listener = rs_limits.MappingListener(state, db, 'chan')
+
+        listener.listen()
+
+        pubsub.subscribe.assert_called_once_with('chan')
+        self.assertEqual(state.invalidate.call_args_list, [
+            mock.call(),
+            mock.call('grp2'),
+            mock.call('grp3'),
+        ])
+        self.assertTrue(listener.subscribed.ready())
+
+        # Resubscribing must not send the event again
+        listener.listen()
+
+
+class TestPriorityWatcher(unittest2.TestCase):
+    def test_init(self):
+        watcher = rs_limits.PriorityWatcher('db')
+
+        self.assertEqual(watcher.db, 'db')
+        self.assertEqual(watcher.interval, 30.0)
+        self.assertEqual(watcher.version, None)
+        self.assertEqual(watcher.prios, None)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        watcher = rs_limits.PriorityWatcher('db')
+
+        watcher.start()
+
+        mock_spawn_n.assert_called_once_with(watcher.run)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=[None, TestException])
+    @mock.patch.object(rs_limits.PriorityWatcher, 'check',
+                       side_effect=[Exception, None])
+    @mock.patch.object(rs_limits.LOG, 'exception')
+    def test_run(self, mock_exception, mock_check, mock_sleep):
+        watcher = rs_limits.PriorityWatcher('db', interval=2.0)
+
+        self.assertRaises(TestException, watcher.run)
+
+        self.assertEqual(mock_check.call_count, 2)
+        self.assertEqual(mock_exception.call_count, 1)
+        mock_sleep.assert_has_calls([mock.call(2.0), mock.call(2.0)])
+
+    def test_check_unchanged(self):
+        db = mock.Mock(**{'hget.return_value': '3'})
+        watcher = rs_limits.PriorityWatcher(db)
+        watcher.version = '3'
+
+        result = watcher.check()
+
+        self.assertEqual(result, False)
+        db.hget.assert_called_once_with(rs_limits.PRIORITIES_KEY, 'version')
+        self.assertFalse(db.hmget.called)
+
+    @mock.patch.object(rs_limits.LOG, 'info')
+    def test_check_changed(self, mock_info):
+        db = mock.Mock(**{
+            'hget.return_value': '3',
+            'hmget.return_value': ['=0.2,admin=0.5', '4'],
+        })
+        watcher = rs_limits.PriorityWatcher(db)
+
+        result = watcher.check()
+
+        self.assertEqual(result, True)
+        db.hmget.assert_called_once_with(rs_limits.PRIORITIES_KEY,
+                                         ['groups', 'version'])
+        self.assertEqual(watcher.version, '4')
+        self.assertEqual(watcher.prios, {'': 0.2, 'admin': 0.5})
+        self.assertEqual(watcher.prios.conf_value, '=0.2,admin=0.5')
+
+    @mock.patch.object(rs_limits.LOG, 'info')
+    def test_check_deleted(self, mock_info):
+        db = mock.Mock(**{
+            'hget.return_value': '5',
+            'hmget.return_value': [None, '5'],
+        })
+        watcher = rs_limits.PriorityWatcher(db)
+        watcher.version = '4'
+        watcher.prios = rs_limits.GroupPriorities('admin=0.5')
+
+        result = watcher.check()
+
+        self.assertEqual(result, True)
+        self.assertEqual(watcher.version, '5')
+        self.assertEqual(watcher.prios, None)
+
+    def test_get_prio_conf(self):
+        watcher = rs_limits.PriorityWatcher('db')
+
+        self.assertEqual(watcher.get_prio_conf('admin=0.5'), 'admin=0.5')
+
+        watcher.prios = rs_limits.GroupPriorities('admin=0.7')
+
+        self.assertEqual(watcher.get_prio_conf('admin=0.5'), 'admin=0.7')
+
+
+class TestResolutionTable(unittest2.TestCase):
+    def test_init(self):
+        table = rs_limits.ResolutionTable('db')
+
+        self.assertEqual(table.db, 'db')
+        self.assertEqual(table.interval, 300.0)
+        self.assertEqual(table.version, None)
+        self.assertEqual(table.entries, None)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        table = rs_limits.ResolutionTable('db')
+
+        table.start()
+
+        mock_spawn_n.assert_called_once_with(table.run)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=[None, TestException])
+    @mock.patch.object(rs_limits.ResolutionTable, 'check',
+                       side_effect=[Exception, None])
+    @mock.patch.object(rs_limits.LOG, 'exception')
+    def test_run(self, mock_exception, mock_check, mock_sleep):
+        table = rs_limits.ResolutionTable('db', interval=2.0)
+
+        self.assertRaises(TestException, table.run)
+
+        self.assertEqual(mock_check.call_count, 2)
+        self.assertEqual(mock_exception.call_count, 1)
+        mock_sleep.assert_has_calls([mock.call(2.0), mock.call(2.0)])
+
+    @mock.patch.object(rs_limits.LOG, 'info')
+    def test_check_load(self, mock_info):
+        db = mock.Mock(**{
+            'hmget.return_value': ['2', '0'],
+            'get.return_value': None,
+            'hgetall.return_value': {'grp1,grp2': 'cls1', 'grp3': ''},
+        })
+        table = rs_limits.ResolutionTable(db)
+
+        result = table.check()
+
+        self.assertEqual(result, True)
+        db.hmget.assert_called_once_with(rs_limits.TABLE_INFO_KEY,
+                                         ['version', 'epoch'])
+        db.get.assert_called_once_with(rs_limits.EPOCH_KEY)
+        db.hgetall.assert_called_once_with(rs_limits.TABLE_KEY)
+        self.assertEqual(table.version, '2')
+        self.assertEqual(table.entries, {
+            ('grp1', 'grp2'): 'cls1',
+            ('grp3',): None,
+        })
+
+    def test_check_unchanged(self):
+        db = mock.Mock(**{
+            'hmget.return_value': ['2', '5'],
+            'get.return_value': '5',
+        })
+        table = rs_limits.ResolutionTable(db)
+        table.version = '2'
+        table.entries = {}
+
+        result = table.check()
+
+        self.assertEqual(result, False)
+        self.assertFalse(db.hgetall.called)
+        self.assertEqual(table.entries, {})
+
+    @mock.patch.object(rs_limits.LOG, 'info')
+    def test_check_out_of_date(self, mock_info):
+        db = mock.Mock(**{
+            'hmget.return_value': ['2', '5'],
+            'get.return_value': '6',
+        })
+        table = rs_limits.ResolutionTable(db)
+        table.version = '2'
+        table.entries = {}
+
+        result = table.check()
+
+        self.assertEqual(result, False)
+        self.assertFalse(db.hgetall.called)
+        self.assertEqual(table.version, None)
+        self.assertEqual(table.entries, None)
+
+    def test_check_missing(self):
+        db = mock.Mock(**{
+            'hmget.return_value': [None, None],
+            'get.return_value': None,
+        })
+        table = rs_limits.ResolutionTable(db)
+
+        result = table.check()
+
+        self.assertEqual(result, False)
+        self.assertEqual(table.entries, None)
+
+    def test_lookup(self):
+        table = rs_limits.ResolutionTable('db')
+
+        self.assertIs(table.lookup(['grp1']), rs_limits._unresolved)
+
+        table.entries = {('grp1', 'grp2'): 'cls1', ('grp3',): None}
+
+        self.assertEqual(table.lookup(['grp1', 'grp2']), 'cls1')
+        self.assertEqual(table.lookup(['grp3']), None)
+        self.assertIs(table.lookup(['grp2', 'grp1']), rs_limits._unresolved)
+
+    def test_invalidate(self):
+        table = rs_limits.ResolutionTable('db')
+        table.entries = {
+            ('grp1', 'grp2'): 'cls1',
+            ('grp3',): None,
+            ('grp2',): 'cls1',
+        }
+
+        table.invalidate('grp2')
+
+        self.assertEqual(table.entries, {('grp3',): None})
+
+    def test_invalidate_unloaded(self):
+        table = rs_limits.ResolutionTable('db')
+
+        table.invalidate('grp2')
+
+        self.assertEqual(table.entries, None)
+
+
+class TestCircuitBreaker(unittest2.TestCase):
+    def test_init(self):
+        breaker = rs_limits.CircuitBreaker()
+
+        self.assertEqual(breaker.threshold, 5)
+        self.assertEqual(breaker.reset, 30.0)
+        self.assertEqual(breaker.stats(), dict(
+            state='closed', failures=0, trips=0, fallbacks=0))
+
+    def test_trip(self):
+        breaker = rs_limits.CircuitBreaker(threshold=3)
+
+        self.assertFalse(breaker.failure())
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failure())
+
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats(), dict(
+            state='open', failures=3, trips=1, fallbacks=0))
+
+    def test_success_resets(self):
+        breaker = rs_limits.CircuitBreaker(threshold=2)
+
+        breaker.failure()
+        breaker.success()
+
+        self.assertFalse(breaker.failure())
+        self.assertEqual(breaker.state, 'closed')
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_trial_success(self, mock_time):
+        breaker = rs_limits.CircuitBreaker(threshold=1, reset=10.0)
+        breaker.failure()
+
+        mock_time.return_value = 1009.0
+        self.assertFalse(breaker.allow())
+        mock_time.return_value = 1010.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertFalse(breaker.allow())
+
+        breaker.success()
+
+        self.assertEqual(breaker.stats(), dict(
+            state='closed', failures=0, trips=1, fallbacks=0))
+        self.assertTrue(breaker.allow())
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_trial_failure(self, mock_time):
+        breaker = rs_limits.CircuitBreaker(threshold=3, reset=10.0)
+        for i in range(3):
+            breaker.failure()
+        mock_time.return_value = 1010.0
+        breaker.allow()
+
+        self.assertTrue(breaker.failure())
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.opened, 1010.0)
+        self.assertEqual(breaker.trips, 2)
+        self.assertFalse(breaker.allow())
+
+    def test_fallback(self):
+        breaker = rs_limits.CircuitBreaker()
+
+        breaker.fallback()
+        breaker.fallback()
+
+        self.assertEqual(breaker.stats()['fallbacks'], 2)
+
+
+class TestSingleFlight(unittest2.TestCase):
+    @mock.patch.object(rs_limits.event, 'Event')
+    @mock.patch.object(threading, 'Event')
+    def test_single(self, mock_Event, mock_GreenEvent):
+        flights = rs_limits.SingleFlight()
+        func = mock.Mock(return_value='result')
+
+        result = flights.do('key', func, 1, 2, a=3)
+
+        # Uncontended calls don't need an event
+        self.assertFalse(mock_Event.called)
+        self.assertFalse(mock_GreenEvent.called)
+
+        self.assertEqual(result, ('result', False))
+        func.assert_called_once_with(1, 2, a=3)
+        self.assertEqual(flights.flights, {})
+        self.assertEqual(flights.coalesced, 0)
+
+    def test_green(self):
+        flights = rs_limits.SingleFlight()
+        calls = []
+
+        def func(value):
+            calls.append(value)
+            eventlet.sleep(0.01)
+            return value
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(lambda v: flights.do('key', func, v),
+                                 [1, 2, 3]))
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [(1, False), (1, True), (1, True)])
+        self.assertEqual(flights.flights, {})
+        self.assertEqual(flights.coalesced, 2)
+
+    def test_green_distinct_keys(self):
+        flights = rs_limits.SingleFlight()
+
+        def func(value):
+            eventlet.sleep(0.01)
+            return value
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(lambda v: flights.do(v, func, v), [1, 2]))
+
+        self.assertEqual(results, [(1, False), (2, False)])
+
+    def test_native(self):
+        flights = rs_limits.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def func():
+            started.set()
+            release.wait()
+            return 'result'
+
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('key', func)))
+        leader.start()
+        started.wait()
+        waiter = threading.Thread(
+            target=lambda: results.append(flights.do('key', func)))
+        waiter.start()
+        while not flights.coalesced:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        waiter.join()
+
+        self.assertEqual(sorted(results), [('result', False),
+                                           ('result', True)])
+
+    def test_exception(self):
+        flights = rs_limits.SingleFlight()
+
+        def func():
+            eventlet.sleep(0.01)
+            raise TestException()
+
+        def call():
+            try:
+                flights.do('key', func)
+            except TestException:
+                return 'raised'
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(lambda v: call(), [1, 2]))
+
+        self.assertEqual(results, ['raised', 'raised'])
+        self.assertEqual(flights.flights, {})
+
+
+class TestMemoryMetrics(unittest2.TestCase):
+    def test_incr(self):
+        metrics = rs_limits.MemoryMetrics()
+
+        metrics.incr('spam')
+        metrics.incr('spam', 2)
+        metrics.incr('eggs')
+
+        self.assertEqual(metrics.stats(), {
+            'counters': dict(spam=3, eggs=1),
+            'distributions': {},
+        })
+
+    def test_observe(self):
+        metrics = rs_limits.MemoryMetrics()
+
+        for value in (0, 1, 1, 3, 2000):
+            metrics.observe('spam', value)
+
+        dist = metrics.stats()['distributions']['spam']
+        self.assertEqual(dist['count'], 5)
+        self.assertEqual(dist['sum'], 2005)
+        self.assertEqual(dist['min'], 0)
+        self.assertEqual(dist['max'], 2000)
+        buckets = dict(dist['buckets'])
+        self.assertEqual(buckets[0], 1)
+        self.assertEqual(buckets[1], 2)
+        self.assertEqual(buckets[5], 1)
+        self.assertEqual(buckets[None], 1)
+        self.assertEqual(sum(buckets.values()), 5)
+
+    def test_timing(self):
+        metrics = rs_limits.MemoryMetrics()
+
+        metrics.timing('spam', 0.0015)
+
+        dist = metrics.stats()['distributions']['spam']
+        self.assertAlmostEqual(dist['sum'], 1.5)
+        self.assertEqual(dict(dist['buckets'])[2], 1)
+
+
+class TestStatsdMetrics(unittest2.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.metrics = rs_limits.StatsdMetrics(dict(
+            statsd_host='127.0.0.1',
+            statsd_port=str(self.server.getsockname()[1]),
+            statsd_prefix='test',
+        ))
+
+    def tearDown(self):
+        self.server.close()
+        self.metrics.sock.close()
+
+    def test_init_defaults(self):
+        metrics = rs_limits.StatsdMetrics()
+
+        self.assertEqual(metrics.address, ('localhost', 8125))
+        self.assertEqual(metrics.prefix, 'rs_limits')
+        metrics.sock.close()
+
+    def test_incr(self):
+        self.metrics.incr('spam', 2)
+
+        self.assertEqual(self.server.recv(1024), 'test.spam:2|c')
+
+    def test_observe(self):
+        self.metrics.observe('spam', 3)
+
+        self.assertEqual(self.server.recv(1024), 'test.spam:3|h')
+
+    def test_timing(self):
+        self.metrics.timing('spam', 0.0015)
+
+        self.assertEqual(self.server.recv(1024), 'test.spam:1.500|ms')
+
+    def test_error(self):
+        self.metrics.sock = mock.Mock(**{'sendto.side_effect': socket.error})
+
+        # Checking that no exceptions are raised
+        self.metrics.incr('spam')
+
+
+class TestInstrumentedDatabase(unittest2.TestCase):
+    @mock.patch('time.time', side_effect=[1.0, 1.5])
+    def test_instrumented(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'value'})
+        metrics = mock.Mock()
+        idb = rs_limits.InstrumentedDatabase(db, metrics)
+
+        result = idb.get('key')
+
+        self.assertEqual(result, 'value')
+        db.get.assert_called_once_with('key')
+        self.assertEqual(idb.lookups, 1)
+        metrics.timing.assert_called_once_with('redis.get', 0.5)
+
+    @mock.patch('time.time', side_effect=[1.0, 1.5])
+    def test_instrumented_error(self, mock_time):
+        db = mock.Mock(**{'mget.side_effect': TestException})
+        metrics = mock.Mock()
+        idb = rs_limits.InstrumentedDatabase(db, metrics)
+
+        self.assertRaises(TestException, idb.mget, ['key'])
+        self.assertEqual(idb.lookups, 1)
+        metrics.timing.assert_called_once_with('redis.mget', 0.5)
+
+    def test_uninstrumented(self):
+        db = mock.Mock()
+        metrics = mock.Mock()
+        idb = rs_limits.InstrumentedDatabase(db, metrics)
+
+        self.assertEqual(idb.publish, db.publish)
+        self.assertEqual(idb.lookups, 0)
+
+    def test_first_match(self):
+        db = mock.Mock(**{'evalsha.return_value': [0, 'cls1']})
+        metrics = mock.Mock()
+        idb = rs_limits.InstrumentedDatabase(db, metrics)
+
+        result = rs_limits._first_match(idb, ['key1'])
+
+        self.assertEqual(result, (0, 'cls1'))
+        self.assertEqual(idb.lookups, 1)
+        self.assertEqual(metrics.timing.call_args[0][0], 'redis.evalsha')
+
+
+class TestStages(unittest2.TestCase):
+    @mock.patch('time.time', side_effect=[1000.0, 1000.5, 1002.0])
+    def test_mark(self, mock_time):
+        stages = rs_limits._Stages()
+
+        stages.mark('stage1')
+        stages.mark('stage2')
+
+        self.assertEqual(stages.times, [('stage1', 0.5), ('stage2', 1.5)])
+
+
+class TestProfiler(unittest2.TestCase):
+    def test_init(self):
+        profiler = rs_limits.Profiler()
+
+        self.assertEqual(profiler.rate, 1000)
+        self.assertEqual(profiler.path, None)
+        self.assertEqual(profiler.interval, 60.0)
+        self.assertEqual(profiler.cprofile, False)
+        self.assertEqual(profiler.calls, 0)
+        self.assertEqual(profiler.samples, 0)
+        self.assertEqual(profiler.stages, {})
+        self.assertEqual(profiler.stats, None)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        profiler = rs_limits.Profiler(path='/tmp/profile')
+
+        profiler.start()
+
+        mock_spawn_n.assert_called_once_with(profiler.run)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start_nopath(self, mock_spawn_n):
+        profiler = rs_limits.Profiler()
+
+        profiler.start()
+
+        self.assertFalse(mock_spawn_n.called)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=[None, None,
+                                                       TestException])
+    @mock.patch.object(rs_limits.Profiler, 'dump',
+                       side_effect=[Exception, None])
+    @mock.patch.object(rs_limits.LOG, 'exception')
+    def test_run(self, mock_exception, mock_dump, mock_sleep):
+        profiler = rs_limits.Profiler(path='/tmp/profile', interval=2.0)
+
+        self.assertRaises(TestException, profiler.run)
+
+        self.assertEqual(mock_dump.call_count, 2)
+        self.assertEqual(mock_exception.call_count, 1)
+        mock_sleep.assert_has_calls([mock.call(2.0)] * 3)
+
+    def test_sample(self):
+        profiler = rs_limits.Profiler(rate=3)
+
+        result = [profiler.sample() for i in range(7)]
+
+        self.assertEqual(result, [False, False, True, False, False, True,
+                                  False])
+        self.assertEqual(profiler.calls, 7)
+
+    def test_profile_stages(self):
+        def func(arg, stages):
+            stages.mark('stage1')
+            stages.mark('stage2')
+            return arg
+
+        profiler = rs_limits.Profiler()
+
+        result = profiler.profile(func, 'arg')
+
+        self.assertEqual(result, 'arg')
+        self.assertEqual(profiler.samples, 1)
+        self.assertEqual(sorted(profiler.stages), ['stage1', 'stage2'])
+        self.assertEqual(profiler.stages['stage1'][0], 1)
+
+    def test_profile_stages_failure(self):
+        def func(stages):
+            stages.mark('stage1')
+            raise TestException()
+
+        profiler = rs_limits.Profiler()
+
+        self.assertRaises(TestException, profiler.profile, func)
+        self.assertEqual(profiler.samples, 1)
+        self.assertEqual(profiler.stages['stage1'][0], 1)
+
+    def test_profile_cprofile(self):
+        def func(arg):
+            return arg
+
+        profiler = rs_limits.Profiler(cprofile=True)
+
+        first = profiler.profile(func, 'arg1')
+        second = profiler.profile(func, 'arg2')
+
+        self.assertEqual((first, second), ('arg1', 'arg2'))
+        self.assertEqual(profiler.samples, 2)
+        self.assertIsInstance(profiler.stats, pstats.Stats)
+        self.assertEqual(profiler.active, False)
+        calls = [value[1] for key, value in profiler.stats.stats.items()
+                 if key[2] == 'func']
+        self.assertEqual(calls, [2])
+
+    def test_profile_cprofile_active(self):
+        profiler = rs_limits.Profiler(cprofile=True)
+        profiler.active = True
+
+        result = profiler.profile(lambda x: x, 'arg')
+
+        self.assertEqual(result, 'arg')
+        self.assertEqual(profiler.samples, 0)
+        self.assertEqual(profiler.stats, None)
+
+    def test_record(self):
+        profiler = rs_limits.Profiler()
+
+        profiler.record([('stage1', 0.5), ('stage2', 0.25)])
+        profiler.record([('stage1', 1.5)])
+
+        self.assertEqual(profiler.samples, 2)
+        self.assertEqual(profiler.stages, {
+            'stage1': [2, 2.0, 1.5],
+            'stage2': [1, 0.25, 0.25],
+        })
+
+    def test_summary(self):
+        profiler = rs_limits.Profiler()
+        profiler.calls = 2000
+        profiler.record([('lookup', 0.002), ('parse', 0.0005)])
+        profiler.record([('lookup', 0.001)])
+
+        result = profiler.summary()
+
+        self.assertEqual(result.split('\n'), [
+            'rs_preprocess() profile: 2 of 2000 calls sampled',
+            'stage             calls   total (ms)  mean (us)   max (us)',
+            'lookup                2        3.000     1500.0     2000.0',
+            'parse                 1        0.500      500.0      500.0',
+            '',
+        ])
+
+    def test_dump_stages(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'profile')
+        profiler = rs_limits.Profiler(path=path)
+        profiler.record([('lookup', 0.002)])
+
+        profiler.dump()
+
+        with open(path) as f:
+            self.assertEqual(f.read(), profiler.summary())
+        self.assertEqual(os.listdir(tmpdir), ['profile'])
+
+    @mock.patch.object(os, 'getpid', return_value=1234)
+    @mock.patch.object(os, 'rename')
+    def test_dump_per_process(self, mock_rename, mock_getpid):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'profile')
+        profiler = rs_limits.Profiler(path=path)
+
+        profiler.dump()
+
+        mock_rename.assert_called_once_with(path + '.1234.tmp', path)
+
+    def test_dump_cprofile(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'profile')
+        profiler = rs_limits.Profiler(path=path, cprofile=True)
+
+        # Nothing to write yet
+        profiler.dump()
+
+        self.assertEqual(os.listdir(tmpdir), [])
+
+        profiler.profile(len, 'arg')
+        profiler.dump()
+
+        self.assertEqual(os.listdir(tmpdir), ['profile'])
+        self.assertIsInstance(pstats.Stats(path), pstats.Stats)
+
+
+class TestReplicaDatabase(unittest2.TestCase):
+    def test_routed(self):
+        primary = mock.Mock()
+        replica = mock.Mock(**{'get.return_value': 'cls1'})
+        db = rs_limits.ReplicaDatabase(primary, replica)
+
+        self.assertEqual(db.get('rs-group:grp1'), 'cls1')
+        replica.get.assert_called_once_with('rs-group:grp1')
+        self.assertFalse(primary.get.called)
+
+    def test_not_routed(self):
+        primary = mock.Mock()
+        replica = mock.Mock()
+        db = rs_limits.ReplicaDatabase(primary, replica)
+
+        db.set('rs-group:grp1', 'cls1')
+        db.pubsub()
+
+        primary.set.assert_called_once_with('rs-group:grp1', 'cls1')
+        primary.pubsub.assert_called_once_with()
+        self.assertFalse(replica.method_calls)
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_fallback(self, mock_time):
+        primary = mock.Mock(**{'mget.return_value': ['cls1']})
+        replica = mock.Mock(**{
+            'mget.side_effect': redis.exceptions.ConnectionError,
+        })
+        db = rs_limits.ReplicaDatabase(primary, replica, retry=10.0)
+
+        self.assertEqual(db.mget(['rs-group:grp1']), ['cls1'])
+        self.assertEqual(db.failed, 1000.0)
+
+        # The replica is not used until the retry interval elapses
+        mock_time.return_value = 1009.0
+        db.mget(['rs-group:grp1'])
+        self.assertEqual(replica.mget.call_count, 1)
+        self.assertEqual(primary.mget.call_count, 2)
+
+        mock_time.return_value = 1010.0
+        replica.mget.side_effect = None
+        replica.mget.return_value = ['cls2']
+        self.assertEqual(db.mget(['rs-group:grp1']), ['cls2'])
+        self.assertEqual(db.failed, None)
+
+    def test_timeout(self):
+        primary = mock.Mock(**{'hget.return_value': 'cls1'})
+        replica = mock.Mock(**{
+            'hget.side_effect': redis.exceptions.TimeoutError,
+        })
+        db = rs_limits.ReplicaDatabase(primary, replica)
+
+        self.assertEqual(db.hget('rs-groups', 'grp1'), 'cls1')
+
+    def test_other_error(self):
+        replica = mock.Mock(**{
+            'evalsha.side_effect': redis.exceptions.NoScriptError,
+        })
+        db = rs_limits.ReplicaDatabase(mock.Mock(), replica)
+
+        self.assertRaises(redis.exceptions.NoScriptError, db.evalsha, 'sha',
+                          0)
+        self.assertEqual(db.failed, None)
+
+    def test_iter(self):
+        primary = mock.Mock()
+        replica = mock.Mock(**{'scan_iter.return_value': iter(['k1', 'k2'])})
+        db = rs_limits.ReplicaDatabase(primary, replica)
+
+        self.assertEqual(list(db.scan_iter(match='rs-group:*')), ['k1', 'k2'])
+        replica.scan_iter.assert_called_once_with(match='rs-group:*')
+        self.assertFalse(primary.scan_iter.called)
+
+    def test_iter_fallback(self):
+        primary = mock.Mock(**{'hscan_iter.return_value': iter(['k1'])})
+        replica = mock.Mock(**{
+            'hscan_iter.side_effect': redis.exceptions.ConnectionError,
+        })
+        db = rs_limits.ReplicaDatabase(primary, replica)
+
+        self.assertEqual(list(db.hscan_iter('rs-groups')), ['k1'])
+        self.assertNotEqual(db.failed, None)
+
+    def test_iter_fail_midway(self):
+        def scan_iter(**kwargs):
+            yield 'k1'
+            raise redis.exceptions.ConnectionError()
+
+        primary = mock.Mock()
+        replica = mock.Mock(**{'scan_iter.side_effect': scan_iter})
+        db = rs_limits.ReplicaDatabase(primary, replica)
+        result = db.scan_iter(match='rs-group:*')
+
+        self.assertEqual(result.next(), 'k1')
+        self.assertRaises(redis.exceptions.ConnectionError, result.next)
+        self.assertNotEqual(db.failed, None)
+        self.assertFalse(primary.scan_iter.called)
+
+    @mock.patch.object(rs_limits, '_script_first_match',
+                       return_value=(0, 'cls1'))
+    def test_first_match(self, mock_script_first_match):
+        db = rs_limits.ReplicaDatabase(mock.Mock(), mock.Mock())
+
+        self.assertEqual(db.first_match(['rs-group:grp1']), (0, 'cls1'))
+        mock_script_first_match.assert_called_once_with(db,
+                                                        ['rs-group:grp1'])
+
+
+class TestHeaderWarmer(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'hot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_start(self, mock_spawn_n):
+        warmer = rs_limits.HeaderWarmer('state', 'db')
+
+        warmer.start()
+
+        mock_spawn_n.assert_called_once_with(warmer.run)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=[None, TestException])
+    @mock.patch.object(rs_limits.HeaderWarmer, 'warm',
+                       side_effect=TestException)
+    @mock.patch.object(rs_limits.HeaderWarmer, 'save')
+    def test_run(self, mock_save, mock_warm, mock_sleep):
+        warmer = rs_limits.HeaderWarmer('state', 'db', interval=10.0)
+
+        self.assertRaises(TestException, warmer.run)
+
+        mock_warm.assert_called_once_with()
+        mock_save.assert_called_once_with()
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(10.0), mock.call(10.0)])
+
+    def test_record_hot(self):
+        warmer = rs_limits.HeaderWarmer('state', 'db', size=2)
+
+        for hdr in ('a', 'b', 'b', 'c', 'c', 'c'):
+            warmer.record(hdr)
+
+        self.assertEqual(warmer.hot(), ['c', 'b'])
+
+    def test_record_bounded(self):
+        warmer = rs_limits.HeaderWarmer('state', 'db', size=1)
+        for i in range(4):
+            warmer.record('hot')
+
+        for i in range(10):
+            warmer.record('cold%d' % i)
+
+        self.assertEqual(warmer.counts, {'hot': 2})
+
+    def test_save_load_file(self):
+        warmer = rs_limits.HeaderWarmer('state', 'db', path=self.path)
+        warmer.record('grp1,grp2')
+
+        warmer.save()
+
+        self.assertEqual(warmer.load(), ['grp1,grp2'])
+        self.assertEqual(os.listdir(self.tmpdir), ['hot'])
+
+    def test_save_empty(self):
+        warmer = rs_limits.HeaderWarmer('state', 'db', path=self.path)
+
+        warmer.save()
+
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_load_file_missing(self):
+        warmer = rs_limits.HeaderWarmer('state', 'db', path=self.path)
+
+        self.assertEqual(warmer.load(), [])
+
+    def test_save_load_key(self):
+        db = mock.Mock(**{'lrange.return_value': ['grp1,grp2']})
+        pipe = db.pipeline.return_value
+        warmer = rs_limits.HeaderWarmer('state', db, key='hot')
+        warmer.record('grp1,grp2')
+
+        warmer.save()
+
+        self.assertEqual(pipe.method_calls, [
+            mock.call.delete('hot'),
+            mock.call.rpush('hot', 'grp1,grp2'),
+            mock.call.execute(),
+        ])
+        self.assertEqual(warmer.load(), ['grp1,grp2'])
+        db.lrange.assert_called_once_with('hot', 0, -1)
+
+    def test_warm(self):
+        data = {'rs-group:grp2': 'cls2', 'rs-group:grp3': 'cls3'}
+        db = mock.Mock(**{
+            'lrange.return_value': ['grp1,grp2', 'grp3;q=0.5,grp1', 'grp4'],
+            'mget.side_effect': lambda keys: [data.get(k) for k in keys],
+        })
+        state = rs_limits.PreprocessState(dict(cache_size='10',
+                                               resolution_cache_size='10',
+                                               lookup_timeout='1'))
+        warmer = rs_limits.HeaderWarmer(state, db, key='hot')
+
+        result = warmer.warm()
+
+        self.assertEqual(result, 3)
+        db.mget.assert_called_once_with(['rs-group:grp1', 'rs-group:grp2',
+                                         'rs-group:grp3', 'rs-group:grp4'])
+        self.assertEqual(state.cache.lookup('rs-group:grp2'), 'cls2')
+        self.assertEqual(state.cache.lookup('rs-group:grp1', 'missing'),
+                         None)
+        self.assertEqual(state.resolution_cache.lookup(('grp1,grp2', '')),
+                         'cls2')
+        self.assertEqual(state.resolution_cache.lookup(('grp3;q=0.5,grp1',
+                                                        '')), 'cls3')
+        self.assertEqual(state.resolution_cache.lookup(('grp4', ''),
+                                                       'missing'), None)
+        self.assertEqual(state.stale.lookup(('grp1,grp2', '')), 'cls2')
+        self.assertEqual(state.header_cache.lookup(('grp1,grp2', '')),
+                         (('grp1', 'grp2'), True))
+
+    def test_warm_hash(self):
+        db = mock.Mock(**{
+            'lrange.return_value': ['grp1'],
+            'hmget.return_value': ['cls1'],
+        })
+        state = rs_limits.PreprocessState(dict(storage='hash',
+                                               cache_size='10'))
+        warmer = rs_limits.HeaderWarmer(state, db, key='hot')
+
+        warmer.warm()
+
+        db.hmget.assert_called_once_with('rs-groups', ['grp1'])
+        self.assertEqual(state.cache.lookup('rs-group:grp1'), 'cls1')
+
+    def test_warm_empty(self):
+        db = mock.Mock(**{'lrange.return_value': []})
+        warmer = rs_limits.HeaderWarmer(rs_limits.PreprocessState(), db,
+                                        key='hot')
+
+        self.assertEqual(warmer.warm(), 0)
+        self.assertFalse(db.mget.called)
+
+    def test_warm_invalidated(self):
+        state = rs_limits.PreprocessState(dict(cache_size='10',
+                                               resolution_cache_size='10'))
+
+        def mget(keys):
+            state.invalidate('grp1')
+            return ['cls1']
+
+        db = mock.Mock(**{
+            'lrange.return_value': ['grp1'],
+            'mget.side_effect': mget,
+        })
+        warmer = rs_limits.HeaderWarmer(state, db, key='hot')
+
+        warmer.warm()
+
+        self.assertEqual(len(state.cache), 0)
+        self.assertEqual(len(state.resolution_cache), 0)
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=TestException)
+    @mock.patch.object(rs_limits.HeaderWarmer, 'warm')
+    def test_run_ready(self, mock_warm, mock_sleep):
+        ready = mock.Mock(**{
+            'wait.side_effect': lambda: self.assertFalse(mock_warm.called),
+        })
+        warmer = rs_limits.HeaderWarmer('state', 'db', ready=ready)
+
+        self.assertRaises(TestException, warmer.run)
+
+        ready.wait.assert_called_once_with()
+        mock_warm.assert_called_once_with()
+
+    @mock.patch.object(eventlet, 'sleep', side_effect=TestException)
+    @mock.patch.object(rs_limits.HeaderWarmer, 'warm')
+    def test_run_ready_timeout(self, mock_warm, mock_sleep):
+        warmer = rs_limits.HeaderWarmer('state', 'db', interval=0.01,
+                                        ready=rs_limits.event.Event())
+
+        self.assertRaises(TestException, warmer.run)
+
+        mock_warm.assert_called_once_with()
+
+    def test_warm_with_listener(self):
+        with open(self.path, 'w') as f:
+            json.dump(['grp1,grp2', 'grp2'], f)
+        data = {'rs-group:grp2': 'cls2'}
+
+        # The database yields to other threads, as a real one would
+        def listen():
+            eventlet.sleep(0.01)
+            return iter([dict(type='subscribe', channel='rs-group-update',
+                              data=1)])
+
+        def mget(keys):
+            eventlet.sleep(0)
+            return [data.get(k) for k in keys]
+
+        db = mock.Mock(**{
+            'pubsub.return_value.listen.side_effect': listen,
+            'mget.side_effect': mget,
+        })
+        threads = []
+        with mock.patch.object(eventlet, 'spawn_n',
+                               side_effect=lambda func: threads.append(
+                                   eventlet.spawn(func))):
+            state = rs_limits.PreprocessState(
+                dict(warmup_file=self.path, cache_size='10',
+                     resolution_cache_size='10'), db)
+        for thread in threads:
+            self.addCleanup(thread.kill)
+        for i in range(50):
+            eventlet.sleep(0.01)
+
+        # The listener's initial flush must not undo the preloading
+        self.assertTrue(state.listener.subscribed.ready())
+        self.assertEqual(len(state.cache), 2)
+        self.assertEqual(len(state.resolution_cache), 2)
+
+
+class TestPreprocessState(unittest2.TestCase):
+    def test_init(self):
+        state = rs_limits.PreprocessState()
+
+        self.assertEqual(state.prios, None)
+        self.assertIsInstance(state.header_cache, rs_limits.MappingCache)
+        self.assertEqual(state.header_cache.size, 1000)
+        self.assertEqual(state.header_cache.ttl, None)
+        self.assertEqual(state.cache, None)
+        self.assertEqual(state.listener, None)
+        self.assertEqual(state.breaker, None)
+        self.assertEqual(state.stale, None)
+        self.assertIsInstance(state.flights, rs_limits.SingleFlight)
+        self.assertEqual(state.replica, None)
+        self.assertEqual(state.warmer, None)
+        self.assertEqual(state.filter, None)
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    @mock.patch.object(rs_limits.GroupFilter, 'start')
+    def test_init_filter(self, mock_filter_start, mock_listen_start):
+        state = rs_limits.PreprocessState(dict(group_filter='bloom',
+                                               group_filter_interval='60',
+                                               group_filter_error_rate='0.1',
+                                               storage='hash'), 'db')
+
+        self.assertIsInstance(state.filter, rs_limits.GroupFilter)
+        self.assertIsInstance(state.filter.db, rs_limits.HashDatabase)
+        self.assertIs(state.filter.factory, rs_limits.BloomFilter)
+        self.assertEqual(state.filter.interval, 60.0)
+        self.assertEqual(state.filter.error_rate, 0.1)
+        mock_filter_start.assert_called_once_with()
+        self.assertIsInstance(state.listener, rs_limits.MappingListener)
+
+    def test_init_filter_nodb(self):
+        state = rs_limits.PreprocessState(dict(group_filter='set'))
+
+        self.assertEqual(state.filter, None)
+
+    def test_invalidate_filter(self):
+        state = rs_limits.PreprocessState()
+        state.filter = mock.Mock()
+
+        state.invalidate('grp1')
+        state.invalidate()
+
+        state.filter.update.assert_called_once_with('grp1')
+
+    @mock.patch.object(rs_limits.HeaderWarmer, 'start')
+    def test_init_warmer(self, mock_start):
+        state = rs_limits.PreprocessState(dict(warmup_file='/tmp/hot',
+                                               warmup_size='50',
+                                               warmup_interval='60',
+                                               groups='grp1=0.5'), 'db')
+
+        self.assertIsInstance(state.warmer, rs_limits.HeaderWarmer)
+        self.assertIs(state.warmer.state, state)
+        self.assertEqual(state.warmer.db, 'db')
+        self.assertEqual(state.warmer.prio_conf, 'grp1=0.5')
+        self.assertEqual(state.warmer.path, '/tmp/hot')
+        self.assertEqual(state.warmer.size, 50)
+        self.assertEqual(state.warmer.interval, 60.0)
+        mock_start.assert_called_once_with()
+
+    @mock.patch.object(rs_limits.HeaderWarmer, 'start')
+    def test_init_warmer_key(self, mock_start):
+        state = rs_limits.PreprocessState(dict(warmup_key='hot'), 'db')
+
+        self.assertEqual(state.warmer.key, 'hot')
+
+    def test_init_warmer_nodb(self):
+        state = rs_limits.PreprocessState(dict(warmup_key='hot'))
+
+        self.assertEqual(state.warmer, None)
+
+    def test_init_replica(self):
+        state = rs_limits.PreprocessState(dict(replica_retry='5'), 'db',
+                                          'replica')
+
+        self.assertIsInstance(state.replica, rs_limits.ReplicaDatabase)
+        self.assertEqual(state.replica.db, 'db')
+        self.assertEqual(state.replica.replica, 'replica')
+        self.assertEqual(state.replica.retry, 5.0)
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    @mock.patch.object(rs_limits.MappingSnapshot, 'start')
+    def test_init_replica_snapshot(self, mock_snap_start, mock_listen_start):
+        state = rs_limits.PreprocessState(dict(snapshot='yes'), 'db',
+                                          'replica')
+
+        self.assertIs(state.snapshot.db, state.replica)
+        self.assertIs(state.listener.db, state.replica)
+
+    def test_init_replica_nodb(self):
+        state = rs_limits.PreprocessState({}, None, 'replica')
+
+        self.assertEqual(state.replica, None)
+
+    def test_init_nocoalesce(self):
+        state = rs_limits.PreprocessState(dict(coalesce='no'))
+
+        self.assertEqual(state.flights, None)
+
+    def test_init_breaker(self):
+        state = rs_limits.PreprocessState(dict(lookup_timeout='0.05',
+                                               breaker_threshold='3',
+                                               breaker_reset='10',
+                                               stale_cache_size='20'))
+
+        self.assertEqual(state.lookup_timeout, 0.05)
+        self.assertIsInstance(state.breaker, rs_limits.CircuitBreaker)
+        self.assertEqual(state.breaker.threshold, 3)
+        self.assertEqual(state.breaker.reset, 10.0)
+        self.assertIsInstance(state.stale, rs_limits.MappingCache)
+        self.assertEqual(state.stale.size, 20)
+        self.assertEqual(state.stale.ttl, None)
+
+    def test_init_metrics(self):
+        state = rs_limits.PreprocessState(dict(metrics='memory'))
+
+        self.assertIsInstance(state.metrics, rs_limits.MemoryMetrics)
+
+    def test_init_metrics_entrypoint(self):
+        state = rs_limits.PreprocessState(
+            dict(metrics='rs_limits:StatsdMetrics', statsd_port='1234'))
+
+        self.assertIsInstance(state.metrics, rs_limits.StatsdMetrics)
+        self.assertEqual(state.metrics.address, ('localhost', 1234))
+        state.metrics.sock.close()
+
+    def test_init_metrics_missing(self):
+        self.assertRaises(ImportError, rs_limits.PreprocessState,
+                          dict(metrics='nosuchsink'))
+
+    def test_init_cache(self):
+        state = rs_limits.PreprocessState(dict(cache_size='100',
+                                               cache_ttl='30'))
+
+        self.assertIsInstance(state.cache, rs_limits.MappingCache)
+        self.assertEqual(state.cache.size, 100)
+        self.assertEqual(state.cache.ttl, 30.0)
+        self.assertEqual(state.listener, None)
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    def test_init_cache_listen(self, mock_start):
+        state = rs_limits.PreprocessState(dict(cache_size='100'), 'db')
+
+        self.assertIsInstance(state.listener, rs_limits.MappingListener)
+        self.assertEqual(state.listener.state, state)
+        self.assertEqual(state.listener.db, 'db')
+        mock_start.assert_called_once_with()
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    def test_init_cache_nolisten(self, mock_start):
+        state = rs_limits.PreprocessState(dict(cache_size='100',
+                                               cache_listen='no'), 'db')
+
+        self.assertEqual(state.listener, None)
+        self.assertFalse(mock_start.called)
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    @mock.patch.object(rs_limits.MappingSnapshot, 'start')
+    def test_init_snapshot(self, mock_snap_start, mock_listen_start):
+        state = rs_limits.PreprocessState(dict(snapshot='yes',
+                                               snapshot_interval='60'),
+                                          'db')
+
+        self.assertEqual(state.cache, None)
+        self.assertIsInstance(state.snapshot, rs_limits.MappingSnapshot)
+        self.assertEqual(state.snapshot.db, 'db')
+        self.assertEqual(state.snapshot.interval, 60.0)
+        self.assertEqual(state.snapshot.max_age, 180.0)
+        mock_snap_start.assert_called_once_with()
+        self.assertIsInstance(state.listener, rs_limits.MappingListener)
+        mock_listen_start.assert_called_once_with()
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'start')
+    def test_init_shared(self, mock_snap_start, mock_listen_start):
+        state = rs_limits.PreprocessState(dict(shared_cache='/tmp/mappings',
+                                               shared_cache_interval='60'),
+                                          'db')
+
+        self.assertIsInstance(state.snapshot, rs_limits.SharedSnapshot)
+        self.assertEqual(state.snapshot.path, '/tmp/mappings')
+        self.assertEqual(state.snapshot.db, 'db')
+        self.assertEqual(state.snapshot.interval, 60.0)
+        self.assertEqual(state.snapshot.max_age, 180.0)
+        mock_snap_start.assert_called_once_with()
+        self.assertIsInstance(state.listener, rs_limits.MappingListener)
+
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'start')
+    def test_init_shared_norefresh(self, mock_snap_start, mock_listen_start):
+        state = rs_limits.PreprocessState(dict(shared_cache='/tmp/mappings',
+                                               shared_cache_refresh='no'),
+                                          'db')
+
+        self.assertEqual(state.snapshot.db, None)
+
+    def test_init_snapshot_nodb(self):
+        state = rs_limits.PreprocessState(dict(snapshot='yes'))
+
+        self.assertEqual(state.snapshot, None)
+
+    def test_invalidate_snapshot(self):
+        state = rs_limits.PreprocessState()
+        state.snapshot = mock.Mock()
+
+        state.invalidate('grp1')
+        state.invalidate()
+
+        state.snapshot.update.assert_called_once_with('grp1')
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_invalidate_snapshot_concurrent(self, mock_spawn_n):
+        data = {'rs-group:grp1': 'new'}
+        midware = mock.Mock(db=mock.Mock(**{
+            'get.side_effect': lambda key: data.get(key),
+        }))
+        conf = {'rs_limits': {'snapshot': 'yes',
+                              'resolution_cache_size': '10'}}
+        state = rs_limits._get_state(midware, conf)
+        state.snapshot.mappings = {'rs-group:grp1': 'old'}
+        state.snapshot.loaded = time.time()
+
+        def preprocess():
+            environ = {'HTTP_X_PP_GROUPS': 'grp1', 'turnstile.conf': conf}
+            rs_limits.rs_preprocess(midware, environ)
+            return environ['turnstile.nova.limitclass']
+
+        def get(key):
+            # A request resolved while the update waits on the database
+            self.assertEqual(preprocess(), 'old')
+            return data.get(key)
+        state.snapshot.db = mock.Mock(**{'get.side_effect': get})
+
+        state.invalidate('grp1')
+
+        self.assertEqual(state.snapshot.mappings, {'rs-group:grp1': 'new'})
+        self.assertEqual(preprocess(), 'new')
+
+    def test_init_resolution_cache(self):
+        state = rs_limits.PreprocessState(dict(resolution_cache_size='50',
+                                               cache_ttl='30'))
+
+        self.assertIsInstance(state.resolution_cache, rs_limits.MappingCache)
+        self.assertEqual(state.resolution_cache.size, 50)
+        self.assertEqual(state.resolution_cache.ttl, 30.0)
+        self.assertEqual(state.generation, 0)
+
+    def test_invalidate_resolution_cache(self):
+        state = rs_limits.PreprocessState(dict(resolution_cache_size='50'))
+        state.resolution_cache.store(('grp1', ''), 'cls1')
+
+        state.invalidate('grp2')
+
+        self.assertEqual(len(state.resolution_cache), 0)
+        self.assertEqual(state.generation, 1)
+
+    def test_init_tenant_cache(self):
+        state = rs_limits.PreprocessState(dict(tenant_cache_size='50',
+                                               tenant_cache_ttl='10',
+                                               cache_ttl='30'))
+
+        self.assertIsInstance(state.tenant_cache, rs_limits.MappingCache)
+        self.assertEqual(state.tenant_cache.size, 50)
+        self.assertEqual(state.tenant_cache.ttl, 10.0)
+
+    def test_init_tenant_cache_default_ttl(self):
+        state = rs_limits.PreprocessState(dict(tenant_cache_size='50',
+                                               cache_ttl='30'))
+
+        self.assertEqual(state.tenant_cache.ttl, 30.0)
+
+    def test_init_tenant_cache_disabled(self):
+        state = rs_limits.PreprocessState()
+
+        self.assertEqual(state.tenant_cache, None)
+
+    def test_invalidate_tenant_cache(self):
+        state = rs_limits.PreprocessState(dict(tenant_cache_size='50'))
+        state.tenant_cache.store(('tenant', 'fp'), 'cls1')
+
+        state.invalidate('grp2')
+
+        self.assertEqual(len(state.tenant_cache), 0)
+        self.assertEqual(state.generation, 1)
+
+    def test_invalidate_nocache(self):
+        state = rs_limits.PreprocessState()
+
+        # Checking that no exceptions are raised
+        state.invalidate('grp1')
+        state.invalidate()
+
+    def test_invalidate(self):
+        state = rs_limits.PreprocessState(dict(cache_size='100'))
+        state.cache.store('rs-group:grp1', 'cls1')
+        state.cache.store('rs-group:grp2', 'cls2')
+
+        state.invalidate('grp1')
+
+        self.assertEqual(state.cache.lookup('rs-group:grp1', 'none'), 'none')
+        self.assertEqual(state.cache.lookup('rs-group:grp2', 'none'), 'cls2')
+
+    def test_invalidate_all(self):
+        state = rs_limits.PreprocessState(dict(cache_size='100'))
+        state.cache.store('rs-group:grp1', 'cls1')
+        state.cache.store('rs-group:grp2', 'cls2')
+
+        state.invalidate()
+
+        self.assertEqual(len(state.cache), 0)
+
+    def test_get_priorities(self):
+        state = rs_limits.PreprocessState()
+
+        prios = state.get_priorities('=0.2,admin=0.5')
+
+        self.assertEqual(prios, {'': 0.2, 'admin': 0.5})
+        self.assertEqual(prios.conf_value, '=0.2,admin=0.5')
+        self.assertEqual(state.prios, prios)
+
+    @mock.patch.object(rs_limits, 'GroupPriorities',
+                       side_effect=lambda x: mock.Mock(conf_value=x))
+    def test_get_priorities_cached(self, mock_GroupPriorities):
+        state = rs_limits.PreprocessState()
+
+        first = state.get_priorities('admin=0.5')
+        second = state.get_priorities('admin=0.5')
+
+        self.assertIs(first, second)
+        mock_GroupPriorities.assert_called_once_with('admin=0.5')
+
+    @mock.patch.object(rs_limits, 'GroupPriorities',
+                       side_effect=lambda x: mock.Mock(conf_value=x))
+    def test_get_priorities_changed(self, mock_GroupPriorities):
+        state = rs_limits.PreprocessState()
+
+        first = state.get_priorities('admin=0.5')
+        second = state.get_priorities('admin=0.7')
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.conf_value, 'admin=0.7')
+        self.assertEqual(mock_GroupPriorities.call_count, 2)
+
+    @mock.patch.object(rs_limits.PriorityWatcher, 'start')
+    def test_init_priorities(self, mock_start):
+        state = rs_limits.PreprocessState(dict(priorities_reload='yes',
+                                               priorities_interval='10',
+                                               cache_listen='no'), 'db')
+
+        self.assertIsInstance(state.priorities, rs_limits.PriorityWatcher)
+        self.assertEqual(state.priorities.db, 'db')
+        self.assertEqual(state.priorities.interval, 10.0)
+        mock_start.assert_called_once_with()
+
+    @mock.patch.object(rs_limits.ResolutionTable, 'start')
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    def test_init_table(self, mock_listen_start, mock_start):
+        state = rs_limits.PreprocessState(dict(resolution_table='yes',
+                                               resolution_table_interval='60'),
+                                          'db')
+
+        self.assertIsInstance(state.table, rs_limits.ResolutionTable)
+        self.assertEqual(state.table.db, 'db')
+        self.assertEqual(state.table.interval, 60.0)
+        mock_start.assert_called_once_with()
+        self.assertIsInstance(state.listener, rs_limits.MappingListener)
+
+    def test_init_table_nodb(self):
+        state = rs_limits.PreprocessState(dict(resolution_table='yes'))
+
+        self.assertEqual(state.table, None)
+
+    def test_invalidate_table(self):
+        state = rs_limits.PreprocessState()
+        state.table = mock.Mock()
+
+        state.invalidate('grp1')
+        state.invalidate()
+
+        state.table.invalidate.assert_called_once_with('grp1')
+
+    @mock.patch.object(rs_limits.Profiler, 'start')
+    def test_init_profiler(self, mock_start):
+        state = rs_limits.PreprocessState(dict(profile='cprofile',
+                                               profile_rate='10',
+                                               profile_file='/tmp/prof',
+                                               profile_interval='30'))
+
+        self.assertIsInstance(state.profiler, rs_limits.Profiler)
+        self.assertEqual(state.profiler.rate, 10)
+        self.assertEqual(state.profiler.path, '/tmp/prof')
+        self.assertEqual(state.profiler.interval, 30.0)
+        self.assertEqual(state.profiler.cprofile, True)
+        mock_start.assert_called_once_with()
+
+    def test_init_profiler_disabled(self):
+        state = rs_limits.PreprocessState()
+
+        self.assertEqual(state.profiler, None)
+
+    def test_init_profiler_unknown(self):
+        self.assertRaises(ValueError, rs_limits.PreprocessState,
+                          dict(profile='spam'))
+
+    def test_init_lookup(self):
+        self.assertEqual(rs_limits.PreprocessState().lookup,
+                         rs_limits._lookup_get)
+        self.assertEqual(rs_limits.PreprocessState(
+            dict(storage='hash')).lookup, rs_limits._lookup_mget)
+        self.assertEqual(rs_limits.PreprocessState(
+            dict(lookup='lua')).lookup, rs_limits._lookup_lua)
+
+    def test_init_lookup_unknown(self):
+        self.assertRaises(ValueError, rs_limits.PreprocessState,
+                          dict(lookup='mgte'))
+
+    def test_init_priorities_nodb(self):
+        state = rs_limits.PreprocessState(dict(priorities_reload='yes'))
+
+        self.assertEqual(state.priorities, None)
+
+    def test_get_prio_conf(self):
+        state = rs_limits.PreprocessState()
+
+        self.assertEqual(state.get_prio_conf('admin=0.5'), 'admin=0.5')
+
+        state.priorities = rs_limits.PriorityWatcher('db')
+
+        self.assertEqual(state.get_prio_conf('admin=0.5'), 'admin=0.5')
+
+        state.priorities.prios = rs_limits.GroupPriorities('admin=0.7')
+
+        self.assertEqual(state.get_prio_conf('admin=0.5'), 'admin=0.7')
+
+    @mock.patch.object(rs_limits, 'GroupPriorities',
+                       side_effect=lambda x: mock.Mock(conf_value=x))
+    def test_get_priorities_reloaded(self, mock_GroupPriorities):
+        state = rs_limits.PreprocessState()
+        state.priorities = rs_limits.PriorityWatcher('db')
+        state.priorities.prios = mock.Mock(conf_value='admin=0.7')
+
+        reloaded = state.get_priorities('admin=0.7')
+        configured = state.get_priorities('admin=0.5')
+
+        self.assertIs(reloaded, state.priorities.prios)
+        self.assertEqual(configured.conf_value, 'admin=0.5')
+        mock_GroupPriorities.assert_called_once_with('admin=0.5')
+
+
+class TestGetState(unittest2.TestCase):
+    def test_get_state(self):
+        midware1 = mock.Mock()
+        midware2 = mock.Mock()
+        conf = {'rs_limits': {}}
+
+        state1 = rs_limits._get_state(midware1, conf)
+        state2 = rs_limits._get_state(midware2, conf)
+
+        self.assertIsInstance(state1, rs_limits.PreprocessState)
+        self.assertIsInstance(state2, rs_limits.PreprocessState)
+        self.assertIsNot(state1, state2)
+        self.assertIs(rs_limits._get_state(midware1, conf), state1)
+
+    def test_get_state_replica(self):
+        midware = mock.Mock()
+        conf = mock.MagicMock(**{
+            '__getitem__.return_value': {'redis.host': 'localhost'},
+        })
+
+        state = rs_limits._get_state(midware, conf)
+
+        conf.get_database.assert_called_once_with('rs_limits')
+        self.assertIs(state.replica.replica,
+                      conf.get_database.return_value)
+        self.assertIs(state.replica.db, midware.db)
+
+    def test_get_state_noreplica(self):
+        midware = mock.Mock()
+        conf = mock.MagicMock(**{'__getitem__.return_value': {}})
+
+        state = rs_limits._get_state(midware, conf)
+
+        self.assertFalse(conf.get_database.called)
+        self.assertEqual(state.replica, None)
+
+
+class TestLookupGet(unittest2.TestCase):
+    def test_found(self):
+        classes = {'rs-group:grp2': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+
+        result = rs_limits._lookup_get(db, ['grp1', 'grp2', 'grp3'])
+
+        self.assertEqual(result, ('grp2', 'lim_class'))
+        self.assertEqual(db.get.call_args_list, [
+            mock.call('rs-group:grp1'),
+            mock.call('rs-group:grp2'),
+        ])
+
+    def test_not_found(self):
+        db = mock.Mock(**{'get.return_value': None})
+
+        result = rs_limits._lookup_get(db, ['grp1', 'grp2'])
+
+        self.assertEqual(result, (None, None))
+        self.assertEqual(db.get.call_count, 2)
+
+
+class TestLookupMget(unittest2.TestCase):
+    def test_found(self):
+        db = mock.Mock(**{'mget.return_value': [None, 'cls2', 'cls3']})
+
+        result = rs_limits._lookup_mget(db, ['grp1', 'grp2', 'grp3'])
+
+        self.assertEqual(result, ('grp2', 'cls2'))
+        db.mget.assert_called_once_with(
+            ['rs-group:grp1', 'rs-group:grp2', 'rs-group:grp3'])
+        self.assertFalse(db.get.called)
+
+    def test_not_found(self):
+        db = mock.Mock(**{'mget.return_value': [None, None]})
+
+        result = rs_limits._lookup_mget(db, ['grp1', 'grp2'])
+
+        self.assertEqual(result, (None, None))
+        db.mget.assert_called_once_with(['rs-group:grp1', 'rs-group:grp2'])
+
+    def test_empty(self):
+        db = mock.Mock()
+
+        result = rs_limits._lookup_mget(db, [])
+
+        self.assertEqual(result, (None, None))
+        self.assertFalse(db.mget.called)
+
+
+class TestLookupLua(unittest2.TestCase):
+    @mock.patch.object(rs_limits, '_first_match', return_value=(1, 'cls2'))
+    def test_found(self, mock_first_match):
+        result = rs_limits._lookup_lua('db', ['grp1', 'grp2', 'grp3'])
+
+        self.assertEqual(result, ('grp2', 'cls2'))
+        mock_first_match.assert_called_once_with(
+            'db', ['rs-group:grp1', 'rs-group:grp2', 'rs-group:grp3'])
+
+    @mock.patch.object(rs_limits, '_first_match',
+                       return_value=(None, None))
+    def test_not_found(self, mock_first_match):
+        result = rs_limits._lookup_lua('db', ['grp1', 'grp2'])
+
+        self.assertEqual(result, (None, None))
+
+    @mock.patch.object(rs_limits, '_first_match')
+    def test_empty(self, mock_first_match):
+        result = rs_limits._lookup_lua('db', [])
+
+        self.assertEqual(result, (None, None))
+        self.assertFalse(mock_first_match.called)
+
+
+class TestParseGroups(unittest2.TestCase):
+    def test_stages(self):
+        prios = rs_limits.GroupPriorities('')
+        stages = mock.Mock()
+
+        rs_limits._parse_groups('grp1;q=0.5,grp2;q=0.7', prios,
+                                stages=stages)
+        rs_limits._parse_groups('grp1,grp2', prios, stages=stages)
+
+        self.assertEqual(stages.mark.call_args_list, [
+            mock.call('parse'),
+            mock.call('sort'),
+            mock.call('parse'),
+            mock.call('remap'),
+            mock.call('sort'),
+        ])
+
+    def test_quality(self):
+        prios = rs_limits.GroupPriorities('')
+
+        result = rs_limits._parse_groups(
+            'grp1,grp2;q=0.5,grp3;q=0.7, grp4;q=0.9,grp5', prios)
+
+        self.assertEqual(result, ('grp1', 'grp5', 'grp4', 'grp3', 'grp2'))
+
+    def test_priorities(self):
+        prios = rs_limits.GroupPriorities('=0.1,grp2=0.5,GRP4=0.9')
+
+        result = rs_limits._parse_groups('grp1,grp2,grp3,grp4', prios)
+
+        self.assertEqual(result, ('grp4', 'grp2', 'grp1', 'grp3'))
+
+    def test_metrics(self):
+        prios = rs_limits.GroupPriorities('')
+        metrics = mock.Mock()
+
+        rs_limits._parse_groups('grp1;q=0.5,grp2', prios, metrics)
+        self.assertFalse(metrics.incr.called)
+
+        rs_limits._parse_groups('grp1,grp2', prios, metrics)
+        metrics.incr.assert_called_once_with('repose')
+
+    def test_parse_header(self):
+        prios = rs_limits.GroupPriorities('grp2=0.5')
+
+        self.assertEqual(rs_limits._parse_header('grp1;q=0.5,grp2', prios),
+                         (('grp2', 'grp1'), False))
+        self.assertEqual(rs_limits._parse_header('grp1,grp2', prios),
+                         (('grp2', 'grp1'), True))
+
+
+class TestSetClass(unittest2.TestCase):
+    def test_noclass(self):
+        context = mock.Mock(quota_class=None)
+        environ = {}
+
+        rs_limits._set_class(environ, context, None)
+
+        self.assertEqual(environ, {})
+        self.assertEqual(context.quota_class, None)
+
+    def test_class(self):
+        environ = {}
+
+        rs_limits._set_class(environ, None, 'lim_class')
+
+        self.assertEqual(environ, {'turnstile.nova.limitclass': 'lim_class'})
+
+    def test_class_context(self):
+        context = mock.Mock(quota_class=None)
+        environ = {}
+
+        rs_limits._set_class(environ, context, 'lim_class')
+
+        self.assertEqual(environ, {'turnstile.nova.limitclass': 'lim_class'})
+        self.assertEqual(context.quota_class, 'lim_class')
+
+
+class TestPreprocessMetrics(unittest2.TestCase):
+    def test_metrics(self):
+        classes = {'rs-group:grp3': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'metrics': 'memory'}}
+
+        rs_limits.rs_preprocess(midware, {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3',
+            'turnstile.conf': conf,
+        })
+        rs_limits.rs_preprocess(midware, {
+            'HTTP_X_PP_GROUPS': 'grp4;q=0.5',
+            'turnstile.conf': conf,
+        })
+
+        stats = rs_limits._get_state(midware, conf).metrics.stats()
+        self.assertEqual(stats['counters'], dict(repose=1, unmapped=1))
+        dists = stats['distributions']
+        self.assertEqual(dists['preprocess']['count'], 2)
+        self.assertEqual(dists['redis.get']['count'], 4)
+        self.assertEqual(dists['lookups']['count'], 2)
+        self.assertEqual(dists['lookups']['sum'], 4)
+        self.assertEqual(dists['position']['count'], 1)
+        self.assertEqual(dists['position']['sum'], 2)
+
+    def test_metrics_header_cache(self):
+        db = mock.Mock(**{'get.return_value': None})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'metrics': 'memory'}}
+
+        for i in range(10):
+            rs_limits.rs_preprocess(midware, {
+                'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                'turnstile.conf': conf,
+            })
+
+        stats = rs_limits._get_state(midware, conf).metrics.stats()
+        self.assertEqual(stats['counters'], dict(repose=10, unmapped=10))
+        self.assertEqual(stats['distributions']['lookups']['count'], 10)
+
+    def test_metrics_resolution_cache(self):
+        classes = {'rs-group:grp2': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'metrics': 'memory',
+                              'resolution_cache_size': '10'}}
+
+        for hdr in ('grp1,grp2', 'grp1,grp2', 'grp3', 'grp3'):
+            rs_limits.rs_preprocess(midware, {
+                'HTTP_X_PP_GROUPS': hdr,
+                'turnstile.conf': conf,
+            })
+
+        stats = rs_limits._get_state(midware, conf).metrics.stats()
+        self.assertEqual(stats['counters'], dict(repose=2, unmapped=2))
+        dists = stats['distributions']
+        self.assertEqual(dists['lookups']['count'], 4)
+        self.assertEqual(dists['lookups']['sum'], 3)
+        self.assertEqual(dists['position']['count'], 1)
+
+    def test_metrics_snapshot(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {'metrics': 'memory'}}
+        state = rs_limits._get_state(midware, conf)
+        state.snapshot = mock.Mock(**{
+            'fresh.return_value': True,
+            'mget.return_value': ['lim_class'],
+        })
+
+        rs_limits.rs_preprocess(midware, {
+            'HTTP_X_PP_GROUPS': 'grp1',
+            'turnstile.conf': conf,
+        })
+
+        dists = state.metrics.stats()['distributions']
+        self.assertEqual(dists['lookups']['sum'], 0)
+        self.assertEqual(dists['position']['sum'], 0)
+
+
+class TestGuardedLookup(unittest2.TestCase):
+    def setUp(self):
+        self.state = rs_limits.PreprocessState(dict(lookup_timeout='0.05',
+                                                    breaker_threshold='1',
+                                                    metrics='memory'))
+
+    def test_success(self):
+        lookup = mock.Mock(return_value=('grp1', 'lim_class'))
+
+        result = rs_limits._guarded_lookup(self.state, lookup, 'db',
+                                           ['grp1'])
+
+        self.assertEqual(result, ('grp1', 'lim_class'))
+        lookup.assert_called_once_with('db', ['grp1'])
+        self.assertEqual(self.state.breaker.state, 'closed')
+
+    def test_open(self):
+        self.state.breaker.failure()
+        lookup = mock.Mock()
+
+        result = rs_limits._guarded_lookup(self.state, lookup, 'db',
+                                           ['grp1'])
+
+        self.assertEqual(result, rs_limits._unresolved)
+        self.assertFalse(lookup.called)
+
+    def test_timeout(self):
+        def lookup(db, groups):
+            eventlet.sleep(1)
+
+        result = rs_limits._guarded_lookup(self.state, lookup, 'db',
+                                           ['grp1'])
+
+        self.assertEqual(result, rs_limits._unresolved)
+        self.assertEqual(self.state.breaker.state, 'open')
+        self.assertEqual(self.state.metrics.stats()['counters'],
+                         {'breaker.trip': 1})
+
+    def test_other_timeout(self):
+        def lookup(db, groups):
+            raise eventlet.Timeout()
+
+        self.assertRaises(eventlet.Timeout, rs_limits._guarded_lookup,
+                          self.state, lookup, 'db', ['grp1'])
+        self.assertEqual(self.state.breaker.state, 'open')
+
+    @mock.patch('time.time', return_value=1000.0)
+    def test_trial_interrupted(self, mock_time):
+        self.state.breaker.failure()
+        mock_time.return_value += self.state.breaker.reset
+        lookups = [eventlet.Timeout(), greenlet.GreenletExit()]
+
+        for exc in lookups:
+            lookup = mock.Mock(side_effect=exc)
+
+            self.assertRaises(type(exc), rs_limits._guarded_lookup,
+                              self.state, lookup, 'db', ['grp1'])
+            self.assertTrue(lookup.called)
+            self.assertEqual(self.state.breaker.state, 'open')
+
+            # The breaker permits another trial once it resets
+            mock_time.return_value += self.state.breaker.reset
+
+        lookup = mock.Mock(return_value=('grp1', 'lim_class'))
+        result = rs_limits._guarded_lookup(self.state, lookup, 'db',
+                                           ['grp1'])
+
+        self.assertEqual(result, ('grp1', 'lim_class'))
+        self.assertEqual(self.state.breaker.state, 'closed')
+
+    def test_error(self):
+        lookup = mock.Mock(side_effect=redis.exceptions.ConnectionError)
+
+        result = rs_limits._guarded_lookup(self.state, lookup, 'db',
+                                           ['grp1'])
+
+        self.assertEqual(result, rs_limits._unresolved)
+        self.assertEqual(self.state.breaker.state, 'open')
+
+    def test_other_error(self):
+        lookup = mock.Mock(side_effect=TestException)
+
+        self.assertRaises(TestException, rs_limits._guarded_lookup,
+                          self.state, lookup, 'db', ['grp1'])
+        self.assertEqual(self.state.breaker.state, 'open')
+
+    @mock.patch('time.time', side_effect=[1000.0] + [1000.1] * 5)
+    def test_slow(self, mock_time):
+        lookup = mock.Mock(return_value=('grp1', 'lim_class'))
+
+        result = rs_limits._guarded_lookup(self.state, lookup, 'db',
+                                           ['grp1'])
+
+        self.assertEqual(result, ('grp1', 'lim_class'))
+        self.assertEqual(self.state.breaker.state, 'open')
+
+
+class TestFallback(unittest2.TestCase):
+    def setUp(self):
+        self.state = rs_limits.PreprocessState(dict(lookup_timeout='0.05',
+                                                    metrics='memory'))
+
+    def test_stale(self):
+        self.state.stale.store(('grp1,grp2', ''), 'lim_class')
+
+        result = rs_limits._fallback(self.state, ('grp1,grp2', ''),
+                                     ['grp1', 'grp2'])
+
+        self.assertEqual(result, 'lim_class')
+        self.assertEqual(self.state.breaker.fallbacks, 1)
+        self.assertEqual(self.state.metrics.stats()['counters'],
+                         {'fallback': 1})
+
+    def test_stale_unmapped(self):
+        self.state.stale.store(('grp1,grp2', ''), None)
+        self.state.snapshot = mock.Mock()
+
+        result = rs_limits._fallback(self.state, ('grp1,grp2', ''),
+                                     ['grp1', 'grp2'])
+
+        self.assertEqual(result, None)
+        self.assertFalse(self.state.snapshot.mget.called)
+
+    def test_snapshot(self):
+        self.state.snapshot = mock.Mock(**{
+            'mget.return_value': [None, 'lim_class'],
+        })
+
+        result = rs_limits._fallback(self.state, ('grp1,grp2', ''),
+                                     ['grp1', 'grp2'])
+
+        self.assertEqual(result, 'lim_class')
+        self.state.snapshot.mget.assert_called_once_with(['rs-group:grp1',
+                                                          'rs-group:grp2'])
+
+    def test_unknown(self):
+        result = rs_limits._fallback(self.state, ('grp1,grp2', ''),
+                                     ['grp1', 'grp2'])
+
+        self.assertEqual(result, None)
+
+
+class TestPreprocessBreaker(unittest2.TestCase):
+    def test_stale_fallback(self):
+        classes = {'rs-group:grp2': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'lookup_timeout': '1',
+                              'breaker_threshold': '1'}}
+        state = rs_limits._get_state(midware, conf)
+
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2', 'turnstile.conf': conf}
+        rs_limits.rs_preprocess(midware, environ)
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+
+        db.get.side_effect = redis.exceptions.ConnectionError
+        for i in range(2):
+            environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                       'turnstile.conf': conf}
+            rs_limits.rs_preprocess(midware, environ)
+            self.assertEqual(environ['turnstile.nova.limitclass'],
+                             'lim_class')
+
+        self.assertEqual(db.get.call_count, 3)
+        self.assertEqual(state.breaker.stats(), dict(
+            state='open', failures=1, trips=1, fallbacks=2))
+
+    def test_snapshot_bypasses_breaker(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {'lookup_timeout': '1'}}
+        state = rs_limits._get_state(midware, conf)
+        state.breaker.failure = mock.Mock()
+        state.breaker.state = 'open'
+        state.breaker.opened = float('inf')
+        state.snapshot = mock.Mock(**{
+            'fresh.return_value': True,
+            'mget.return_value': ['lim_class'],
+        })
+        environ = {'HTTP_X_PP_GROUPS': 'grp1', 'turnstile.conf': conf}
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertEqual(state.breaker.fallbacks, 0)
+
+
+class TestPreprocessWarmer(unittest2.TestCase):
+    def test_record(self):
+        midware = mock.Mock(**{'db.get.return_value': None})
+        conf = {'rs_limits': {}}
+        state = rs_limits._get_state(midware, conf)
+        state.warmer = mock.Mock()
+
+        rs_limits.rs_preprocess(midware, {'HTTP_X_PP_GROUPS': 'grp1',
+                                          'turnstile.conf': conf})
+        rs_limits.rs_prepare(midware, {'HTTP_X_PP_GROUPS': 'grp2',
+                                       'turnstile.conf': conf})
+
+        self.assertEqual(state.warmer.record.call_args_list,
+                         [mock.call('grp1'), mock.call('grp2')])
+
+
+class TestPreprocessFilter(unittest2.TestCase):
+    def setUp(self):
+        self.midware = mock.Mock(**{
+            'db.mget.return_value': ['lim_class'],
+        })
+        self.conf = {'rs_limits': {'lookup': 'mget'}}
+        self.state = rs_limits._get_state(self.midware, self.conf)
+        self.state.filter = rs_limits.GroupFilter(None)
+        self.state.filter.members = set(['grp3', 'grp4'])
+
+    def test_preprocess(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4',
+                   'turnstile.conf': self.conf}
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.midware.db.mget.assert_called_once_with(['rs-group:grp3',
+                                                      'rs-group:grp4'])
+
+    def test_preprocess_none_mapped(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                   'turnstile.conf': self.conf}
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertFalse('turnstile.nova.limitclass' in environ)
+        self.assertFalse(self.midware.db.mget.called)
+
+    def test_prepare(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp3,grp2',
+                   'turnstile.conf': self.conf}
+
+        result = rs_limits.rs_prepare(self.midware, environ)
+
+        self.assertEqual(result.command, ('MGET', 'rs-group:grp3'))
+
+    def test_prepare_none_mapped(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                   'turnstile.conf': self.conf}
+
+        result = rs_limits.rs_prepare(self.midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertFalse('turnstile.nova.limitclass' in environ)
+
+
+class TestPreprocessReplica(unittest2.TestCase):
+    def test_replica(self):
+        midware = mock.Mock()
+        replica = mock.Mock(**{'get.return_value': 'lim_class'})
+        conf = {'rs_limits': {}}
+        rs_limits._states[midware] = rs_limits.PreprocessState(
+            conf['rs_limits'], midware.db, replica)
+        environ = {'HTTP_X_PP_GROUPS': 'grp1', 'turnstile.conf': conf}
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        replica.get.assert_called_once_with('rs-group:grp1')
+        self.assertFalse(midware.db.get.called)
+
+
+class TestPreprocessCoalesce(unittest2.TestCase):
+    def test_coalesce(self):
+        def get(key):
+            eventlet.sleep(0.01)
+            return 'lim_class' if key == 'rs-group:grp2' else None
+
+        db = mock.Mock(**{'get.side_effect': get})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'metrics': 'memory'}}
+        state = rs_limits._get_state(midware, conf)
+
+        def preprocess(i):
+            environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                       'turnstile.conf': conf}
+            rs_limits.rs_preprocess(midware, environ)
+            return environ['turnstile.nova.limitclass']
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(preprocess, range(5)))
+
+        self.assertEqual(results, ['lim_class'] * 5)
+        self.assertEqual(db.get.call_count, 2)
+        self.assertEqual(state.metrics.stats()['counters']['coalesced'], 4)
+
+
+class TestTenantKey(unittest2.TestCase):
+    def test_disabled(self):
+        state = rs_limits.PreprocessState()
+        environ = {'nova.context': mock.Mock(project_id='tenant')}
+
+        self.assertEqual(rs_limits._tenant_key(state, environ, 'grp1', ''),
+                         None)
+
+    def test_no_context(self):
+        state = rs_limits.PreprocessState(dict(tenant_cache_size='10'))
+
+        self.assertEqual(rs_limits._tenant_key(state, {}, 'grp1', ''), None)
+
+    def test_no_tenant(self):
+        state = rs_limits.PreprocessState(dict(tenant_cache_size='10'))
+        environ = {'nova.context': mock.Mock(project_id=None)}
+
+        self.assertEqual(rs_limits._tenant_key(state, environ, 'grp1', ''),
+                         None)
+
+    def test_key(self):
+        state = rs_limits.PreprocessState(dict(tenant_cache_size='10'))
+        environ = {'nova.context': mock.Mock(project_id='tenant')}
+
+        key1 = rs_limits._tenant_key(state, environ, 'grp1', '')
+        key2 = rs_limits._tenant_key(state, environ, 'grp1', 'grp1=1')
+        key3 = rs_limits._tenant_key(state, environ, 'grp2', '')
+
+        self.assertEqual(key1[0], 'tenant')
+        self.assertEqual(key1, rs_limits._tenant_key(state, environ,
+                                                     'grp1', ''))
+        self.assertNotEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+
+
+class TestPreprocessTenant(unittest2.TestCase):
+    def setUp(self):
+        self.classes = {'rs-group:grp2': 'lim_class'}
+        self.db = mock.Mock(**{
+            'get.side_effect': lambda x: self.classes.get(x),
+        })
+        self.midware = mock.Mock(db=self.db)
+        self.conf = {'rs_limits': {'tenant_cache_size': '10',
+                                   'cache_listen': 'no',
+                                   'metrics': 'memory'}}
+        self.state = rs_limits._get_state(self.midware, self.conf)
+
+    def environ(self, groups='grp1,grp2', tenant='tenant'):
+        return {
+            'HTTP_X_PP_GROUPS': groups,
+            'nova.context': mock.Mock(project_id=tenant, quota_class=None,
+                                      spec=['project_id', 'quota_class']),
+            'turnstile.conf': self.conf,
+        }
 
-        gp = rs_limits.GroupPriorities(example)
+    @mock.patch.object(rs_limits, '_get_groups',
+                       wraps=rs_limits._get_groups)
+    def test_preprocess(self, mock_get_groups):
+        for i in range(3):
+            environ = self.environ()
 
-        self.assertEqual(gp, expected)
+            rs_limits.rs_preprocess(self.midware, environ)
 
-    def test_missing(self):
-        example = "=0.1, AdMin=0.5555, dElINQUenT=1.00000000"
+            self.assertEqual(environ['turnstile.nova.limitclass'],
+                             'lim_class')
+            self.assertEqual(environ['nova.context'].quota_class,
+                             'lim_class')
 
-        gp = rs_limits.GroupPriorities(example)
+        self.assertEqual(mock_get_groups.call_count, 1)
+        self.assertEqual(self.db.get.call_count, 2)
+
+    def test_preprocess_distinct(self):
+        rs_limits.rs_preprocess(self.midware, self.environ())
+        rs_limits.rs_preprocess(self.midware, self.environ(tenant='other'))
+        rs_limits.rs_preprocess(self.midware, self.environ(groups='grp2'))
+
+        self.assertEqual(len(self.state.tenant_cache), 3)
+        self.assertEqual(self.db.get.call_count, 5)
+
+    def test_preprocess_unmapped(self):
+        for i in range(2):
+            environ = self.environ(groups='grp3')
+
+            rs_limits.rs_preprocess(self.midware, environ)
+
+            self.assertFalse('turnstile.nova.limitclass' in environ)
+
+        self.assertEqual(self.db.get.call_count, 1)
+
+    def test_preprocess_no_tenant(self):
+        for i in range(2):
+            rs_limits.rs_preprocess(self.midware, self.environ(tenant=None))
+
+        self.assertEqual(len(self.state.tenant_cache), 0)
+        self.assertEqual(self.db.get.call_count, 4)
+
+    def test_preprocess_invalidated(self):
+        def fake_get(key):
+            # Simulate a change announced during the lookup
+            self.state.invalidate('grp1')
+            return 'lim_class'
+        self.db.get.side_effect = fake_get
+        environ = self.environ(groups='grp1')
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertEqual(len(self.state.tenant_cache), 0)
+
+    def test_preprocess_fallback(self):
+        self.state.breaker = rs_limits.CircuitBreaker()
+        self.state.breaker.state = 'open'
+        self.state.breaker.opened = float('inf')
+        self.state.stale = rs_limits.MappingCache(10)
+        self.state.stale.store(('grp1,grp2', ''), 'stale_class')
+        environ = self.environ()
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'stale_class')
+        self.assertEqual(len(self.state.tenant_cache), 0)
+
+    def test_preprocess_resolution_cache(self):
+        self.state.resolution_cache = rs_limits.MappingCache(10)
+        self.state.resolution_cache.store(('grp1,grp2', ''), 'cached')
+        environ = self.environ()
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'cached')
+        key = rs_limits._tenant_key(self.state, environ, 'grp1,grp2', '')
+        self.assertEqual(self.state.tenant_cache.lookup(key), 'cached')
+        self.assertFalse(self.db.get.called)
+
+    def test_prepare(self):
+        environ = self.environ()
+
+        pending = rs_limits.rs_prepare(self.midware, environ)
+        pending.complete([None, 'lim_class'])
+
+        environ = self.environ()
+        result = rs_limits.rs_prepare(self.midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertEqual(environ['nova.context'].quota_class, 'lim_class')
+
+
+class TestPreprocessPriorities(unittest2.TestCase):
+    def setUp(self):
+        classes = {'rs-group:grp1': 'cls1', 'rs-group:grp2': 'cls2'}
+        self.midware = mock.Mock(**{
+            'db.get.side_effect': lambda x: classes.get(x),
+        })
+        self.conf = {'rs_limits': {'groups': 'grp1=0.9,grp2=0.1',
+                                   'resolution_cache_size': '10',
+                                   'cache_listen': 'no'}}
+        self.state = rs_limits._get_state(self.midware, self.conf)
+        self.state.priorities = rs_limits.PriorityWatcher('db')
+
+    def preprocess(self):
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2',
+            'turnstile.conf': self.conf,
+        }
+        rs_limits.rs_preprocess(self.midware, environ)
+        return environ['turnstile.nova.limitclass']
+
+    def test_preprocess(self):
+        self.assertEqual(self.preprocess(), 'cls1')
+
+        # Reloading the priorities takes effect immediately
+        self.state.priorities.prios = rs_limits.GroupPriorities(
+            'grp1=0.1,grp2=0.9')
+
+        self.assertEqual(self.preprocess(), 'cls2')
+
+        # As does deleting them
+        self.state.priorities.prios = None
+
+        self.assertEqual(self.preprocess(), 'cls1')
+
+    def test_prepare(self):
+        self.state.priorities.prios = rs_limits.GroupPriorities(
+            'grp1=0.1,grp2=0.9')
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2',
+            'turnstile.conf': self.conf,
+        }
+
+        pending = rs_limits.rs_prepare(self.midware, environ)
+
+        self.assertEqual(pending.command, ('MGET', 'rs-group:grp2',
+                                           'rs-group:grp1'))
+
+
+class TestPreprocessTable(unittest2.TestCase):
+    def setUp(self):
+        self.midware = mock.Mock(**{'db.get.return_value': 'db_class'})
+        self.conf = {'rs_limits': {'metrics': 'memory'}}
+        self.state = rs_limits._get_state(self.midware, self.conf)
+        self.state.table = rs_limits.ResolutionTable('db')
+        self.state.table.entries = {
+            ('grp1', 'grp2'): 'lim_class',
+            ('grp3',): None,
+        }
+
+    def test_preprocess(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                   'turnstile.conf': self.conf}
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertFalse(self.midware.db.get.called)
+        self.assertEqual(
+            self.state.metrics.stats()['counters']['table_hit'], 1)
+
+    def test_preprocess_unmapped(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp3', 'turnstile.conf': self.conf}
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertFalse('turnstile.nova.limitclass' in environ)
+        self.assertFalse(self.midware.db.get.called)
+
+    def test_preprocess_miss(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp2,grp1',
+                   'turnstile.conf': self.conf}
+
+        rs_limits.rs_preprocess(self.midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'db_class')
+        self.midware.db.get.assert_called_once_with('rs-group:grp2')
+
+    def test_prepare(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                   'turnstile.conf': self.conf}
+
+        result = rs_limits.rs_prepare(self.midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+
+    def test_prepare_miss(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp4', 'turnstile.conf': self.conf}
+
+        result = rs_limits.rs_prepare(self.midware, environ)
+
+        self.assertEqual(result.command, ('MGET', 'rs-group:grp4'))
 
-        self.assertEqual(gp['nobody'], 0.1)
-        self.assertEqual(gp['AdMin'], 0.1)
-        self.assertEqual(gp['admin'], 0.5555)
+
+class TestPreprocessProfiler(unittest2.TestCase):
+    def setUp(self):
+        self.midware = mock.Mock(**{'db.get.return_value': 'lim_class'})
+        self.conf = {'rs_limits': {'profile': 'stages',
+                                   'profile_rate': '2'}}
+        self.state = rs_limits._get_state(self.midware, self.conf)
+
+    def preprocess(self):
+        environ = {'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                   'turnstile.conf': self.conf}
+        rs_limits.rs_preprocess(self.midware, environ)
+        return environ['turnstile.nova.limitclass']
+
+    def test_sample(self):
+        results = [self.preprocess() for i in range(4)]
+
+        self.assertEqual(results, ['lim_class'] * 4)
+        self.assertEqual(self.state.profiler.calls, 4)
+        self.assertEqual(self.state.profiler.samples, 2)
+
+    def test_stages(self):
+        self.state.resolution_cache = rs_limits.MappingCache(10)
+        self.state.profiler.rate = 1
+
+        self.preprocess()
+        self.preprocess()
+
+        # The first call is resolved from the database, and the second
+        # from the resolution cache
+        stages = self.state.profiler.stages
+        self.assertEqual(sorted(stages), ['cache', 'finish', 'lookup',
+                                          'parse', 'remap', 'resolve',
+                                          'sort'])
+        self.assertEqual(stages['cache'][0], 2)
+        self.assertEqual(stages['lookup'][0], 1)
+
+    def test_header_cache(self):
+        self.state.profiler.rate = 1
+
+        self.preprocess()
+        self.preprocess()
+
+        stages = self.state.profiler.stages
+        self.assertEqual(stages['header_cache'][0], 1)
+        self.assertEqual(stages['parse'][0], 1)
+
+    def test_cprofile(self):
+        self.state.profiler.cprofile = True
+
+        self.preprocess()
+        self.preprocess()
+
+        self.assertIsInstance(self.state.profiler.stats, pstats.Stats)
+        self.assertEqual(self.state.profiler.stages, {})
 
 
 class TestPreprocess(unittest2.TestCase):
@@ -100,45 +3336,282 @@ class TestPreprocess(unittest2.TestCase):
             mock.call.get('rs-group:grp1'),
         ])
 
-    def test_group_select(self):
+    def test_group_select(self):
+        classes = {'rs-group:grp3': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        environ = dict(
+            HTTP_X_PP_GROUPS='grp1,grp2,grp3,grp4,grp5',
+        )
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ, {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
+            'turnstile.nova.limitclass': 'lim_class',
+        })
+        db.assert_has_calls([
+            mock.call.get('rs-group:grp1'),
+            mock.call.get('rs-group:grp2'),
+            mock.call.get('rs-group:grp3'),
+        ])
+
+    @mock.patch.object(rs_limits, '_parse_header',
+                       return_value=(('grp2', 'grp1'), True))
+    def test_group_header_cache(self, mock_parse_header):
+        classes = {'rs-group:grp1': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'groups': 'grp2=0.5'}}
+
+        for i in range(3):
+            environ = {
+                'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                'turnstile.conf': conf,
+            }
+
+            rs_limits.rs_preprocess(midware, environ)
+
+            self.assertEqual(environ['turnstile.nova.limitclass'],
+                             'lim_class')
+
+        state = rs_limits._get_state(midware, conf)
+        mock_parse_header.assert_called_once_with('grp1,grp2', state.prios,
+                                                  None)
+        self.assertEqual(state.header_cache.lookup(('grp1,grp2',
+                                                    'grp2=0.5')),
+                         (('grp2', 'grp1'), True))
+
+        # Changing the priorities must not use the cached result
+        conf['rs_limits']['groups'] = 'grp1=0.5'
+        rs_limits.rs_preprocess(midware, {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2',
+            'turnstile.conf': conf,
+        })
+        self.assertEqual(mock_parse_header.call_count, 2)
+
+    @mock.patch.object(rs_limits, '_parse_groups',
+                       return_value=('grp2', 'grp1'))
+    def test_group_header_cache_disabled(self, mock_parse_groups):
+        db = mock.Mock(**{'get.return_value': None})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'header_cache_size': '0'}}
+
+        for i in range(2):
+            rs_limits.rs_preprocess(midware, {
+                'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                'turnstile.conf': conf,
+            })
+
+        self.assertEqual(mock_parse_groups.call_count, 2)
+        self.assertEqual(rs_limits._get_state(midware, conf).header_cache,
+                         None)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_group_resolution_cache(self, mock_spawn_n):
+        classes = {'rs-group:grp2': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'resolution_cache_size': '10'}}
+
+        for i in range(3):
+            context = mock.Mock(quota_class=None, spec=['quota_class'])
+            environ = {
+                'HTTP_X_PP_GROUPS': 'grp1,grp2',
+                'nova.context': context,
+                'turnstile.conf': conf,
+            }
+            rs_limits.rs_preprocess(midware, environ)
+
+            self.assertEqual(environ['turnstile.nova.limitclass'],
+                             'lim_class')
+            self.assertEqual(context.quota_class, 'lim_class')
+
+            environ = {
+                'HTTP_X_PP_GROUPS': 'grp3',
+                'turnstile.conf': conf,
+            }
+            rs_limits.rs_preprocess(midware, environ)
+
+            self.assertFalse('turnstile.nova.limitclass' in environ)
+
+        self.assertEqual(db.get.call_args_list, [
+            mock.call('rs-group:grp1'),
+            mock.call('rs-group:grp2'),
+            mock.call('rs-group:grp3'),
+        ])
+
+        # Invalidating should cause the lookup to be repeated
+        state = rs_limits._get_state(midware, conf)
+        state.invalidate('grp2')
+        rs_limits.rs_preprocess(midware, {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2',
+            'turnstile.conf': conf,
+        })
+        self.assertEqual(db.get.call_count, 5)
+
+    def test_group_resolution_cache_invalidated(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {'resolution_cache_size': '10',
+                              'cache_listen': 'no'}}
+        state = rs_limits._get_state(midware, conf)
+
+        def fake_get(key):
+            # Simulate a change announced during the lookup
+            state.invalidate('grp1')
+            return 'lim_class'
+        midware.db.get.side_effect = fake_get
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1',
+            'turnstile.conf': conf,
+        }
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertEqual(len(state.resolution_cache), 0)
+
+    def test_group_repose_workaround(self):
+        classes = {'rs-group:grp5': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
+            'turnstile.conf': {'rs_limits': {'groups': "grp5=1.0"}},
+        }
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ, {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
+            'turnstile.conf': {'rs_limits': {'groups': "grp5=1.0"}},
+            'turnstile.nova.limitclass': 'lim_class',
+        })
+        db.assert_has_calls([
+            mock.call.get('rs-group:grp5'),
+        ])
+
+    def test_group_select_mget(self):
+        db = mock.Mock(**{'mget.return_value': [None, 'lim_class', None]})
+        midware = mock.Mock(db=db)
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1;q=0.5,grp2;q=0.7,grp3;q=0.9',
+            'turnstile.conf': {'rs_limits': {'lookup': 'mget'}},
+        }
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        db.mget.assert_called_once_with([
+            'rs-group:grp3',
+            'rs-group:grp2',
+            'rs-group:grp1',
+        ])
+        self.assertFalse(db.get.called)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_group_select_cached(self, mock_spawn_n):
+        classes = {'rs-group:grp3': 'lim_class'}
+        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {'cache_size': '10'}}
+
+        for i in range(2):
+            environ = {
+                'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
+                'turnstile.conf': conf,
+            }
+
+            rs_limits.rs_preprocess(midware, environ)
+
+            self.assertEqual(environ['turnstile.nova.limitclass'],
+                             'lim_class')
+
+        self.assertEqual(db.get.call_args_list, [
+            mock.call('rs-group:grp1'),
+            mock.call('rs-group:grp2'),
+            mock.call('rs-group:grp3'),
+        ])
+        state = rs_limits._get_state(midware, conf)
+        self.assertEqual(state.cache.stats(), dict(size=3, hits=3, misses=3))
+        mock_spawn_n.assert_called_once_with(state.listener.run)
+
+    def test_group_select_snapshot(self):
+        db = mock.Mock()
+        midware = mock.Mock(db=db)
+        conf = {'rs_limits': {}}
+        state = rs_limits._get_state(midware, conf)
+        state.snapshot = mock.Mock(**{
+            'fresh.return_value': True,
+            'mget.return_value': [None, None, 'lim_class', None, None],
+        })
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
+            'turnstile.conf': conf,
+        }
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        state.snapshot.mget.assert_called_once_with([
+            'rs-group:grp1',
+            'rs-group:grp2',
+            'rs-group:grp3',
+            'rs-group:grp4',
+            'rs-group:grp5',
+        ])
+        self.assertFalse(db.get.called)
+
+    def test_group_select_snapshot_stale(self):
         classes = {'rs-group:grp3': 'lim_class'}
         db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
         midware = mock.Mock(db=db)
-        environ = dict(
-            HTTP_X_PP_GROUPS='grp1,grp2,grp3,grp4,grp5',
-        )
+        conf = {'rs_limits': {}}
+        state = rs_limits._get_state(midware, conf)
+        state.snapshot = mock.Mock(**{'fresh.return_value': False})
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
+            'turnstile.conf': conf,
+        }
 
         rs_limits.rs_preprocess(midware, environ)
 
-        self.assertEqual(environ, {
-            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
-            'turnstile.nova.limitclass': 'lim_class',
-        })
-        db.assert_has_calls([
-            mock.call.get('rs-group:grp1'),
-            mock.call.get('rs-group:grp2'),
-            mock.call.get('rs-group:grp3'),
-        ])
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertFalse(state.snapshot.get.called)
+        self.assertEqual(db.get.call_count, 3)
 
-    def test_group_repose_workaround(self):
-        classes = {'rs-group:grp5': 'lim_class'}
-        db = mock.Mock(**{'get.side_effect': lambda x: classes.get(x)})
+    def test_group_select_hash(self):
+        db = mock.Mock(**{'hmget.return_value': [None, 'lim_class', None]})
         midware = mock.Mock(db=db)
         environ = {
-            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
-            'turnstile.conf': {'rs_limits': {'groups': "grp5=1.0"}},
+            'HTTP_X_PP_GROUPS': 'grp1;q=0.5,grp2;q=0.7,grp3;q=0.9',
+            'turnstile.conf': {'rs_limits': {'storage': 'hash'}},
         }
 
         rs_limits.rs_preprocess(midware, environ)
 
-        self.assertEqual(environ, {
-            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4,grp5',
-            'turnstile.conf': {'rs_limits': {'groups': "grp5=1.0"}},
-            'turnstile.nova.limitclass': 'lim_class',
-        })
-        db.assert_has_calls([
-            mock.call.get('rs-group:grp5'),
-        ])
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        db.hmget.assert_called_once_with(rs_limits.GROUP_HASH,
+                                         ['grp3', 'grp2', 'grp1'])
+        self.assertFalse(db.get.called)
+        self.assertFalse(db.mget.called)
+
+    def test_group_select_lua(self):
+        db = mock.Mock(**{'evalsha.return_value': [1, 'lim_class']})
+        midware = mock.Mock(db=db)
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1;q=0.5,grp2;q=0.7,grp3;q=0.9',
+            'turnstile.conf': {'rs_limits': {'lookup': 'lua'}},
+        }
+
+        rs_limits.rs_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        db.evalsha.assert_called_once_with(
+            rs_limits._first_match_keys.sha, 3,
+            'rs-group:grp3', 'rs-group:grp2', 'rs-group:grp1')
+        self.assertFalse(db.get.called)
+        self.assertFalse(db.mget.called)
 
     def test_group_context_no_quota_class(self):
         classes = {'rs-group:grp3': 'lim_class'}
@@ -181,99 +3654,528 @@ class TestPreprocess(unittest2.TestCase):
         self.assertEqual(context.quota_class, 'lim_class')
 
 
+class TestPendingResolution(unittest2.TestCase):
+    def test_init_keys(self):
+        state = rs_limits.PreprocessState({})
+        unres = rs_limits._unresolved
+
+        pending = rs_limits.PendingResolution(
+            state, {}, None, ('key', ''), ['grp1', 'grp2', 'grp3'],
+            [unres, None, unres], 0)
+
+        self.assertEqual(pending.missing, [0, 2])
+        self.assertEqual(pending.command,
+                         ('MGET', 'rs-group:grp1', 'rs-group:grp3'))
+
+    def test_init_hash(self):
+        state = rs_limits.PreprocessState({'storage': 'hash'})
+        unres = rs_limits._unresolved
+
+        pending = rs_limits.PendingResolution(
+            state, {}, None, ('key', ''), ['grp1', 'grp2', 'grp3'],
+            [unres, None, unres], 0)
+
+        self.assertEqual(pending.command,
+                         ('HMGET', rs_limits.GROUP_HASH, 'grp1', 'grp3'))
+
+    def test_complete(self):
+        state = rs_limits.PreprocessState({
+            'cache_size': '10',
+            'resolution_cache_size': '10',
+        })
+        environ = {}
+        unres = rs_limits._unresolved
+        pending = rs_limits.PendingResolution(
+            state, environ, None, ('key', ''), ['grp1', 'grp2', 'grp3'],
+            [unres, None, unres], 0)
+
+        result = pending.complete([None, 'lim_class'])
+
+        self.assertEqual(result, 'lim_class')
+        self.assertEqual(environ, {'turnstile.nova.limitclass': 'lim_class'})
+        self.assertEqual(state.cache.lookup('rs-group:grp1', unres), None)
+        self.assertEqual(state.cache.lookup('rs-group:grp3'), 'lim_class')
+        self.assertEqual(state.resolution_cache.lookup(('key', '')),
+                         'lim_class')
+
+    def test_complete_unmapped(self):
+        environ = {}
+        pending = rs_limits.PendingResolution(
+            rs_limits.PreprocessState({}), environ, None, ('key', ''),
+            ['grp1'], [rs_limits._unresolved], 0)
+
+        result = pending.complete([None])
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ, {})
+
+    def test_complete_invalidated(self):
+        state = rs_limits.PreprocessState({
+            'cache_size': '10',
+            'resolution_cache_size': '10',
+        })
+        pending = rs_limits.PendingResolution(
+            state, {}, None, ('key', ''), ['grp1'], [rs_limits._unresolved],
+            0)
+        state.invalidate('grp1')
+
+        pending.complete(['lim_class'])
+
+        self.assertEqual(len(state.cache), 0)
+        self.assertEqual(len(state.resolution_cache), 0)
+
+
+class TestPrepare(unittest2.TestCase):
+    def test_nogroups(self):
+        midware = mock.Mock()
+        environ = {}
+
+        result = rs_limits.rs_prepare(midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ, {})
+
+    def test_pending(self):
+        midware = mock.Mock()
+        context = mock.Mock(quota_class=None)
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2;q=0.5,grp3;q=0.7',
+            'nova.context': context,
+        }
+
+        result = rs_limits.rs_prepare(midware, environ)
+
+        self.assertEqual(result.command, ('MGET', 'rs-group:grp1',
+                                          'rs-group:grp3', 'rs-group:grp2'))
+        self.assertFalse(midware.db.method_calls)
+        self.assertFalse('turnstile.nova.limitclass' in environ)
+
+        result.complete([None, 'lim_class', None])
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        self.assertEqual(context.quota_class, 'lim_class')
+
+    def test_partially_cached(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {'cache_size': '10'}}
+        state = rs_limits._get_state(midware, conf)
+        state.cache.store('rs-group:grp1', None)
+        state.cache.store('rs-group:grp3', 'lim_class')
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3,grp4',
+            'turnstile.conf': conf,
+        }
+
+        result = rs_limits.rs_prepare(midware, environ)
+
+        self.assertEqual(result.command, ('MGET', 'rs-group:grp2'))
+
+        result.complete([None])
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+
+    def test_fully_cached(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {'cache_size': '10'}}
+        state = rs_limits._get_state(midware, conf)
+        state.cache.store('rs-group:grp1', None)
+        state.cache.store('rs-group:grp2', 'lim_class')
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2,grp3',
+            'turnstile.conf': conf,
+        }
+
+        result = rs_limits.rs_prepare(midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+
+    def test_snapshot(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {}}
+        state = rs_limits._get_state(midware, conf)
+        state.snapshot = mock.Mock(**{
+            'fresh.return_value': True,
+            'mget.return_value': [None, 'lim_class'],
+        })
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2',
+            'turnstile.conf': conf,
+        }
+
+        result = rs_limits.rs_prepare(midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+        state.snapshot.mget.assert_called_once_with(['rs-group:grp1',
+                                                     'rs-group:grp2'])
+
+    def test_resolution_cache(self):
+        midware = mock.Mock()
+        conf = {'rs_limits': {'resolution_cache_size': '10'}}
+        state = rs_limits._get_state(midware, conf)
+        state.resolution_cache.store(('grp1,grp2', ''), 'lim_class')
+        environ = {
+            'HTTP_X_PP_GROUPS': 'grp1,grp2',
+            'turnstile.conf': conf,
+        }
+
+        result = rs_limits.rs_prepare(midware, environ)
+
+        self.assertEqual(result, None)
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'lim_class')
+
+
 class TestCheckArguments(unittest2.TestCase):
     def test_neither(self):
-        args = mock.Mock(klass=None, delete=False)
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass=None, delete=False, priorities=None)
 
         # Checking that no exceptions are raised
         rs_limits._check_arguments(args)
 
     def test_klass_only(self):
-        args = mock.Mock(klass='class', delete=False)
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass='class', delete=False, priorities=None)
 
         # Checking that no exceptions are raised
         rs_limits._check_arguments(args)
 
     def test_delete_only(self):
-        args = mock.Mock(klass=None, delete=True)
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass=None, delete=True, priorities=None)
+
+        # Checking that no exceptions are raised
+        rs_limits._check_arguments(args)
+
+    def test_both(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass='class', delete=True, priorities=None)
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+    def test_no_group(self):
+        args = mock.Mock(group=None, listing=False, counts=False,
+                         klass=None, delete=False, priorities=None)
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+    def test_listing(self):
+        for listing, counts in ((True, False), (False, True), (True, True)):
+            args = mock.Mock(group=None, listing=listing, counts=counts,
+                             klass=None, delete=False, priorities=None)
+
+            # Checking that no exceptions are raised
+            rs_limits._check_arguments(args)
+
+    def test_listing_klass(self):
+        args = mock.Mock(group=None, listing=True, counts=False,
+                         klass='class', delete=False, priorities=None)
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+    def test_counts_delete(self):
+        args = mock.Mock(group=None, listing=False, counts=True,
+                         klass=None, delete=True, priorities=None)
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+    def test_priorities(self):
+        for priorities, delete in ((True, False), (True, True),
+                                   ('admin=0.5', False)):
+            args = mock.Mock(group=None, listing=False, counts=False,
+                             klass=None, delete=delete,
+                             priorities=priorities)
+
+            # Checking that no exceptions are raised
+            rs_limits._check_arguments(args)
+
+    def test_priorities_set_delete(self):
+        args = mock.Mock(group=None, listing=False, counts=False,
+                         klass=None, delete=True, priorities='admin=0.5')
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+    def test_priorities_klass(self):
+        args = mock.Mock(group=None, listing=False, counts=False,
+                         klass='class', delete=False, priorities=True)
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+    def test_priorities_listing(self):
+        args = mock.Mock(group=None, listing=True, counts=False,
+                         klass=None, delete=False, priorities=True)
+
+        self.assertRaises(Exception, rs_limits._check_arguments, args)
+
+
+class TestReportGroupClass(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_unconfigured(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass=None, delete=False, priorities=None)
+
+        result = rs_limits._report_group_class(args, None)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group group:\n"
+                         "  Not currently configured in database.\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_configured(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass=None, delete=False, priorities=None)
+
+        result = rs_limits._report_group_class(args, 'old_class')
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group group:\n"
+                         "  Configured rate-limit class: old_class\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_deleted_unconfigured(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass=None, delete=True, priorities=None)
+
+        result = rs_limits._report_group_class(args, None)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group group:\n"
+                         "  Deleted from database\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_deleted(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass=None, delete=True, priorities=None)
+
+        result = rs_limits._report_group_class(args, 'old_class')
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group group:\n"
+                         "  Previous rate-limit class: old_class\n"
+                         "  Deleted from database\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_updated_unconfigured(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass='new_class', delete=False, priorities=None)
+
+        result = rs_limits._report_group_class(args, None)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group group:\n"
+                         "  New rate-limit class: new_class\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_updated(self):
+        args = mock.Mock(group='group', listing=False, counts=False,
+                         klass='new_class', delete=False, priorities=None)
+
+        result = rs_limits._report_group_class(args, 'old_class')
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group group:\n"
+                         "  Previous rate-limit class: old_class\n"
+                         "  New rate-limit class: new_class\n")
+
+
+class TestReportGroupPriorities(unittest2.TestCase):
+    def args(self, priorities=True, delete=False):
+        return mock.Mock(group=None, listing=False, counts=False,
+                         klass=None, delete=delete, priorities=priorities)
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_unconfigured(self):
+        result = rs_limits._report_group_class(self.args(), (None, None))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group priorities:\n"
+                         "  Not currently configured in database.\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_configured(self):
+        result = rs_limits._report_group_class(self.args(),
+                                               ('3', 'admin=0.5'))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group priorities:\n"
+                         "  Configured priorities: admin=0.5\n"
+                         "  Version: 3\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_deleted(self):
+        result = rs_limits._report_group_class(self.args(delete=True),
+                                               ('3', 'admin=0.5'))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group priorities:\n"
+                         "  Previous priorities: admin=0.5\n"
+                         "  Deleted from database\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_updated_unconfigured(self):
+        result = rs_limits._report_group_class(self.args('admin=0.7'),
+                                               (None, None))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group priorities:\n"
+                         "  New priorities: admin=0.7\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_updated(self):
+        result = rs_limits._report_group_class(self.args('admin=0.7'),
+                                               ('3', 'admin=0.5'))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group priorities:\n"
+                         "  Previous priorities: admin=0.5\n"
+                         "  New priorities: admin=0.7\n")
+
+
+class TestGroupPrioritiesCommand(unittest2.TestCase):
+    def setUp(self):
+        self.db = mock.Mock(**{'hmget.return_value': ['3', 'admin=0.5']})
+        self.pipe = self.db.pipeline.return_value
+
+    def test_get(self):
+        result = rs_limits._group_priorities(self.db)
+
+        self.assertEqual(result, ('3', 'admin=0.5'))
+        self.db.hmget.assert_called_once_with(rs_limits.PRIORITIES_KEY,
+                                              ['version', 'groups'])
+        self.assertFalse(self.db.pipeline.called)
+
+    def test_set(self):
+        result = rs_limits._group_priorities(self.db, 'admin=0.7')
+
+        self.assertEqual(result, ('3', 'admin=0.5'))
+        self.pipe.assert_has_calls([
+            mock.call.hset(rs_limits.PRIORITIES_KEY, 'groups', 'admin=0.7'),
+            mock.call.hincrby(rs_limits.PRIORITIES_KEY, 'version', 1),
+            mock.call.execute(),
+        ])
+
+    def test_set_unchanged(self):
+        rs_limits._group_priorities(self.db, 'admin=0.5')
+
+        self.assertFalse(self.db.pipeline.called)
+
+    def test_delete(self):
+        result = rs_limits._group_priorities(self.db, delete=True)
+
+        self.assertEqual(result, ('3', 'admin=0.5'))
+        self.pipe.assert_has_calls([
+            mock.call.hdel(rs_limits.PRIORITIES_KEY, 'groups'),
+            mock.call.hincrby(rs_limits.PRIORITIES_KEY, 'version', 1),
+            mock.call.execute(),
+        ])
+
+    def test_delete_unconfigured(self):
+        self.db.hmget.return_value = [None, None]
 
-        # Checking that no exceptions are raised
-        rs_limits._check_arguments(args)
+        result = rs_limits._group_priorities(self.db, delete=True)
 
-    def test_both(self):
-        args = mock.Mock(klass='class', delete=True)
+        self.assertEqual(result, (None, None))
+        self.assertFalse(self.db.pipeline.called)
 
-        self.assertRaises(Exception, rs_limits._check_arguments, args)
 
+class TestReportGroupList(unittest2.TestCase):
+    mappings = [('grp1', 'cls1'), ('grp2', 'cls2'), ('grp3', 'cls1')]
 
-class TestReportGroupClass(unittest2.TestCase):
     @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_unconfigured(self):
-        args = mock.Mock(group='group', klass=None, delete=False)
+    def test_listing(self):
+        args = mock.Mock(group=None, listing=True, counts=False,
+                         klass=None, delete=False, priorities=None)
 
-        result = rs_limits._report_group_class(args, None)
+        result = rs_limits._report_group_class(args, iter(self.mappings))
 
         self.assertEqual(result, None)
         self.assertEqual(sys.stdout.getvalue(),
-                         "Group group:\n"
-                         "  Not currently configured in database.\n")
+                         "Group grp1: cls1\n"
+                         "Group grp2: cls2\n"
+                         "Group grp3: cls1\n")
 
     @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_configured(self):
-        args = mock.Mock(group='group', klass=None, delete=False)
+    def test_counts(self):
+        args = mock.Mock(group=None, listing=False, counts=True,
+                         klass=None, delete=False, priorities=None)
 
-        result = rs_limits._report_group_class(args, 'old_class')
+        result = rs_limits._report_group_class(args, iter(self.mappings))
 
         self.assertEqual(result, None)
         self.assertEqual(sys.stdout.getvalue(),
-                         "Group group:\n"
-                         "  Configured rate-limit class: old_class\n")
+                         "Groups per rate-limit class:\n"
+                         "  cls1: 2\n"
+                         "  cls2: 1\n"
+                         "  Total: 3\n")
 
     @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_deleted_unconfigured(self):
-        args = mock.Mock(group='group', klass=None, delete=True)
+    def test_listing_counts(self):
+        args = mock.Mock(group=None, listing=True, counts=True,
+                         klass=None, delete=False, priorities=None)
 
-        result = rs_limits._report_group_class(args, None)
+        rs_limits._report_group_class(args, iter(self.mappings[:1]))
 
-        self.assertEqual(result, None)
         self.assertEqual(sys.stdout.getvalue(),
-                         "Group group:\n"
-                         "  Deleted from database\n")
+                         "Group grp1: cls1\n"
+                         "Groups per rate-limit class:\n"
+                         "  cls1: 1\n"
+                         "  Total: 1\n")
 
-    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_deleted(self):
-        args = mock.Mock(group='group', klass=None, delete=True)
 
-        result = rs_limits._report_group_class(args, 'old_class')
+class TestScanMappings(unittest2.TestCase):
+    def test_scan(self):
+        data = {'rs-group:grp1': 'cls1', 'rs-group:grp3': 'cls3'}
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter(['rs-group:grp1', 'rs-group:grp2',
+                                            'rs-group:grp3']),
+            'mget.side_effect': lambda keys: [data.get(k) for k in keys],
+        })
 
-        self.assertEqual(result, None)
-        self.assertEqual(sys.stdout.getvalue(),
-                         "Group group:\n"
-                         "  Previous rate-limit class: old_class\n"
-                         "  Deleted from database\n")
+        result = list(rs_limits._scan_mappings(db, 'grp*', 2))
 
-    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_updated_unconfigured(self):
-        args = mock.Mock(group='group', klass='new_class', delete=False)
+        self.assertEqual(result, [[('grp1', 'cls1')], [('grp3', 'cls3')]])
+        db.scan_iter.assert_called_once_with(match='rs-group:grp*', count=2)
 
-        result = rs_limits._report_group_class(args, None)
+    def test_lazy(self):
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter(['rs-group:grp1', 'rs-group:grp2',
+                                            'rs-group:grp3']),
+            'mget.side_effect': lambda keys: ['cls'] * len(keys),
+        })
 
-        self.assertEqual(result, None)
-        self.assertEqual(sys.stdout.getvalue(),
-                         "Group group:\n"
-                         "  New rate-limit class: new_class\n")
+        result = rs_limits._list_mappings(db, batch=2)
 
-    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_updated(self):
-        args = mock.Mock(group='group', klass='new_class', delete=False)
+        self.assertFalse(db.scan_iter.called)
+        self.assertEqual(result.next(), ('grp1', 'cls'))
+        self.assertEqual(db.mget.call_count, 1)
+        self.assertEqual(list(result), [('grp2', 'cls'), ('grp3', 'cls')])
+        self.assertEqual(db.mget.call_count, 2)
 
-        result = rs_limits._report_group_class(args, 'old_class')
+    def test_hash(self):
+        db = mock.Mock(**{
+            'hscan_iter.return_value': iter([('grp1', 'cls1')]),
+            'hmget.return_value': ['cls1'],
+        })
 
-        self.assertEqual(result, None)
-        self.assertEqual(sys.stdout.getvalue(),
-                         "Group group:\n"
-                         "  Previous rate-limit class: old_class\n"
-                         "  New rate-limit class: new_class\n")
+        result = list(rs_limits._list_mappings(rs_limits.HashDatabase(db),
+                                               'grp*'))
+
+        self.assertEqual(result, [('grp1', 'cls1')])
+        db.hscan_iter.assert_called_once_with('rs-groups', match='grp*',
+                                              count=1000)
+        db.hmget.assert_called_once_with('rs-groups', ['grp1'])
 
 
 class TestGroupClass(unittest2.TestCase):
@@ -281,7 +4183,53 @@ class TestGroupClass(unittest2.TestCase):
         self.assertIsInstance(rs_limits.group_class, tools.ScriptAdaptor)
         self.assertGreater(len(rs_limits.group_class._arguments), 0)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
+    }))
+    @mock.patch.object(rs_limits, '_list_mappings',
+                       return_value=iter([('grp1', 'cls1')]))
+    def test_list(self, mock_list_mappings, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = rs_limits.group_class('config_file', None, listing=True)
+
+        self.assertEqual(list(result), [('grp1', 'cls1')])
+        mock_list_mappings.assert_called_once_with(db, '*', 1000)
+        self.assertFalse(db.get.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
+    }))
+    @mock.patch.object(rs_limits, '_list_mappings', return_value=iter([]))
+    def test_counts_pattern(self, mock_list_mappings, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        rs_limits.group_class('config_file', 'grp*', counts=True, batch=50)
+
+        mock_list_mappings.assert_called_once_with(db, 'grp*', 50)
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {'storage': 'hash'},
+    }))
+    @mock.patch.object(rs_limits, '_group_priorities',
+                       return_value=('3', 'admin=0.5'))
+    def test_priorities(self, mock_group_priorities, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = rs_limits.group_class('config_file', None, priorities=True)
+        rs_limits.group_class('config_file', None, priorities='admin=0.7')
+        rs_limits.group_class('config_file', None, priorities=True,
+                              delete=True)
+
+        self.assertEqual(result, ('3', 'admin=0.5'))
+        self.assertEqual(mock_group_priorities.call_args_list, [
+            mock.call(db, None, False),
+            mock.call(db, 'admin=0.7', False),
+            mock.call(db, None, True),
+        ])
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
         'get_database.return_value': mock.Mock(**{
             'get.return_value': 'old_class',
         }),
@@ -296,8 +4244,10 @@ class TestGroupClass(unittest2.TestCase):
         db.get.assert_called_once_with('rs-group:spam')
         self.assertFalse(db.set.called)
         self.assertFalse(db.delete.called)
+        self.assertFalse(db.publish.called)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
         'get_database.return_value': mock.Mock(**{
             'get.return_value': None,
         }),
@@ -312,8 +4262,10 @@ class TestGroupClass(unittest2.TestCase):
         db.get.assert_called_once_with('rs-group:spam')
         self.assertFalse(db.set.called)
         self.assertFalse(db.delete.called)
+        self.assertFalse(db.publish.called)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
         'get_database.return_value': mock.Mock(**{
             'get.return_value': 'old_class',
         }),
@@ -329,8 +4281,11 @@ class TestGroupClass(unittest2.TestCase):
         db.get.assert_called_once_with('rs-group:spam')
         db.set.assert_called_once_with('rs-group:spam', 'new_class')
         self.assertFalse(db.delete.called)
+        db.publish.assert_called_once_with(rs_limits.GROUP_CHANNEL, 'spam')
+        db.incr.assert_called_once_with(rs_limits.EPOCH_KEY)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
         'get_database.return_value': mock.Mock(**{
             'get.return_value': None,
         }),
@@ -346,8 +4301,11 @@ class TestGroupClass(unittest2.TestCase):
         db.get.assert_called_once_with('rs-group:spam')
         db.set.assert_called_once_with('rs-group:spam', 'new_class')
         self.assertFalse(db.delete.called)
+        db.publish.assert_called_once_with(rs_limits.GROUP_CHANNEL, 'spam')
+        db.incr.assert_called_once_with(rs_limits.EPOCH_KEY)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
         'get_database.return_value': mock.Mock(**{
             'get.return_value': 'old_class',
         }),
@@ -362,8 +4320,11 @@ class TestGroupClass(unittest2.TestCase):
         db.get.assert_called_once_with('rs-group:spam')
         self.assertFalse(db.set.called)
         db.delete.assert_called_once_with('rs-group:spam')
+        db.publish.assert_called_once_with(rs_limits.GROUP_CHANNEL, 'spam')
+        db.incr.assert_called_once_with(rs_limits.EPOCH_KEY)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
         'get_database.return_value': mock.Mock(**{
             'get.return_value': None,
         }),
@@ -378,3 +4339,588 @@ class TestGroupClass(unittest2.TestCase):
         db.get.assert_called_once_with('rs-group:spam')
         self.assertFalse(db.set.called)
         self.assertFalse(db.delete.called)
+        self.assertFalse(db.publish.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {'storage': 'hash'},
+        'get_database.return_value': mock.Mock(**{
+            'hget.return_value': 'old_class',
+        }),
+    }))
+    def test_set_hash(self, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = rs_limits.group_class('config_file', 'spam',
+                                       klass='new_class')
+
+        self.assertEqual(result, 'old_class')
+        mock_Config.return_value.__getitem__.assert_called_with('rs_limits')
+        db.hget.assert_called_once_with(rs_limits.GROUP_HASH, 'spam')
+        db.hset.assert_called_once_with(rs_limits.GROUP_HASH, 'spam',
+                                        'new_class')
+        self.assertFalse(db.get.called)
+        self.assertFalse(db.set.called)
+        db.publish.assert_called_once_with(rs_limits.GROUP_CHANNEL, 'spam')
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {'storage': 'hash'},
+        'get_database.return_value': mock.Mock(**{
+            'hget.return_value': 'old_class',
+        }),
+    }))
+    def test_delete_hash(self, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = rs_limits.group_class('config_file', 'spam', delete=True)
+
+        self.assertEqual(result, 'old_class')
+        db.hdel.assert_called_once_with(rs_limits.GROUP_HASH, 'spam')
+        self.assertFalse(db.delete.called)
+        db.publish.assert_called_once_with(rs_limits.GROUP_CHANNEL, 'spam')
+
+
+class TestReadMappings(unittest2.TestCase):
+    def test_csv(self):
+        stream = StringIO.StringIO('grp1,cls1\n\n"grp,2",cls2\ngrp3,\n'
+                                   'grp4\n')
+
+        result = list(rs_limits._read_mappings(stream, 'csv'))
+
+        self.assertEqual(result, [('grp1', 'cls1'), ('grp,2', 'cls2'),
+                                  ('grp3', None), ('grp4', None)])
+
+    def test_csv_invalid(self):
+        stream = StringIO.StringIO('grp1,cls1\ngrp2,cls2,extra\n')
+
+        with self.assertRaises(ValueError) as cm:
+            list(rs_limits._read_mappings(stream, 'csv'))
+
+        self.assertEqual(str(cm.exception),
+                         "Invalid group mapping on line 2")
+
+    def test_json(self):
+        stream = StringIO.StringIO('{"group": "grp1", "class": "cls1"}\n'
+                                   '\n'
+                                   '{"group": "grp2", "class": null}\n'
+                                   '{"group": "grp3"}\n')
+
+        result = list(rs_limits._read_mappings(stream, 'json'))
+
+        self.assertEqual(result, [('grp1', 'cls1'), ('grp2', None),
+                                  ('grp3', None)])
+
+    def test_json_invalid(self):
+        for line in ('not json', '["grp1"]', '{"class": "cls1"}'):
+            stream = StringIO.StringIO('\n' + line + '\n')
+
+            with self.assertRaises(ValueError) as cm:
+                list(rs_limits._read_mappings(stream, 'json'))
+
+            self.assertEqual(str(cm.exception),
+                             "Invalid group mapping on line 2")
+
+
+class TestWriteMappings(unittest2.TestCase):
+    def test_csv(self):
+        stream = StringIO.StringIO()
+
+        rs_limits._write_mappings(stream, 'csv', [('grp1', 'cls1'),
+                                                  ('grp,2', 'cls2')])
+
+        self.assertEqual(stream.getvalue(), 'grp1,cls1\r\n"grp,2",cls2\r\n')
+
+    def test_json(self):
+        stream = StringIO.StringIO()
+
+        rs_limits._write_mappings(stream, 'json', [('grp1', 'cls1')])
+
+        self.assertEqual(stream.getvalue(),
+                         '{"class": "cls1", "group": "grp1"}\n')
+
+
+class TestBulkBatch(unittest2.TestCase):
+    def test_batch(self):
+        db = mock.Mock(**{'mget.return_value': ['cls1', None, 'cls3',
+                                                None]})
+        pipe = db.pipeline.return_value
+
+        result = rs_limits._bulk_batch(db, [
+            ('grp1', 'cls1'),
+            ('grp2', 'cls2'),
+            ('grp3', None),
+            ('grp4', None),
+        ])
+
+        self.assertEqual(result, [
+            ('grp2', None, 'cls2'),
+            ('grp3', 'cls3', None),
+        ])
+        db.mget.assert_called_once_with(['rs-group:grp1', 'rs-group:grp2',
+                                         'rs-group:grp3', 'rs-group:grp4'])
+        db.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.method_calls, [
+            mock.call.set('rs-group:grp2', 'cls2'),
+            mock.call.publish('rs-group-update', 'grp2'),
+            mock.call.delete('rs-group:grp3'),
+            mock.call.publish('rs-group-update', 'grp3'),
+            mock.call.incr(rs_limits.EPOCH_KEY),
+            mock.call.execute(),
+        ])
+
+    def test_unchanged(self):
+        db = mock.Mock(**{'mget.return_value': ['cls1']})
+
+        result = rs_limits._bulk_batch(db, [('grp1', 'cls1')])
+
+        self.assertEqual(result, [])
+        self.assertFalse(db.pipeline.return_value.execute.called)
+
+
+class TestDumpMappings(unittest2.TestCase):
+    def test_dump(self):
+        data = {'rs-group:grp1': 'cls1', 'rs-group:grp3': 'cls3'}
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter(['rs-group:grp1', 'rs-group:grp2',
+                                            'rs-group:grp3']),
+            'mget.side_effect': lambda keys: [data.get(k) for k in keys],
+        })
+        stream = StringIO.StringIO()
+
+        result = rs_limits._dump_mappings(db, stream, 'csv', 2)
+
+        self.assertEqual(result, 2)
+        self.assertEqual(stream.getvalue(), 'grp1,cls1\r\ngrp3,cls3\r\n')
+        db.scan_iter.assert_called_once_with(match='rs-group:*', count=2)
+        self.assertEqual(db.mget.call_args_list, [
+            mock.call(['rs-group:grp1', 'rs-group:grp2']),
+            mock.call(['rs-group:grp3']),
+        ])
+
+
+class TestReportGroupBulk(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        args = mock.Mock(dump=False)
+
+        result = rs_limits._report_group_bulk(args, [
+            ('grp1', None, 'cls1'),
+            ('grp2', 'old2', 'cls2'),
+            ('grp3', 'old3', None),
+        ])
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Group grp1:\n"
+                         "  New rate-limit class: cls1\n"
+                         "Group grp2:\n"
+                         "  Previous rate-limit class: old2\n"
+                         "  New rate-limit class: cls2\n"
+                         "Group grp3:\n"
+                         "  Previous rate-limit class: old3\n"
+                         "  Deleted from database\n"
+                         "Changed 3 group mapping(s)\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_report_dump(self):
+        args = mock.Mock(dump=True)
+
+        result = rs_limits._report_group_bulk(args, 5)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(), '')
+        self.assertEqual(sys.stderr.getvalue(),
+                         "Dumped 5 group mapping(s)\n")
+
+
+class TestGroupBulk(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'mappings')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_has_arguments(self):
+        self.assertIsInstance(rs_limits.group_bulk, tools.ScriptAdaptor)
+        self.assertGreater(len(rs_limits.group_bulk._arguments), 0)
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
+    }))
+    @mock.patch.object(rs_limits, '_bulk_batch',
+                       side_effect=lambda db, batch: [(g, None, k)
+                                                      for g, k in batch])
+    def test_import(self, mock_bulk_batch, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+        with open(self.path, 'w') as f:
+            f.write('grp1,cls1\ngrp2,cls2\ngrp1,\ngrp3,cls3\ngrp4,cls4\n')
+
+        result = rs_limits.group_bulk('config_file', self.path, batch=2)
+
+        self.assertEqual(result, [('grp1', None, 'cls1'),
+                                  ('grp2', None, 'cls2'),
+                                  ('grp1', None, None),
+                                  ('grp3', None, 'cls3'),
+                                  ('grp4', None, 'cls4')])
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        self.assertEqual(mock_bulk_batch.call_args_list, [
+            mock.call(db, [('grp1', 'cls1'), ('grp2', 'cls2')]),
+            mock.call(db, [('grp1', None), ('grp3', 'cls3')]),
+            mock.call(db, [('grp4', 'cls4')]),
+        ])
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
+    }))
+    @mock.patch.object(rs_limits, '_bulk_batch', return_value=[])
+    def test_import_duplicate(self, mock_bulk_batch, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+        with open(self.path, 'w') as f:
+            f.write('grp1,cls1\ngrp1,cls2\n')
+
+        rs_limits.group_bulk('config_file', self.path)
+
+        self.assertEqual(mock_bulk_batch.call_args_list, [
+            mock.call(db, [('grp1', 'cls1')]),
+            mock.call(db, [('grp1', 'cls2')]),
+        ])
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
+    }))
+    @mock.patch.object(rs_limits, '_bulk_batch', return_value=[])
+    @mock.patch.object(sys, 'stdin',
+                       StringIO.StringIO('{"group": "grp1", "class": "c"}'))
+    def test_import_stdin(self, mock_bulk_batch, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        rs_limits.group_bulk('config_file', fmt='json')
+
+        mock_bulk_batch.assert_called_once_with(db, [('grp1', 'c')])
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {'storage': 'hash'},
+    }))
+    @mock.patch.object(rs_limits, '_dump_mappings', return_value=3)
+    def test_dump(self, mock_dump_mappings, mock_Config):
+        result = rs_limits.group_bulk('config_file', self.path, dump=True,
+                                      batch=10)
+
+        self.assertEqual(result, 3)
+        db, stream, fmt, batch = mock_dump_mappings.call_args[0]
+        self.assertIsInstance(db, rs_limits.HashDatabase)
+        self.assertEqual(stream.name, self.path)
+        self.assertTrue(stream.closed)
+        self.assertEqual((fmt, batch), ('csv', 10))
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        '__getitem__.return_value': {},
+    }))
+    @mock.patch.object(rs_limits, '_dump_mappings', return_value=3)
+    def test_dump_stdout(self, mock_dump_mappings, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        rs_limits.group_bulk('config_file', dump=True, fmt='json')
+
+        mock_dump_mappings.assert_called_once_with(db, sys.stdout, 'json',
+                                                   1000)
+
+
+class TestMigrateBatch(unittest2.TestCase):
+    def test_migrate(self):
+        pipe = mock.Mock()
+        db = mock.Mock(**{
+            'mget.return_value': ['cls1', None, 'cls3'],
+            'pipeline.return_value': pipe,
+        })
+
+        result = rs_limits._migrate_batch(db, ['rs-group:grp1',
+                                               'rs-group:grp2',
+                                               'rs-group:grp3'])
+
+        self.assertEqual(result, 2)
+        db.mget.assert_called_once_with(['rs-group:grp1', 'rs-group:grp2',
+                                         'rs-group:grp3'])
+        db.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.method_calls, [
+            mock.call.hset(rs_limits.GROUP_HASH, 'grp1', 'cls1'),
+            mock.call.hset(rs_limits.GROUP_HASH, 'grp3', 'cls3'),
+            mock.call.execute(),
+        ])
+
+    def test_migrate_delete(self):
+        pipe = mock.Mock()
+        db = mock.Mock(**{
+            'mget.return_value': ['cls1'],
+            'pipeline.return_value': pipe,
+        })
+
+        result = rs_limits._migrate_batch(db, ['rs-group:grp1'], True)
+
+        self.assertEqual(result, 1)
+        self.assertEqual(pipe.method_calls, [
+            mock.call.hset(rs_limits.GROUP_HASH, 'grp1', 'cls1'),
+            mock.call.delete('rs-group:grp1'),
+            mock.call.execute(),
+        ])
+
+
+class TestReportGroupMigrate(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        args = mock.Mock(delete=False)
+
+        result = rs_limits._report_group_migrate(args, 5)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Migrated 5 group mapping(s) to hash rs-groups\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report_delete(self):
+        args = mock.Mock(delete=True)
+
+        result = rs_limits._report_group_migrate(args, 5)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Migrated 5 group mapping(s) to hash rs-groups\n"
+                         "  Original keys deleted from database\n")
+
+
+class TestGroupShare(unittest2.TestCase):
+    def test_has_arguments(self):
+        self.assertIsInstance(rs_limits.group_share, tools.ScriptAdaptor)
+        self.assertGreater(len(rs_limits.group_share._arguments), 0)
+
+    @mock.patch.object(config, 'Config')
+    def test_unconfigured(self, mock_Config):
+        mock_Config.return_value.__getitem__.return_value = {}
+
+        self.assertRaises(ValueError, rs_limits.group_share, 'config_file')
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(eventlet, 'monkey_patch')
+    @mock.patch.object(rs_limits.MappingListener, 'start')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'load')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'run')
+    def test_once(self, mock_run, mock_load, mock_start, mock_monkey_patch,
+                  mock_Config):
+        mock_Config.return_value.__getitem__.return_value = {
+            'shared_cache': '/tmp/mappings',
+        }
+
+        rs_limits.group_share('config_file', True)
+
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        mock_load.assert_called_once_with()
+        self.assertFalse(mock_run.called)
+        self.assertFalse(mock_start.called)
+        self.assertFalse(mock_monkey_patch.called)
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(eventlet, 'monkey_patch')
+    @mock.patch.object(rs_limits, 'MappingListener')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'load')
+    @mock.patch.object(rs_limits.SharedSnapshot, 'run')
+    def test_run(self, mock_run, mock_load, mock_MappingListener,
+                 mock_monkey_patch, mock_Config):
+        mock_Config.return_value.__getitem__.return_value = {
+            'shared_cache': '/tmp/mappings',
+            'storage': 'hash',
+        }
+        raw_db = mock_Config.return_value.get_database.return_value
+
+        rs_limits.group_share('config_file')
+
+        mock_monkey_patch.assert_called_once_with()
+        snapshot = mock_MappingListener.call_args[0][0]
+        self.assertIsInstance(snapshot, rs_limits.SharedSnapshot)
+        self.assertIsInstance(snapshot.db, rs_limits.HashDatabase)
+        mock_MappingListener.assert_called_once_with(snapshot, raw_db)
+        mock_MappingListener.return_value.start.assert_called_once_with()
+        mock_run.assert_called_once_with()
+        self.assertFalse(mock_load.called)
+
+
+class TestComputeTable(unittest2.TestCase):
+    def test_compute(self):
+        prios = rs_limits.GroupPriorities('grp1=0.1,grp2=0.9')
+        mappings = {'grp1': 'cls1', 'grp2': 'cls2', 'grp4': ''}
+
+        result = rs_limits._compute_table([
+            'grp1,grp2',
+            'grp1;q=0.9,grp2;q=0.1',
+            'grp3,grp4',
+            '',
+        ], prios, mappings)
+
+        self.assertEqual(result, {
+            'grp2,grp1': 'cls2',
+            'grp1,grp2': 'cls1',
+            'grp3,grp4': '',
+        })
+
+
+class TestStoreTable(unittest2.TestCase):
+    def test_store(self):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+
+        rs_limits._store_table(db, {'grp1': 'cls1', 'grp2': ''}, '5', 1)
+
+        db.pipeline.assert_called_once_with()
+        calls = pipe.method_calls
+        self.assertEqual(calls[0], mock.call.delete('rs-group-table.tmp'))
+        self.assertEqual(sorted(call[1][1].items()[0] for call in calls[1:3]),
+                         [('grp1', 'cls1'), ('grp2', '')])
+        self.assertEqual(calls[3:], [
+            mock.call.rename('rs-group-table.tmp', rs_limits.TABLE_KEY),
+            mock.call.hincrby(rs_limits.TABLE_INFO_KEY, 'version', 1),
+            mock.call.hset(rs_limits.TABLE_INFO_KEY, 'epoch', '5'),
+            mock.call.execute(),
+        ])
+
+    def test_store_empty(self):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+
+        rs_limits._store_table(db, {}, '5')
+
+        self.assertEqual(pipe.method_calls, [
+            mock.call.delete('rs-group-table.tmp'),
+            mock.call.delete(rs_limits.TABLE_KEY),
+            mock.call.hincrby(rs_limits.TABLE_INFO_KEY, 'version', 1),
+            mock.call.hset(rs_limits.TABLE_INFO_KEY, 'epoch', '5'),
+            mock.call.execute(),
+        ])
+
+
+class TestReportGroupTable(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        args = mock.Mock(delete=False)
+
+        result = rs_limits._report_group_table(
+            args, (5, {'grp1': 'cls1', 'grp2': '', 'grp3': 'cls1'}))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Stored 3 group combination(s) from 5 header "
+                         "value(s)\n"
+                         "  With a rate-limit class: 2\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report_delete(self):
+        args = mock.Mock(delete=True)
+
+        result = rs_limits._report_group_table(args, None)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Deleted the resolution table from database\n")
+
+
+class TestGroupTable(unittest2.TestCase):
+    def setUp(self):
+        self.rs_conf = {}
+        self.db = mock.Mock(**{
+            'get.return_value': '7',
+            'hget.return_value': 'grp1=0.1,grp2=0.9',
+        })
+        patcher = mock.patch.object(config, 'Config', return_value=mock.Mock(
+            **{
+                '__getitem__': lambda x, y: self.rs_conf,
+                'get_database.return_value': self.db,
+            }), to_bool=config.Config.to_bool)
+        self.mock_Config = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rs_limits, '_list_mappings',
+                                    return_value=iter([('grp1', 'cls1'),
+                                                       ('grp2', 'cls2')]))
+        self.mock_list_mappings = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rs_limits, '_store_table')
+        self.mock_store_table = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_has_arguments(self):
+        self.assertIsInstance(rs_limits.group_table, tools.ScriptAdaptor)
+        self.assertGreater(len(rs_limits.group_table._arguments), 0)
+
+    def test_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        file_name = os.path.join(tmpdir, 'headers')
+        with open(file_name, 'w') as f:
+            f.write('grp1,grp2\n\ngrp3\n')
+
+        result = rs_limits.group_table('config_file', file_name, batch=50)
+
+        table = {'grp1,grp2': 'cls1', 'grp3': ''}
+        self.assertEqual(result, (2, table))
+        self.mock_Config.assert_called_once_with(conf_file='config_file')
+        self.db.get.assert_called_once_with(rs_limits.EPOCH_KEY)
+        self.mock_list_mappings.assert_called_once_with(self.db, batch=50)
+        self.mock_store_table.assert_called_once_with(self.db, table, '7',
+                                                      50)
+
+    @mock.patch.object(sys, 'stdin', StringIO.StringIO('grp1,grp2\n'))
+    def test_stdin_priorities(self):
+        self.rs_conf['priorities_reload'] = 'yes'
+        self.rs_conf['groups'] = 'grp1=0.9'
+
+        result = rs_limits.group_table('config_file', '-')
+
+        self.assertEqual(result, (1, {'grp2,grp1': 'cls2'}))
+        self.db.hget.assert_called_once_with(rs_limits.PRIORITIES_KEY,
+                                             'groups')
+
+    def test_warmup_key(self):
+        self.rs_conf['warmup_key'] = 'hot'
+        self.rs_conf['storage'] = 'hash'
+        self.db.lrange.return_value = ['grp1,grp2']
+
+        result = rs_limits.group_table('config_file')
+
+        self.assertEqual(result, (1, {'grp1,grp2': 'cls1'}))
+        self.db.lrange.assert_called_once_with('hot', 0, -1)
+        self.assertFalse(self.db.hget.called)
+        db = self.mock_list_mappings.call_args[0][0]
+        self.assertIsInstance(db, rs_limits.HashDatabase)
+
+    def test_no_headers(self):
+        self.assertRaises(ValueError, rs_limits.group_table, 'config_file')
+        self.assertFalse(self.mock_store_table.called)
+
+    def test_delete(self):
+        result = rs_limits.group_table('config_file', delete=True)
+
+        self.assertEqual(result, None)
+        self.db.delete.assert_called_once_with(rs_limits.TABLE_KEY,
+                                               rs_limits.TABLE_INFO_KEY)
+        self.assertFalse(self.mock_store_table.called)
+
+
+class TestGroupMigrate(unittest2.TestCase):
+    def test_has_arguments(self):
+        self.assertIsInstance(rs_limits.group_migrate, tools.ScriptAdaptor)
+        self.assertGreater(len(rs_limits.group_migrate._arguments), 0)
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(rs_limits, '_migrate_batch', side_effect=[2, 1])
+    def test_migrate(self, mock_migrate_batch, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+        db.scan_iter.return_value = iter(['rs-group:grp1', 'rs-group:grp2',
+                                          'rs-group:grp3'])
+
+        result = rs_limits.group_migrate('config_file', True, 2)
+
+        self.assertEqual(result, 3)
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.scan_iter.assert_called_once_with(match='rs-group:*', count=2)
+        self.assertEqual(mock_migrate_batch.call_args_list, [
+            mock.call(db, ['rs-group:grp1', 'rs-group:grp2'], True),
+            mock.call(db, ['rs-group:grp3'], True),
+        ])